@@ -0,0 +1,524 @@
+"""
+End-to-end load benchmark of the pipelines server.
+
+Boots the FastAPI app from main.py under uvicorn, with synthetic pipelines
+covering the server's hot paths, plus a fake OpenAI-compatible upstream for
+the manifold. The synthetic pipelines are a string pipe, sync and async
+generator pipes, a manifold, a filter and a stream-filtered pipe.
+
+Drives /v1/models, /v1/chat/completions (stream and non-stream) and the filter
+endpoints at a controlled concurrency. For each scenario it reports:
+- p50/p95/p99 latency
+- time to first token and tokens/s when streaming
+- server CPU and peak RSS
+
+Usage:
+    python benchmarks/server_benchmark.py --requests 500 --concurrency 50
+    python benchmarks/server_benchmark.py --output baseline.json
+    python benchmarks/server_benchmark.py --compare baseline.json --tolerance 20
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+
+from stats import distribution, summarize
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_KEY = os.getenv("PIPELINES_API_KEY", "0p3n-w3bu!")
+
+
+# Synthetic pipelines, written to a temporary PIPELINES_DIR. Their output size and
+# speed are set with the BENCH_TOKENS and BENCH_TOKEN_DELAY_MS environment variables.
+PIPELINES = {
+    "bench_string.py": '''
+import os
+
+TOKENS = int(os.getenv("BENCH_TOKENS", "100"))
+
+
+class Pipeline:
+    def __init__(self):
+        self.name = "Bench String"
+
+    def pipe(self, user_message, model_id, messages, body):
+        return "token " * TOKENS
+''',
+    "bench_sync_generator.py": '''
+import os
+import time
+
+TOKENS = int(os.getenv("BENCH_TOKENS", "100"))
+DELAY = float(os.getenv("BENCH_TOKEN_DELAY_MS", "0")) / 1000
+
+
+class Pipeline:
+    def __init__(self):
+        self.name = "Bench Sync Generator"
+
+    def pipe(self, user_message, model_id, messages, body):
+        def generate():
+            for _ in range(TOKENS):
+                if DELAY:
+                    time.sleep(DELAY)
+                yield "token "
+
+        return generate()
+''',
+    "bench_async_generator.py": '''
+import asyncio
+import os
+
+TOKENS = int(os.getenv("BENCH_TOKENS", "100"))
+DELAY = float(os.getenv("BENCH_TOKEN_DELAY_MS", "0")) / 1000
+
+
+class Pipeline:
+    def __init__(self):
+        self.name = "Bench Async Generator"
+
+    async def pipe(self, user_message, model_id, messages, body):
+        async def generate():
+            for _ in range(TOKENS):
+                await asyncio.sleep(DELAY)
+                yield "token "
+
+        if body.get("stream"):
+            return generate()
+        return "".join([token async for token in generate()])
+''',
+    "bench_filtered.py": '''
+import os
+
+TOKENS = int(os.getenv("BENCH_TOKENS", "100"))
+
+
+class Pipeline:
+    def __init__(self):
+        self.name = "Bench Filtered"
+
+    def pipe(self, user_message, model_id, messages, body):
+        def generate():
+            for i in range(TOKENS):
+                yield "token. " if i % 10 == 9 else "token "
+
+        return generate()
+''',
+    "bench_filter.py": '''
+from typing import List, Optional
+from pydantic import BaseModel
+
+
+class Pipeline:
+    class Valves(BaseModel):
+        pipelines: List[str] = ["bench_filtered"]
+        priority: int = 0
+
+    def __init__(self):
+        self.type = "filter"
+        self.name = "Bench Filter"
+        self.valves = self.Valves()
+
+    async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        return body
+
+    async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        return body
+
+    async def stream_outlet(self, chunk: str, body: dict) -> str:
+        return chunk
+''',
+    "bench_manifold.py": '''
+import os
+import requests
+
+UPSTREAM_URL = os.getenv("BENCH_UPSTREAM_URL", "http://127.0.0.1:9100")
+
+
+class Pipeline:
+    def __init__(self):
+        self.type = "manifold"
+        self.name = "Bench: "
+        self.pipelines = [{"id": "upstream", "name": "Upstream"}]
+        self.session = requests.Session()
+
+    def pipe(self, user_message, model_id, messages, body):
+        r = self.session.post(
+            f"{UPSTREAM_URL}/chat/completions",
+            json={**body, "model": model_id},
+            stream=True,
+            timeout=60,
+        )
+        r.raise_for_status()
+        if body["stream"]:
+            return r.iter_lines()
+        return r.json()
+''',
+}
+
+
+def upstream_server(port: int, tokens: int, token_delay_ms: float):
+    """A fake OpenAI-compatible chat completions endpoint."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            model = body.get("model", "upstream")
+
+            if not body.get("stream"):
+                payload = json.dumps(
+                    {
+                        "id": "bench",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": "token " * tokens},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                    }
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            for i in range(tokens + 1):
+                if i and token_delay_ms:
+                    time.sleep(token_delay_ms / 1000)
+                chunk = {
+                    "id": "bench",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"content": "token "} if i < tokens else {},
+                            "finish_reason": None if i < tokens else "stop",
+                        }
+                    ],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+
+    ThreadingHTTPServer(("127.0.0.1", port), Handler).serve_forever()
+
+
+class ProcessMonitor:
+    """Samples the CPU time and RSS of a process from /proc (Linux) or psutil."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_rss = 0
+        try:
+            import psutil
+
+            self.process = psutil.Process(pid)
+        except ImportError:
+            self.process = None
+
+    def cpu_time(self) -> float:
+        if self.process is not None:
+            times = self.process.cpu_times()
+            return times.user + times.system
+        try:
+            with open(f"/proc/{self.pid}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return 0.0
+
+    def rss(self) -> int:
+        if self.process is not None:
+            return self.process.memory_info().rss
+        try:
+            with open(f"/proc/{self.pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    async def sample(self, interval: float = 0.1):
+        while True:
+            self.peak_rss = max(self.peak_rss, self.rss())
+            await asyncio.sleep(interval)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def chat_body(model: str, stream: bool) -> dict:
+    return {
+        "model": model,
+        "stream": stream,
+        "messages": [{"role": "user", "content": "Benchmark the server."}],
+    }
+
+
+def scenarios(tokens: int) -> list:
+    """(name, method, path, body, stream) of every benchmarked request."""
+    chats = [
+        ("string", "bench_string"),
+        ("sync_generator", "bench_sync_generator"),
+        ("async_generator", "bench_async_generator"),
+        ("manifold", "bench_manifold.upstream"),
+        ("stream_filter", "bench_filtered"),
+    ]
+    items = [("models", "GET", "/v1/models", None, False)]
+    for name, model in chats:
+        items.append((f"{name}", "POST", "/v1/chat/completions", chat_body(model, False), False))
+        items.append((f"{name}_stream", "POST", "/v1/chat/completions", chat_body(model, True), True))
+    filter_body = {"body": chat_body("bench_filtered", False), "user": {"id": "bench"}}
+    items.append(("filter_inlet", "POST", "/v1/bench_filter/filter/inlet", filter_body, False))
+    items.append(("filter_outlet", "POST", "/v1/bench_filter/filter/outlet", filter_body, False))
+    return items
+
+
+async def run_scenario(
+    session, base_url, scenario, requests, concurrency, monitor, quiet=False
+) -> dict:
+    name, method, path, body, stream = scenario
+    latencies, ttfts, rates = [], [], []
+    tokens_total = 0
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request():
+        nonlocal tokens_total, errors
+        async with semaphore:
+            started = time.perf_counter()
+            first_token = None
+            tokens = 0
+            try:
+                async with session.request(method, f"{base_url}{path}", json=body) as r:
+                    if r.status != 200:
+                        errors += 1
+                        await r.read()
+                        return
+                    if stream:
+                        async for line in r.content:
+                            line = line.strip()
+                            if not line.startswith(b"data:") or line == b"data: [DONE]":
+                                continue
+                            try:
+                                chunk = json.loads(line[5:])
+                                content = chunk["choices"][0]["delta"].get("content")
+                            except (ValueError, KeyError, IndexError):
+                                content = None
+                            if content:
+                                tokens += 1
+                                if first_token is None:
+                                    first_token = time.perf_counter() - started
+                    else:
+                        await r.read()
+            except aiohttp.ClientError:
+                errors += 1
+                return
+
+            latency = time.perf_counter() - started
+            latencies.append(latency)
+            if first_token is not None:
+                ttfts.append(first_token)
+                tokens_total += tokens
+                if latency > first_token:
+                    rates.append(tokens / (latency - first_token))
+
+    cpu_before = monitor.cpu_time()
+    monitor.peak_rss = monitor.rss()
+    started = time.perf_counter()
+    await asyncio.gather(*[request() for _ in range(requests)])
+    elapsed = time.perf_counter() - started
+    cpu = monitor.cpu_time() - cpu_before
+
+    result = {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency": distribution(latencies),
+        "server_cpu_percent": round(100 * cpu / elapsed, 1),
+        "server_peak_rss_mb": round(monitor.peak_rss / 2**20, 1),
+    }
+    if stream:
+        result["ttft"] = distribution(ttfts)
+        result["tokens_per_second"] = round(sum(rates) / len(rates), 1) if rates else 0.0
+        result["tokens_per_second_total"] = round(tokens_total / elapsed, 1)
+
+    if quiet:
+        return result
+
+    print(f"\n[{name}] {result['throughput_rps']} requests/s, {errors} errors")
+    print(summarize("latency", latencies))
+    if stream:
+        print(summarize("ttft", ttfts))
+        print(
+            f"{'tokens/s':<16} {result['tokens_per_second']} per stream, "
+            f"{result['tokens_per_second_total']} total"
+        )
+    print(
+        f"{'server':<16} CPU {result['server_cpu_percent']}%, "
+        f"peak RSS {result['server_peak_rss_mb']} MB"
+    )
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns the regressions of results over baseline beyond tolerance percent."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        for metric in ("latency", "ttft"):
+            for key in ("p50_ms", "p99_ms"):
+                old = previous.get(metric, {}).get(key)
+                new = result.get(metric, {}).get(key)
+                if old and new and new > old * (1 + tolerance / 100):
+                    regressions.append(f"{name} {metric} {key}: {old} -> {new}")
+        old, new = previous.get("throughput_rps"), result.get("throughput_rps")
+        if old and new is not None and new < old * (1 - tolerance / 100):
+            regressions.append(f"{name} throughput_rps: {old} -> {new}")
+    return regressions
+
+
+async def wait_until_ready(base_url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError("The server exited during startup")
+            try:
+                async with session.get(f"{base_url}/") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("The server did not start in time")
+
+
+async def run(args) -> int:
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(
+        target=upstream_server,
+        args=(upstream_port, args.tokens, args.token_delay_ms),
+        daemon=True,
+    )
+    upstream.start()
+
+    pipelines_dir = tempfile.mkdtemp(prefix="pipelines-bench-")
+    for filename, source in PIPELINES.items():
+        with open(os.path.join(pipelines_dir, filename), "w") as file:
+            file.write(source.lstrip())
+
+    port = free_port()
+    env = {
+        **os.environ,
+        "PIPELINES_DIR": pipelines_dir,
+        "PIPELINES_API_KEY": API_KEY,
+        "BENCH_TOKENS": str(args.tokens),
+        "BENCH_TOKEN_DELAY_MS": str(args.token_delay_ms),
+        "BENCH_UPSTREAM_URL": f"http://127.0.0.1:{upstream_port}",
+    }
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--log-level", "warning", "--no-access-log",
+        ],
+        cwd=ROOT,
+        env=env,
+        stdout=None if args.verbose else subprocess.DEVNULL,
+    )
+
+    base_url = f"http://127.0.0.1:{port}"
+    results = {}
+    try:
+        await wait_until_ready(base_url, server)
+        monitor = ProcessMonitor(server.pid)
+        sampler = asyncio.create_task(monitor.sample())
+
+        headers = {"Authorization": f"Bearer {API_KEY}"}
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+            selected = [s for s in scenarios(args.tokens) if not args.only or s[0] in args.only]
+            for scenario in selected:
+                if args.warmup:
+                    await run_scenario(
+                        session, base_url, scenario, args.warmup, args.concurrency, monitor, quiet=True
+                    )
+                results[scenario[0]] = await run_scenario(
+                    session, base_url, scenario, args.requests, args.concurrency, monitor
+                )
+        sampler.cancel()
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+        upstream.terminate()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.tolerance}%:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"\nNo regression over {args.tolerance}% against {args.compare}")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=10, help="Warmup requests per scenario")
+    parser.add_argument("--tokens", type=int, default=100, help="Tokens per response")
+    parser.add_argument("--token-delay-ms", type=float, default=0)
+    parser.add_argument("--only", nargs="*", help="Scenarios to run, all by default")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=20, help="Regression tolerance in percent")
+    parser.add_argument("--verbose", action="store_true", help="Show the server output")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+from typing import Dict, List
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile, 0 for an empty list."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def distribution(values: List[float]) -> Dict[str, float]:
+    """p50, p95, p99 and max of values in seconds, converted to milliseconds."""
+    return {
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+
+def summarize(name: str, values: List[float]) -> str:
+    if not values:
+        return f"{name:<16} n/a"
+    stats = distribution(values)
+    return (
+        f"{name:<16} p50 {stats['p50_ms']:8.1f} ms"
+        f"  p95 {stats['p95_ms']:8.1f} ms"
+        f"  p99 {stats['p99_ms']:8.1f} ms"
+        f"  max {stats['max_ms']:8.1f} ms"
+    )
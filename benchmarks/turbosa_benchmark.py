@@ -0,0 +1,152 @@
+"""
+Load benchmark of the TurboSA controls evidence pipeline on local stand-in
+backends (see utils/pipelines/turbosa.py), without any Azure service.
+
+Runs the pipeline's pipe under concurrency and reports end-to-end latency, time
+to first chunk when streaming, and throughput.
+
+Usage:
+    python benchmarks/turbosa_benchmark.py --requests 200 --concurrency 20
+    python benchmarks/turbosa_benchmark.py --corpus corpus.json --stream --mode search
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.pipelines.turbosa import (  # noqa: E402
+    BM25Retriever,
+    InMemoryControlCatalog,
+    StubLLM,
+)
+
+from stats import summarize  # noqa: E402
+
+PIPELINE_PATH = os.path.join(ROOT, "pipelines", "TurboSA_controls_evidence_index.py")
+
+WORDS = (
+    "access account audit authentication backup change configuration control data "
+    "encryption incident integrity key log monitoring network password patch policy "
+    "privilege recovery review risk role security session system training user vendor"
+).split()
+
+
+def generate_corpus(controls: int, documents: int, questions: int, seed: int) -> dict:
+    """Generates a deterministic synthetic control catalog and document corpus."""
+    rng = random.Random(seed)
+
+    def sentence(length: int) -> str:
+        return " ".join(rng.choice(WORDS) for _ in range(length))
+
+    return {
+        "controls": [
+            {
+                "Family": "AC",
+                "ControlID": str(i + 1),
+                "Name": sentence(3),
+                "GeneratedQuestions": "\n".join(f"{sentence(8)}?" for _ in range(questions)),
+            }
+            for i in range(controls)
+        ],
+        "documents": [
+            {"title": f"document-{i}.pdf", "chunk": sentence(120)}
+            for i in range(documents)
+        ],
+    }
+
+
+def load_pipeline():
+    spec = importlib.util.spec_from_file_location("turbosa_benchmark_pipeline", PIPELINE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Pipeline()
+
+
+async def run(args):
+    if args.corpus:
+        with open(args.corpus, "r") as file:
+            corpus = json.load(file)
+    else:
+        corpus = generate_corpus(args.controls, args.documents, args.questions, args.seed)
+
+    pipeline = load_pipeline()
+    pipeline.catalog = InMemoryControlCatalog(corpus["controls"])
+    pipeline.retriever = BM25Retriever(corpus["documents"])
+    pipeline.llm = StubLLM(args.latency_ms, args.tokens_per_second, args.tokens)
+
+    rng = random.Random(args.seed)
+    controls = corpus["controls"]
+
+    def message() -> str:
+        mode = args.mode if args.mode != "mixed" else rng.choice(["control", "search"])
+        if mode == "control" and controls:
+            control = rng.choice(controls)
+            return f"Family: {control['Family']} ControlID: {control['ControlID']}"
+        return f"How is {rng.choice(WORDS)} {rng.choice(WORDS)} handled?"
+
+    messages = [message() for _ in range(args.requests)]
+    latencies, first_chunks, errors = [], [], 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def request(user_message: str):
+        nonlocal errors
+        body = {"stream": args.stream}
+        chat = [{"role": "user", "content": user_message}]
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await pipeline.pipe(user_message, "turbosa", chat, body)
+                if args.stream:
+                    first = True
+                    async for _ in response:
+                        if first:
+                            first_chunks.append(time.perf_counter() - started)
+                            first = False
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors += 1
+                print(f"Error: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*[request(user_message) for user_message in messages])
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{args.requests} requests, concurrency {args.concurrency}, mode {args.mode}, "
+        f"stream {args.stream}, LLM latency {args.latency_ms} ms, "
+        f"{args.tokens_per_second} tokens/s"
+    )
+    print(summarize("latency", latencies))
+    if args.stream:
+        print(summarize("first chunk", first_chunks))
+    print(f"{'throughput':<16} {len(latencies) / elapsed:8.1f} requests/s over {elapsed:.2f} s")
+    print(f"{'errors':<16} {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--mode", choices=["control", "search", "mixed"], default="mixed")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--corpus", help="JSON file with controls and documents lists")
+    parser.add_argument("--controls", type=int, default=50)
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--questions", type=int, default=5, help="Questions per control")
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=50, help="Tokens per answer")
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,24 @@
-from typing import List, Optional
+from typing import List, Optional, Union
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
 import os
-import requests
 import json
+import asyncio
+import functools
+import inspect
+import re
+import threading
+import aiohttp
+from collections import OrderedDict
 
 from utils.pipelines.main import (
     get_last_user_message,
     add_or_update_system_message,
     get_tools_specs,
 )
+from utils.pipelines.logger import get_logger
+
+logger = get_logger("blueprints.function_calling")
 
 # System prompt for function calling
 DEFAULT_SYSTEM_PROMPT = (
@@ -18,10 +27,142 @@ DEFAULT_SYSTEM_PROMPT = (
 If a function tool doesn't match the query, return an empty string. Else, pick a
 function tool, fill in the parameters from the function tool's schema, and
 return it in the format {{ "name": \"functionName\", "parameters": {{ "key":
-"value" }} }}. Only pick a function if the user asks.  Only return the object. Do not return any other text."
+"value" }} }}. If several function tools are needed, return a JSON list of such
+objects. Only pick a function if the user asks.  Only return the object. Do not return any other text."
 """
         )
 
+# Words that appear in most tool docstrings and say nothing about when to use them
+TRIGGER_STOPWORDS = {
+    "about", "also", "default", "empty", "found", "from", "given", "into",
+    "parameter", "result", "return", "returns", "string", "that", "their",
+    "then", "there", "this", "when", "with", "your",
+}
+
+
+class ToolPreClassifier:
+    """
+    Decides locally whether a user message may need a tool, so that the task
+    model is only called when it has a chance to pick one.
+
+    A message passes if it matches a keyword trigger derived from the tool
+    names and descriptions, one of the explicit regex triggers, or (when an
+    embedding model is configured) is similar enough to a tool description.
+    Recent decisions are kept in a small LRU cache. If the embedding model
+    cannot be loaded or run, every message passes, as without the classifier.
+    """
+
+    def __init__(
+        self,
+        tools_specs: List[dict],
+        triggers: Optional[dict] = None,
+        embedding_model: str = "",
+        embedding_threshold: float = 0.35,
+        cache_size: int = 256,
+    ) -> None:
+        keywords = set()
+        for spec in tools_specs:
+            words = spec["name"].split("_") + re.findall(
+                r"[a-zA-Z]+", spec.get("description", "")
+            )
+            keywords.update(
+                word.lower()
+                for word in words
+                if len(word) >= 4 and word.lower() not in TRIGGER_STOPWORDS
+            )
+
+        patterns = [r"\b(?:" + "|".join(sorted(map(re.escape, keywords))) + ")"] if keywords else []
+        for tool_triggers in (triggers or {}).values():
+            patterns.extend(tool_triggers)
+        self.trigger_regex = (
+            re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+            if patterns
+            else None
+        )
+
+        self.descriptions = [
+            f"{spec['name'].replace('_', ' ')}: {spec.get('description', '')}"
+            for spec in tools_specs
+        ]
+        self.embedding_model_name = embedding_model
+        self.embedding_threshold = embedding_threshold
+        self.embedding_model = None
+        self.description_embeddings = None
+        self.embedding_lock = threading.Lock()
+        self.embedding_failed = False
+
+        self.cache_size = cache_size
+        self.cache: OrderedDict = OrderedDict()
+
+    def load_embedding_model(self) -> bool:
+        # Concurrent first messages must not load the model twice
+        with self.embedding_lock:
+            if self.embedding_failed:
+                return False
+            if self.embedding_model is None:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError:
+                    logger.info("sentence-transformers not installed, skipping embedding pre-classifier")
+                    self.embedding_model_name = ""
+                    return False
+
+                try:
+                    model = SentenceTransformer(self.embedding_model_name)
+                    self.description_embeddings = model.encode(
+                        self.descriptions, normalize_embeddings=True
+                    )
+                except Exception as e:
+                    logger.warning(
+                        "Error loading embedding model %s, no longer filtering messages: %s",
+                        self.embedding_model_name,
+                        e,
+                    )
+                    self.embedding_failed = True
+                    return False
+                self.embedding_model = model
+        return True
+
+    def embedding_match(self, message: str) -> bool:
+        if not self.descriptions or not self.load_embedding_model():
+            return False
+        embedding = self.embedding_model.encode([message], normalize_embeddings=True)[0]
+        return float((self.description_embeddings @ embedding).max()) >= self.embedding_threshold
+
+    async def needs_tool(self, message: Optional[str]) -> bool:
+        if not isinstance(message, str) or not message.strip():
+            return False
+
+        key = " ".join(message.lower().split())
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if self.embedding_failed:
+            return True
+
+        decision = bool(self.trigger_regex and self.trigger_regex.search(message))
+        if not decision and self.embedding_model_name:
+            loop = asyncio.get_running_loop()
+            try:
+                decision = await loop.run_in_executor(None, self.embedding_match, message)
+                if self.embedding_failed:
+                    return True
+            except Exception as e:
+                logger.warning(
+                    "Error running embedding model %s, no longer filtering messages: %s",
+                    self.embedding_model_name,
+                    e,
+                )
+                self.embedding_failed = True
+                return True
+
+        self.cache[key] = decision
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return decision
+
+
 class Pipeline:
     class Valves(BaseModel):
         # List target pipeline ids (models) that this filter will be connected to.
@@ -39,6 +180,18 @@ class Pipeline:
         TASK_MODEL: str
         TEMPLATE: str
 
+        # Timeouts (in seconds) for the task model request and for each tool call
+        TASK_MODEL_TIMEOUT: float = 30
+        TOOL_TIMEOUT: float = 30
+
+        # Skip the task model for messages that the local pre-classifier rules out.
+        # EMBEDDING_MODEL is an optional sentence-transformers model name used when
+        # no keyword trigger matches.
+        SKIP_HEURISTICS: bool = True
+        EMBEDDING_MODEL: str = ""
+        EMBEDDING_THRESHOLD: float = 0.35
+        DECISION_CACHE_SIZE: int = 256
+
     def __init__(self, prompt: str | None = None) -> None:
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -53,6 +206,21 @@ class Pipeline:
         self.prompt = prompt or DEFAULT_SYSTEM_PROMPT
         self.tools: object = None
 
+        # Optional regex triggers per tool name, e.g. {"calculator": [r"\d\s*[-+*/]\s*\d"]}
+        self.tool_triggers: dict = {}
+
+        # Tool specs and the formatted system prompt only depend on self.tools and
+        # self.prompt, so they are computed once and reused until either changes
+        # or the valves are updated.
+        self._cached_tools: object = None
+        self._cached_prompt: Optional[str] = None
+        self._tools_specs: Optional[List[dict]] = None
+        self._tools_prompt: Optional[str] = None
+        self._preclassifier: Optional[ToolPreClassifier] = None
+
+        # Pooled HTTP session for the task model, created on first use
+        self.session: Optional[aiohttp.ClientSession] = None
+
         # Initialize valves
         self.valves = self.Valves(
             **{
@@ -77,29 +245,68 @@ And answer according to the language of the user's question.""",
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        await self.close_session()
+
+    async def on_valves_updated(self):
+        # This function is called when the valves are updated.
+        self.invalidate_tools_cache()
+
+    def invalidate_tools_cache(self):
+        self._tools_specs = None
+        self._tools_prompt = None
+        self._preclassifier = None
+
+    def get_tools_prompt(self) -> str:
+        if (
+            self._tools_prompt is None
+            or self._cached_tools is not self.tools
+            or self._cached_prompt != self.prompt
+        ):
+            self._tools_specs = get_tools_specs(self.tools)
+            self._tools_prompt = self.prompt.format(
+                json.dumps(self._tools_specs, indent=2)
+            )
+            self._cached_tools = self.tools
+            self._cached_prompt = self.prompt
+            self._preclassifier = None
+        return self._tools_prompt
+
+    def get_preclassifier(self) -> ToolPreClassifier:
+        self.get_tools_prompt()
+        if self._preclassifier is None:
+            self._preclassifier = ToolPreClassifier(
+                self._tools_specs,
+                triggers=self.tool_triggers,
+                embedding_model=self.valves.EMBEDDING_MODEL,
+                embedding_threshold=self.valves.EMBEDDING_THRESHOLD,
+                cache_size=self.valves.DECISION_CACHE_SIZE,
+            )
+        return self._preclassifier
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # If title generation is requested, skip the function calling filter
         if body.get("title", False):
             return body
 
-        print(f"pipe:{__name__}")
-        print(user)
+        logger.debug("pipe:%s user:%s", __name__, (user or {}).get("id"))
 
         # Get the last user message
         user_message = get_last_user_message(body["messages"])
 
-        # Get the tools specs
-        tools_specs = get_tools_specs(self.tools)
+        # Skip the task model round-trip if no tool can plausibly apply
+        if self.valves.SKIP_HEURISTICS and not await self.get_preclassifier().needs_tool(
+            user_message
+        ):
+            return body
 
-        prompt = self.prompt.format(json.dumps(tools_specs, indent=2))
+        # Get the system prompt with the (cached) tools specs
+        prompt = self.get_tools_prompt()
         content = "History:\n" + "\n".join(
                                 [
                                     f"{message['role']}: {message['content']}"
@@ -107,41 +314,84 @@ And answer according to the language of the user's question.""",
                                 ]
                             ) + f"Query: {user_message}"
 
-        result = self.run_completion(prompt, content)
-        messages = self.call_function(result, body["messages"])
+        result = await self.run_completion(prompt, content)
+        messages = await self.call_function(result, body["messages"])
 
         return {**body, "messages": messages}
 
-    # Call the function
-    def call_function(self, result, messages: list[dict]) -> list[dict]:
-        if "name" not in result:
+    async def get_session(self) -> aiohttp.ClientSession:
+        # A single pooled session is reused for every task model request
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    # Run a single tool call, off the event loop for sync tools
+    async def run_tool(self, name: str, parameters: dict):
+        function = getattr(self.tools, name)
+        if inspect.iscoroutinefunction(function):
+            coroutine = function(**parameters)
+        else:
+            loop = asyncio.get_running_loop()
+            coroutine = loop.run_in_executor(
+                None, functools.partial(function, **parameters)
+            )
+        return await asyncio.wait_for(coroutine, timeout=self.valves.TOOL_TIMEOUT)
+
+    # Call the functions
+    async def call_function(self, result, messages: list[dict]) -> list[dict]:
+        # The task model may return a single tool call or a list of tool calls
+        tool_calls = result if isinstance(result, list) else [result]
+        tool_calls = [
+            tool_call
+            for tool_call in tool_calls
+            if isinstance(tool_call, dict)
+            and "name" in tool_call
+            and hasattr(self.tools, tool_call["name"])
+        ]
+        if not tool_calls:
             return messages
 
-        function = getattr(self.tools, result["name"])
-        function_result = None
-        try:
-            function_result = function(**result["parameters"])
-        except Exception as e:
-            print(e)
+        function_results = await asyncio.gather(
+            *[
+                self.run_tool(tool_call["name"], tool_call.get("parameters", {}))
+                for tool_call in tool_calls
+            ],
+            return_exceptions=True,
+        )
 
-        # Add the function result to the system prompt
-        if function_result:
+        context = []
+        for tool_call, function_result in zip(tool_calls, function_results):
+            if isinstance(function_result, asyncio.TimeoutError):
+                logger.warning("Tool %s timed out", tool_call["name"])
+            elif isinstance(function_result, Exception):
+                logger.warning("Tool %s failed: %s", tool_call["name"], function_result)
+            elif function_result:
+                context.append(str(function_result))
+
+        # Add the function results to the system prompt
+        if context:
             system_prompt = self.valves.TEMPLATE.replace(
-                "{{CONTEXT}}", function_result
+                "{{CONTEXT}}", "\n".join(context)
             )
 
             messages = add_or_update_system_message(
                 system_prompt, messages
             )
 
-            # Return the updated messages
-            return messages
+        # Return the updated messages
+        return messages
 
-    def run_completion(self, system_prompt: str, content: str) -> dict:
-        r = None
+    async def run_completion(self, system_prompt: str, content: str) -> Union[dict, list]:
         try:
+            session = await self.get_session()
+
             # Call the OpenAI API to get the function response
-            r = requests.post(
+            async with session.post(
                 url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
                 json={
                     "model": self.valves.TASK_MODEL,
@@ -162,26 +412,22 @@ And answer according to the language of the user's question.""",
                     "Authorization": f"Bearer {self.valves.OPENAI_API_KEY}",
                     "Content-Type": "application/json",
                 },
-                stream=False,
-            )
-            r.raise_for_status()
+                timeout=aiohttp.ClientTimeout(total=self.valves.TASK_MODEL_TIMEOUT),
+            ) as r:
+                if r.status >= 400:
+                    logger.warning("Error: %s %s", r.status, await r.text())
+                    return {}
 
-            response = r.json()
-            content = response["choices"][0]["message"]["content"]
+                response = await r.json(content_type=None)
+                content = response["choices"][0]["message"]["content"]
 
             # Parse the function response
             if content != "":
                 result = json.loads(content)
-                print(result)
+                logger.debug("Function calling result: %s", result)
                 return result
 
         except Exception as e:
-            print(f"Error: {e}")
-
-            if r:
-                try:
-                    print(r.json())
-                except:
-                    pass
+            logger.warning("Error: %s", e)
 
         return {}
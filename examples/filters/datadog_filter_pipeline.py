@@ -11,11 +11,18 @@ environment_variables: DD_LLMOBS_AGENTLESS_ENABLED, DD_LLMOBS_ENABLED, DD_LLMOBS
 
 from typing import List, Optional
 import os
+import random
+import time
+import uuid
 
+from utils.pipelines.logger import get_pipeline_logger
 from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.telemetry import BackgroundExporter, TTLStore
 from pydantic import BaseModel
 from ddtrace.llmobs import LLMObs
 
+logger = get_pipeline_logger(__name__)
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -34,6 +41,17 @@ class Pipeline:
         dd_site: str
         ml_app: str
 
+        # Fraction of requests that are traced, between 0 and 1
+        sample_rate: float = 1.0
+
+        # Spans whose outlet never arrives are finished after span_ttl_seconds,
+        # and at most max_spans are kept in flight
+        span_ttl_seconds: int = 3600
+        max_spans: int = 10000
+
+        # Maximum number of pending span updates before new ones are dropped
+        max_queue_size: int = 10000
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -53,29 +71,46 @@ class Pipeline:
                 "dd_api_key": os.getenv("DD_API_KEY"),
                 "dd_site": os.getenv("DD_SITE", "datadoghq.com"),
                 "ml_app": os.getenv("ML_APP", "pipelines-test"),
+                "sample_rate": float(os.getenv("DD_LLMOBS_SAMPLE_RATE", 1.0)),
             }
         )
 
         # DataDog LLMOBS docs: https://docs.datadoghq.com/tracing/llm_observability/sdk/
         self.LLMObs = LLMObs()
-        self.llm_span = None
-        self.chat_generations = {}
+        self.chat_generations = TTLStore(
+            max_size=self.valves.max_spans,
+            ttl=self.valves.span_ttl_seconds,
+            on_evict=self.on_span_evicted,
+        )
+        self.exporter = None
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         self.set_dd()
+        self.exporter = BackgroundExporter(
+            f"datadog:{__name__}",
+            max_queue_size=self.valves.max_queue_size,
+            flush=self.LLMObs.flush,
+        )
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        self.LLMObs.flush()
+        logger.info("on_shutdown:%s", __name__)
+        if self.exporter is not None:
+            self.exporter.close()
+            logger.info("Datadog exporter: %s", self.exporter.metrics)
+        logger.info("Datadog in-flight spans: %s", self.chat_generations.metrics)
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
+        self.chat_generations.max_size = self.valves.max_spans
+        self.chat_generations.ttl = self.valves.span_ttl_seconds
+        if self.exporter is not None:
+            self.exporter.resize(self.valves.max_queue_size)
         self.set_dd()
         pass
 
@@ -88,34 +123,61 @@ class Pipeline:
             integrations_enabled=True,
         )
 
+    def annotate_span(self, span, **kwargs):
+        # Runs on the exporter thread
+        self.LLMObs.annotate(span=span, **kwargs)
+
+    def finish_span(self, span, output_data: Optional[str], finish_time: float):
+        # Runs on the exporter thread, the exporter flushes after each batch
+        if output_data is not None:
+            self.LLMObs.annotate(span=span, output_data=output_data)
+        span.finish(finish_time=finish_time)
+
+    def on_span_evicted(self, chat_id: str, span):
+        # Abandoned spans are still finished, so that they are not left open
+        if self.exporter is not None:
+            self.exporter.submit(self.finish_span, span, None, time.time())
+
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"inlet:{__name__}")
+        logger.debug("inlet:%s", __name__)
+
+        if random.random() >= self.valves.sample_rate:
+            return body
 
-        self.llm_span = self.LLMObs.llm(
+        chat_id = body.get("chat_id") or str(uuid.uuid4())
+
+        # Starting a span only creates it in memory, annotations and submission
+        # happen on the exporter thread
+        llm_span = self.LLMObs.llm(
             model_name=body["model"],
             name=f"filter:{__name__}",
             model_provider="open-webui",
-            session_id=body["chat_id"],
+            session_id=chat_id,
             ml_app=self.valves.ml_app
         )
+        self.chat_generations.set(chat_id, llm_span)
 
-        self.LLMObs.annotate(
-            span = self.llm_span,
-            input_data = get_last_user_message(body["messages"]),
+        self.exporter.submit(
+            self.annotate_span,
+            llm_span,
+            input_data=get_last_user_message(body["messages"]),
         )
 
         return body
 
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"outlet:{__name__}")
+        logger.debug("outlet:%s", __name__)
 
-        self.LLMObs.annotate(
-            span = self.llm_span,
-            output_data = get_last_assistant_message(body["messages"]),
-        )
+        llm_span = self.chat_generations.pop(body.get("chat_id"))
+        if llm_span is None:
+            return body
 
-        self.llm_span.finish()
-        self.LLMObs.flush()
+        self.exporter.submit(
+            self.finish_span,
+            llm_span,
+            get_last_assistant_message(body["messages"]),
+            time.time(),
+        )
 
         return body
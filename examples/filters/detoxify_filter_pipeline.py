@@ -14,6 +14,11 @@ from pydantic import BaseModel
 from detoxify import Detoxify
 import os
 
+from utils.pipelines.batching import MicroBatcher
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -27,6 +32,12 @@ class Pipeline:
         # The lower the number, the higher the priority.
         priority: int = 0
 
+        # Concurrent inlets are batched into one prediction of up to max_batch_size
+        # messages, waiting at most max_wait_ms for the batch to fill up
+        max_batch_size: int = 16
+        max_wait_ms: float = 10
+        cache_size: int = 1024
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -47,35 +58,60 @@ class Pipeline:
         )
 
         self.model = None
+        self.batcher = None
 
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
 
         self.model = Detoxify("original")
+        self.update_batcher()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.batcher is not None:
+            await self.batcher.close()
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
-        pass
+        # The batcher is reconfigured in place, so that requests already queued
+        # are still answered and the model keeps running on a single thread
+        if self.batcher is not None:
+            self.batcher.configure(
+                max_batch_size=self.valves.max_batch_size,
+                max_wait_ms=self.valves.max_wait_ms,
+                cache_size=self.valves.cache_size,
+            )
+
+    def update_batcher(self):
+        self.batcher = MicroBatcher(
+            self.predict_batch,
+            max_batch_size=self.valves.max_batch_size,
+            max_wait_ms=self.valves.max_wait_ms,
+            cache_size=self.valves.cache_size,
+        )
+
+    def predict_batch(self, texts: List[str]) -> List[dict]:
+        # Detoxify returns one list of scores per label for a list of texts
+        scores = self.model.predict(texts)
+        return [
+            {label: float(values[i]) for label, values in scores.items()}
+            for i in range(len(texts))
+        ]
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # This filter is applied to the form data before it is sent to the OpenAI API.
-        print(f"inlet:{__name__}")
+        logger.debug("inlet:%s", __name__)
 
-        print(body)
         user_message = body["messages"][-1]["content"]
 
         # Filter out toxic messages
-        toxicity = self.model.predict(user_message)
-        print(toxicity)
+        toxicity = await self.batcher.predict(user_message)
+        logger.debug("%s", toxicity)
 
         if toxicity["toxicity"] > 0.5:
             raise Exception("Toxic message detected")
@@ -10,10 +10,16 @@ requirements: pydantic, aiohttp
 
 from typing import List, Optional
 from pydantic import BaseModel
+from collections import OrderedDict
+import asyncio
+import hashlib
 import json
 import aiohttp
+from utils.pipelines.logger import get_pipeline_logger
 from utils.pipelines.main import get_last_user_message
 
+logger = get_pipeline_logger(__name__)
+
 class Pipeline:
     class Valves(BaseModel):
         pipelines: List[str] = []
@@ -21,6 +27,10 @@ class Pipeline:
         vision_model: str = "llava"
         ollama_base_url: str = ""
         model_to_override: str = ""
+        # Maximum number of images described at the same time
+        max_concurrency: int = 4
+        # Number of image descriptions remembered across turns
+        cache_size: int = 256
 
     def __init__(self):
         self.type = "filter"
@@ -30,14 +40,24 @@ class Pipeline:
                 "pipelines": ["*"],  # Connect to all pipelines
             }
         )
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphore = None
+
+        # (vision model, image hash, prompt hash) -> description, and descriptions in progress
+        self.descriptions: "OrderedDict[tuple, str]" = OrderedDict()
+        self.pending = {}
 
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.session is not None:
+            await self.session.close()
+
+    async def on_valves_updated(self):
+        self.semaphore = None
 
     async def process_images_with_llava(self, images: List[str], content: str, vision_model: str, ollama_base_url: str) -> str:
         url = f"{ollama_base_url}/api/chat"
@@ -52,22 +72,58 @@ class Pipeline:
             ]
         }
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as response:
-                if response.status == 200:
-                    content = []
-                    async for line in response.content:
-                        data = json.loads(line)
-                        content.append(data.get("message", {}).get("content", ""))
-                    return "".join(content)
-                else:
-                    print(f"Failed to process images with LLava, status code: {response.status}")
-                    return ""
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession()
 
-    async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"pipe:{__name__}")
+        async with self.session.post(url, json=payload) as response:
+            if response.status == 200:
+                content = []
+                async for line in response.content:
+                    data = json.loads(line)
+                    content.append(data.get("message", {}).get("content", ""))
+                return "".join(content)
+            else:
+                logger.warning("Failed to process images with LLava, status code: %s", response.status)
+                return ""
+
+    async def describe_image(self, image: str, content: str) -> str:
+        key = (
+            self.valves.vision_model,
+            hashlib.sha256(image.encode("utf-8")).hexdigest(),
+            hashlib.sha256(content.encode("utf-8")).hexdigest(),
+        )
+        if key in self.descriptions:
+            self.descriptions.move_to_end(key)
+            return self.descriptions[key]
+
+        # The same image requested by concurrent inlets is only described once
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self._describe_image(key, image, content))
+        return await asyncio.shield(self.pending[key])
 
-        images = []
+    async def _describe_image(self, key: tuple, image: str, content: str) -> str:
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.valves.max_concurrency)
+
+        try:
+            async with self.semaphore:
+                description = await self.process_images_with_llava(
+                    [image], content, self.valves.vision_model, self.valves.ollama_base_url
+                )
+        except Exception as e:
+            logger.warning("Failed to process image: %s", e)
+            description = ""
+        finally:
+            self.pending.pop(key, None)
+
+        if description:
+            self.descriptions[key] = description
+            while len(self.descriptions) > self.valves.cache_size:
+                self.descriptions.popitem(last=False)
+        return description
+
+    async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
+        logger.debug("pipe:%s", __name__)
 
         # Ensure the body is a dictionary
         if isinstance(body, str):
@@ -79,13 +135,22 @@ class Pipeline:
         user_message = get_last_user_message(body["messages"])
 
         if model in self.valves.model_to_override:
-            messages = body.get("messages", [])
-            for message in messages:
-                if "images" in message:
-                    images.extend(message["images"])
-                    raw_llava_response = await self.process_images_with_llava(images, user_message, self.valves.vision_model,self.valves.ollama_base_url)
-                    llava_response = f"REPEAT THIS BACK: {raw_llava_response}"
-                    message["content"] = llava_response
-                    message.pop("images", None)  # This will safely remove the 'images' key if it exists
+            messages = [message for message in body.get("messages", []) if "images" in message]
+
+            # Every image of every message is described concurrently, images already
+            # described on a previous turn come from the cache
+            async def describe_message(message):
+                content = message["content"] if isinstance(message.get("content"), str) and message["content"] else user_message
+                descriptions = await asyncio.gather(
+                    *[self.describe_image(image, content or "") for image in message["images"]]
+                )
+                return "\n".join(description for description in descriptions if description)
+
+            raw_llava_responses = await asyncio.gather(*[describe_message(message) for message in messages])
+
+            for message, raw_llava_response in zip(messages, raw_llava_responses):
+                llava_response = f"REPEAT THIS BACK: {raw_llava_response}"
+                message["content"] = llava_response
+                message.pop("images", None)  # This will safely remove the 'images' key if it exists
         
         return body
@@ -5,6 +5,9 @@ from datetime import datetime
 
 
 from blueprints.function_calling_blueprint import Pipeline as FunctionCallingBlueprint
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
 
 
 class Pipeline(FunctionCallingBlueprint):
@@ -79,7 +82,7 @@ class Pipeline(FunctionCallingBlueprint):
                 result = eval(equation)
                 return f"{equation} = {result}"
             except Exception as e:
-                print(e)
+                logger.warning("Invalid equation %r: %s", equation, e)
                 return "Invalid equation"
 
     def __init__(self):
@@ -98,3 +101,8 @@ class Pipeline(FunctionCallingBlueprint):
             },
         )
         self.tools = self.Tools(self)
+
+        # Arithmetic rarely mentions the tool by name, so trigger it on expressions
+        self.tool_triggers = {
+            "calculator": [r"\d\s*[-+*/^%]\s*\d", r"\bcalculat", r"\bcompute"],
+        }
@@ -9,17 +9,17 @@ without requiring an API key. It supports multilingual communication by translat
 and target languages.
 """
 
-import re
 from typing import List, Optional
 from schemas import OpenAIChatMessage
 from pydantic import BaseModel
-import requests
-import os
-import time
+import aiohttp
 import asyncio
-from functools import lru_cache
 
-from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.main import MessageView
+from utils.pipelines.translation import TranslationMemory, translate_content
+
+logger = get_pipeline_logger(__name__)
 
 class Pipeline:
     class Valves(BaseModel):
@@ -29,6 +29,8 @@ class Pipeline:
         target_user: Optional[str] = "en"
         source_assistant: Optional[str] = "en"
         target_assistant: Optional[str] = "uk"
+        # Maximum number of translation requests in flight per message
+        translation_concurrency: int = 4
 
     def __init__(self):
         self.type = "filter"
@@ -40,22 +42,49 @@ class Pipeline:
         )
 
         # Initialize translation cache
-        self.translation_cache = {}
-        self.code_blocks = []  # List to store code blocks
+        self.translation_memory = TranslationMemory()
+        self.session: Optional[aiohttp.ClientSession] = None
 
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.session is not None:
+            await self.session.close()
+        self.translation_memory.close()
 
     async def on_valves_updated(self):
         pass
 
-    # @lru_cache(maxsize=128)  # LRU cache to store translation results
-    def translate(self, text: str, source: str, target: str) -> str:
+    async def translate(self, text: str, source: str, target: str) -> str:
+        # Code blocks and tables are kept intact, sentences are translated in
+        # concurrent batches and unchanged ones are served from the translation memory
+        return await self.translation_memory.translate_async(
+            text,
+            source,
+            target,
+            self.request_translations,
+            namespace="google",
+            batch_chars=1000,
+            concurrency=self.valves.translation_concurrency,
+        )
+
+    async def request_translations(self, texts: List[str], source: str, target: str) -> List[str]:
+        # Segments never contain newlines, so a batch is sent as one multi-line text
+        if len(texts) > 1:
+            translated = (await self.request_translation("\n".join(texts), source, target)).split("\n")
+            if len(translated) == len(texts):
+                return translated
+
+        return list(
+            await asyncio.gather(
+                *[self.request_translation(text, source, target) for text in texts]
+            )
+        )
+
+    async def request_translation(self, text: str, source: str, target: str) -> str:
         url = "https://translate.googleapis.com/translate_a/single"
         params = {
             "client": "gtx",
@@ -64,122 +93,44 @@ class Pipeline:
             "dt": "t",
             "q": text,
         }
-        
-        try:
-            r = requests.get(url, params=params)
+
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+        async with self.session.get(url, params=params) as r:
             r.raise_for_status()
-            result = r.json()
-            translated_text = ''.join([sentence[0] for sentence in result[0]])
-            return translated_text
-        except requests.exceptions.RequestException as e:
-            print(f"Network error: {e}")
-            time.sleep(1)
-            return self.translate(text, source, target)
-        except Exception as e:
-            print(f"Error translating text: {e}")
-            return text
-
-    def split_text_around_table(self, text: str) -> List[str]:
-        table_regex = r'((?:^.*?\|.*?\n)+)(?=\n[^\|\s].*?\|)'
-        matches = re.split(table_regex, text, flags=re.MULTILINE)
-
-        if len(matches) > 1:
-            return [matches[0], matches[1]]
-        else:
-            return [text, ""]
-
-    def clean_table_delimiters(self, text: str) -> str:
-        # Remove extra spaces from table delimiters
-        return re.sub(r'(\|\s*-+\s*)+', lambda m: m.group(0).replace(' ', '-'), text)
+            result = await r.json(content_type=None)
+        translated_text = ''.join([sentence[0] for sentence in result[0]])
+        return translated_text
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"inlet:{__name__}")
+        logger.debug("inlet:%s", __name__)
 
         messages = body["messages"]
-        user_message = get_last_user_message(messages)
-
-        print(f"User message: {user_message}")
-
-        # Find and store code blocks
-        code_block_regex = r'```[\s\S]+?```'
-        self.code_blocks = re.findall(code_block_regex, user_message)
-        # Replace code blocks with placeholders
-        user_message_no_code = re.sub(code_block_regex, '__CODE_BLOCK__', user_message)
-
-        parts = self.split_text_around_table(user_message_no_code)
-        text_before_table, table_text = parts
-
-        # Check translation cache for text before table
-        translated_before_table = self.translation_cache.get(text_before_table)
-        if translated_before_table is None:
-            translated_before_table = self.translate(
-                text_before_table,
-                self.valves.source_user,
-                self.valves.target_user,
+        last_user_message = MessageView(messages).last("user")
+        if last_user_message is not None:
+            last_user_message["content"] = await translate_content(
+                last_user_message["content"],
+                lambda text: self.translate(
+                    text, self.valves.source_user, self.valves.target_user
+                ),
             )
-            self.translation_cache[text_before_table] = translated_before_table
-
-        translated_user_message = translated_before_table + table_text
-
-        # Clean table delimiters
-        translated_user_message = self.clean_table_delimiters(translated_user_message)
-
-        # Restore code blocks
-        for code_block in self.code_blocks:
-            translated_user_message = translated_user_message.replace('__CODE_BLOCK__', code_block, 1)
-
-        print(f"Translated user message: {translated_user_message}")
-
-        for message in reversed(messages):
-            if message["role"] == "user":
-                message["content"] = translated_user_message
-                break
 
         body = {**body, "messages": messages}
         return body
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"outlet:{__name__}")
+        logger.debug("outlet:%s", __name__)
 
         messages = body["messages"]
-        assistant_message = get_last_assistant_message(messages)
-
-        print(f"Assistant message: {assistant_message}")
-
-        # Find and store code blocks
-        code_block_regex = r'```[\s\S]+?```'
-        self.code_blocks = re.findall(code_block_regex, assistant_message)
-        # Replace code blocks with placeholders
-        assistant_message_no_code = re.sub(code_block_regex, '__CODE_BLOCK__', assistant_message)
-
-        parts = self.split_text_around_table(assistant_message_no_code)
-        text_before_table, table_text = parts
-
-        # Check translation cache for text before table
-        translated_before_table = self.translation_cache.get(text_before_table)
-        if translated_before_table is None:
-            translated_before_table = self.translate(
-                text_before_table,
-                self.valves.source_assistant,
-                self.valves.target_assistant,
+        last_assistant_message = MessageView(messages).last("assistant")
+        if last_assistant_message is not None:
+            last_assistant_message["content"] = await translate_content(
+                last_assistant_message["content"],
+                lambda text: self.translate(
+                    text, self.valves.source_assistant, self.valves.target_assistant
+                ),
             )
-            self.translation_cache[text_before_table] = translated_before_table
-
-        translated_assistant_message = translated_before_table + table_text
-
-        # Clean table delimiters
-        translated_assistant_message = self.clean_table_delimiters(translated_assistant_message)
-
-        # Restore code blocks
-        for code_block in self.code_blocks:
-            translated_assistant_message = translated_assistant_message.replace('__CODE_BLOCK__', code_block, 1)
-
-        print(f"Translated assistant message: {translated_assistant_message}")
-
-        for message in reversed(messages):
-            if message["role"] == "assistant":
-                message["content"] = translated_assistant_message
-                break
 
         body = {**body, "messages": messages}
         return body
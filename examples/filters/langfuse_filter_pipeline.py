@@ -9,14 +9,19 @@ requirements: langfuse
 """
 
 from typing import List, Optional
+from datetime import datetime, timezone
 import os
 import uuid
 
+from utils.pipelines.logger import get_pipeline_logger
 from utils.pipelines.main import get_last_assistant_message
+from utils.pipelines.telemetry import BackgroundExporter, TTLStore
 from pydantic import BaseModel
 from langfuse import Langfuse
 from langfuse.api.resources.commons.errors.unauthorized_error import UnauthorizedError
 
+logger = get_pipeline_logger(__name__)
+
 def get_last_assistant_message_obj(messages: List[dict]) -> dict:
     for message in reversed(messages):
         if message["role"] == "assistant":
@@ -31,6 +36,12 @@ class Pipeline:
         secret_key: str
         public_key: str
         host: str
+        # In-flight generations whose outlet never arrives are dropped after
+        # trace_ttl_seconds, and at most max_traces are kept
+        trace_ttl_seconds: int = 3600
+        max_traces: int = 10000
+        # Maximum number of pending trace submissions before new ones are dropped
+        max_queue_size: int = 10000
 
     def __init__(self):
         self.type = "filter"
@@ -44,17 +55,31 @@ class Pipeline:
             }
         )
         self.langfuse = None
-        self.chat_generations = {}
+        self.chat_generations = TTLStore(
+            max_size=self.valves.max_traces, ttl=self.valves.trace_ttl_seconds
+        )
+        self.exporter = None
 
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         self.set_langfuse()
+        self.exporter = BackgroundExporter(
+            f"langfuse:{__name__}", max_queue_size=self.valves.max_queue_size
+        )
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
+        if self.exporter is not None:
+            self.exporter.close()
+            logger.info("Langfuse exporter: %s", self.exporter.metrics)
+        logger.info("Langfuse in-flight traces: %s", self.chat_generations.metrics)
         self.langfuse.flush()
 
     async def on_valves_updated(self):
+        self.chat_generations.max_size = self.valves.max_traces
+        self.chat_generations.ttl = self.valves.trace_ttl_seconds
+        if self.exporter is not None:
+            self.exporter.resize(self.valves.max_queue_size)
         self.set_langfuse()
 
     def set_langfuse(self):
@@ -67,58 +92,77 @@ class Pipeline:
             )
             self.langfuse.auth_check()
         except UnauthorizedError:
-            print(
+            logger.error(
                 "Langfuse credentials incorrect. Please re-enter your Langfuse credentials in the pipeline settings."
             )
         except Exception as e:
-            print(f"Langfuse error: {e} Please re-enter your Langfuse credentials in the pipeline settings.")
+            logger.error("Langfuse error: %s Please re-enter your Langfuse credentials in the pipeline settings.", e)
+
+    def start_generation(self, state: dict, body: dict, user: dict, start_time: datetime):
+        # Runs on the exporter thread
+        trace = self.langfuse.trace(
+            id=state["trace_id"],
+            name=f"filter:{__name__}",
+            input=body,
+            user_id=user.get("email"),
+            metadata={"user_name": user.get("name"), "user_id": user.get("id")},
+            session_id=body["chat_id"],
+        )
+
+        state["generation"] = trace.generation(
+            name=body["chat_id"],
+            model=body["model"],
+            input=body["messages"],
+            metadata={"interface": "open-webui"},
+            start_time=start_time,
+        )
+
+    def end_generation(self, state: dict, output: Optional[str], usage: Optional[dict], end_time: datetime):
+        # Runs on the exporter thread, after start_generation for the same state
+        if state.get("generation") is None:
+            return
+
+        state["generation"].end(
+            output=output,
+            metadata={"interface": "open-webui"},
+            usage=usage,
+            end_time=end_time,
+        )
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"inlet:{__name__}")
-        print(f"Received body: {body}")
-        print(f"User: {user}")
+        logger.debug("inlet:%s", __name__)
 
         # Check for presence of required keys and generate chat_id if missing
         if "chat_id" not in body:
             unique_id = f"SYSTEM MESSAGE {uuid.uuid4()}"
             body["chat_id"] = unique_id
-            print(f"chat_id was missing, set to: {unique_id}")
+            logger.debug("chat_id was missing, set to: %s", unique_id)
 
         required_keys = ["model", "messages"]
         missing_keys = [key for key in required_keys if key not in body]
         
         if missing_keys:
             error_message = f"Error: Missing keys in the request body: {', '.join(missing_keys)}"
-            print(error_message)
+            logger.warning("%s", error_message)
             raise ValueError(error_message)
 
-        trace = self.langfuse.trace(
-            name=f"filter:{__name__}",
-            input=body,
-            user_id=user["email"],
-            metadata={"user_name": user["name"], "user_id": user["id"]},
-            session_id=body["chat_id"],
-        )
+        # Later filters may edit the messages in place, so the exporter gets a snapshot
+        snapshot = {**body, "messages": [dict(message) for message in body["messages"]]}
+        state = {"trace_id": str(uuid.uuid4()), "generation": None}
 
-        generation = trace.generation(
-            name=body["chat_id"],
-            model=body["model"],
-            input=body["messages"],
-            metadata={"interface": "open-webui"},
+        self.chat_generations.set(body["chat_id"], state)
+        self.exporter.submit(
+            self.start_generation, state, snapshot, user or {}, datetime.now(timezone.utc)
         )
 
-        self.chat_generations[body["chat_id"]] = generation
-        print(trace.get_trace_url())
-
         return body
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"outlet:{__name__}")
-        print(f"Received body: {body}")
-        if body["chat_id"] not in self.chat_generations:
+        logger.debug("outlet:%s", __name__)
+        state = self.chat_generations.pop(body.get("chat_id"))
+        if state is None:
             return body
 
-        generation = self.chat_generations[body["chat_id"]]
         assistant_message = get_last_assistant_message(body["messages"])
 
         
@@ -138,13 +182,8 @@ class Pipeline:
                     }
 
         # Update generation
-        generation.end(
-            output=assistant_message,
-            metadata={"interface": "open-webui"},
-            usage=usage,
+        self.exporter.submit(
+            self.end_generation, state, assistant_message, usage, datetime.now(timezone.utc)
         )
 
-        # Clean up the chat_generations dictionary
-        del self.chat_generations[body["chat_id"]]
-
         return body
@@ -1,10 +1,14 @@
 from typing import List, Optional
 from schemas import OpenAIChatMessage
 from pydantic import BaseModel
-import requests
+import aiohttp
 import os
 
-from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.main import MessageView
+from utils.pipelines.translation import TranslationMemory, translate_content
+
+logger = get_pipeline_logger(__name__)
 
 
 class Pipeline:
@@ -33,6 +37,9 @@ class Pipeline:
         source_assistant: Optional[str] = "en"
         target_assistant: Optional[str] = "es"
 
+        # Maximum number of translation requests in flight per message
+        translation_concurrency: int = 4
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -55,87 +62,85 @@ class Pipeline:
             }
         )
 
-        pass
+        # Initialize translation cache
+        self.translation_memory = TranslationMemory()
+        self.session: Optional[aiohttp.ClientSession] = None
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.session is not None:
+            await self.session.close()
+        self.translation_memory.close()
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
         pass
 
-    def translate(self, text: str, source: str, target: str) -> str:
+    async def translate(self, text: str, source: str, target: str) -> str:
+        # Code blocks and tables are kept intact, sentences are translated in
+        # concurrent batches and unchanged ones are served from the translation memory
+        return await self.translation_memory.translate_async(
+            text,
+            source,
+            target,
+            self.request_translations,
+            namespace=f"libretranslate:{self.valves.libretranslate_url}",
+            concurrency=self.valves.translation_concurrency,
+        )
+
+    async def request_translations(self, texts: List[str], source: str, target: str) -> List[str]:
+        # LibreTranslate accepts a list of texts and returns a list of translations
         payload = {
-            "q": text,
+            "q": texts,
             "source": source,
             "target": target,
         }
 
-        try:
-            r = requests.post(
-                f"{self.valves.libretranslate_url}/translate", json=payload
-            )
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+
+        async with self.session.post(
+            f"{self.valves.libretranslate_url}/translate", json=payload
+        ) as r:
             r.raise_for_status()
+            data = await r.json(content_type=None)
 
-            data = r.json()
-            return data["translatedText"]
-        except Exception as e:
-            print(f"Error translating text: {e}")
-            return text
+        return data["translatedText"]
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"inlet:{__name__}")
+        logger.debug("inlet:%s", __name__)
 
         messages = body["messages"]
-        user_message = get_last_user_message(messages)
-
-        print(f"User message: {user_message}")
-
-        # Translate user message
-        translated_user_message = self.translate(
-            user_message,
-            self.valves.source_user,
-            self.valves.target_user,
-        )
-
-        print(f"Translated user message: {translated_user_message}")
-
-        for message in reversed(messages):
-            if message["role"] == "user":
-                message["content"] = translated_user_message
-                break
+        last_user_message = MessageView(messages).last("user")
+        if last_user_message is not None:
+            last_user_message["content"] = await translate_content(
+                last_user_message["content"],
+                lambda text: self.translate(
+                    text, self.valves.source_user, self.valves.target_user
+                ),
+            )
 
         body = {**body, "messages": messages}
         return body
 
     async def outlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"outlet:{__name__}")
+        logger.debug("outlet:%s", __name__)
 
         messages = body["messages"]
-        assistant_message = get_last_assistant_message(messages)
-
-        print(f"Assistant message: {assistant_message}")
-
-        # Translate assistant message
-        translated_assistant_message = self.translate(
-            assistant_message,
-            self.valves.source_assistant,
-            self.valves.target_assistant,
-        )
-
-        print(f"Translated assistant message: {translated_assistant_message}")
-
-        for message in reversed(messages):
-            if message["role"] == "assistant":
-                message["content"] = translated_assistant_message
-                break
+        last_assistant_message = MessageView(messages).last("assistant")
+        if last_assistant_message is not None:
+            last_assistant_message["content"] = await translate_content(
+                last_assistant_message["content"],
+                lambda text: self.translate(
+                    text, self.valves.source_assistant, self.valves.target_assistant
+                ),
+            )
 
         body = {**body, "messages": messages}
         return body
@@ -1,10 +1,16 @@
 from typing import List, Optional
 from schemas import OpenAIChatMessage
 from pydantic import BaseModel
-import requests
+import aiohttp
+import asyncio
+import json
 import os
 
-from utils.pipelines.main import get_last_user_message, get_last_assistant_message
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.main import MessageView
+from utils.pipelines.translation import TranslationMemory, translate_content
+
+logger = get_pipeline_logger(__name__)
 
 
 class Pipeline:
@@ -33,6 +39,9 @@ class Pipeline:
         source_assistant: Optional[str] = "en"
         target_assistant: Optional[str] = "es"
 
+        # Maximum number of translation requests in flight per message
+        translation_concurrency: int = 4
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -55,23 +64,67 @@ class Pipeline:
             }
         )
 
-        pass
+        # Initialize translation cache
+        self.translation_memory = TranslationMemory()
+        self.session: Optional[aiohttp.ClientSession] = None
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.session is not None:
+            await self.session.close()
+        self.translation_memory.close()
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
         pass
 
-    def translate(self, text: str, source: str, target: str) -> str:
+    async def translate(self, text: str, source: str, target: str) -> str:
+        # Code blocks and tables are kept intact, sentences are translated in
+        # concurrent batches and unchanged ones are served from the translation memory
+        return await self.translation_memory.translate_async(
+            text,
+            source,
+            target,
+            self.request_translations,
+            namespace=f"llm:{self.valves.TASK_MODEL}",
+            concurrency=self.valves.translation_concurrency,
+        )
+
+    async def request_translations(self, texts: List[str], source: str, target: str) -> List[str]:
+        # A batch is sent as a JSON array, falling back to one request per text
+        # if the model does not return an array of the same length
+        if len(texts) > 1:
+            try:
+                translated = json.loads(
+                    await self.request_completion(
+                        f"Translate each string of the following JSON array to {target}. Provide only a JSON array of the translated strings, in the same order, and nothing else.",
+                        json.dumps(texts, ensure_ascii=False),
+                    )
+                )
+                if isinstance(translated, list) and len(translated) == len(texts):
+                    return [str(text) for text in translated]
+            except json.JSONDecodeError:
+                pass
+
+        return list(
+            await asyncio.gather(
+                *[
+                    self.request_completion(
+                        f"Translate the following text to {target}. Provide only the translated text and nothing else.",
+                        text,
+                    )
+                    for text in texts
+                ]
+            )
+        )
+
+    async def request_completion(self, system_prompt: str, content: str) -> str:
         headers = {}
         headers["Authorization"] = f"Bearer {self.valves.OPENAI_API_KEY}"
         headers["Content-Type"] = "application/json"
@@ -80,50 +133,38 @@ class Pipeline:
             "messages": [
                 {
                     "role": "system",
-                    "content": f"Translate the following text to {target}. Provide only the translated text and nothing else.",
+                    "content": system_prompt,
                 },
-                {"role": "user", "content": text},
+                {"role": "user", "content": content},
             ],
             "model": self.valves.TASK_MODEL,
         }
-        print(payload)
-
-        try:
-            r = requests.post(
-                url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
-                json=payload,
-                headers=headers,
-                stream=False,
-            )
 
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60))
+
+        async with self.session.post(
+            url=f"{self.valves.OPENAI_API_BASE_URL}/chat/completions",
+            json=payload,
+            headers=headers,
+        ) as r:
             r.raise_for_status()
-            response = r.json()
-            print(response)
-            return response["choices"][0]["message"]["content"]
-        except Exception as e:
-            return f"Error: {e}"
+            response = await r.json(content_type=None)
+
+        return response["choices"][0]["message"]["content"]
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"inlet:{__name__}")
+        logger.debug("inlet:%s", __name__)
 
         messages = body["messages"]
-        user_message = get_last_user_message(messages)
-
-        print(f"User message: {user_message}")
-
-        # Translate user message
-        translated_user_message = self.translate(
-            user_message,
-            self.valves.source_user,
-            self.valves.target_user,
-        )
-
-        print(f"Translated user message: {translated_user_message}")
-
-        for message in reversed(messages):
-            if message["role"] == "user":
-                message["content"] = translated_user_message
-                break
+        last_user_message = MessageView(messages).last("user")
+        if last_user_message is not None:
+            last_user_message["content"] = await translate_content(
+                last_user_message["content"],
+                lambda text: self.translate(
+                    text, self.valves.source_user, self.valves.target_user
+                ),
+            )
 
         body = {**body, "messages": messages}
         return body
@@ -132,26 +173,17 @@ class Pipeline:
         if "title" in body:
             return body
 
-        print(f"outlet:{__name__}")
+        logger.debug("outlet:%s", __name__)
 
         messages = body["messages"]
-        assistant_message = get_last_assistant_message(messages)
-
-        print(f"Assistant message: {assistant_message}")
-
-        # Translate assistant message
-        translated_assistant_message = self.translate(
-            assistant_message,
-            self.valves.source_assistant,
-            self.valves.target_assistant,
-        )
-
-        print(f"Translated assistant message: {translated_assistant_message}")
-
-        for message in reversed(messages):
-            if message["role"] == "assistant":
-                message["content"] = translated_assistant_message
-                break
+        last_assistant_message = MessageView(messages).last("assistant")
+        if last_assistant_message is not None:
+            last_assistant_message["content"] = await translate_content(
+                last_assistant_message["content"],
+                lambda text: self.translate(
+                    text, self.valves.source_assistant, self.valves.target_assistant
+                ),
+            )
 
         body = {**body, "messages": messages}
         return body
@@ -15,6 +15,11 @@ from llm_guard.input_scanners import PromptInjection
 from llm_guard.input_scanners.prompt_injection import MatchType
 import os
 
+from utils.pipelines.batching import MicroBatcher
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
+
 class Pipeline:
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
@@ -39,6 +44,12 @@ class Pipeline:
             # The lower the number, the higher the priority.
             priority: int = 0
 
+            # Concurrent inlets are grouped into batches of up to max_batch_size
+            # messages, waiting at most max_wait_ms for the batch to fill up
+            max_batch_size: int = 16
+            max_wait_ms: float = 10
+            cache_size: int = 1024
+
         # Initialize
         self.valves = Valves(
             **{
@@ -47,33 +58,56 @@ class Pipeline:
         )
 
         self.model = None
+        self.batcher = None
 
         pass
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
 
         self.model = PromptInjection(threshold=0.8, match_type=MatchType.FULL)
+        self.update_batcher()
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.batcher is not None:
+            await self.batcher.close()
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
-        pass
+        # The batcher is reconfigured in place, so that requests already queued
+        # are still answered and the model keeps running on a single thread
+        if self.batcher is not None:
+            self.batcher.configure(
+                max_batch_size=self.valves.max_batch_size,
+                max_wait_ms=self.valves.max_wait_ms,
+                cache_size=self.valves.cache_size,
+            )
+
+    def update_batcher(self):
+        self.batcher = MicroBatcher(
+            self.predict_batch,
+            max_batch_size=self.valves.max_batch_size,
+            max_wait_ms=self.valves.max_wait_ms,
+            cache_size=self.valves.cache_size,
+        )
+
+    def predict_batch(self, texts: List[str]) -> List[tuple]:
+        # The scanner has no batch API, but batching still runs the scans off the
+        # event loop and de-duplicates identical prompts
+        return [self.model.scan(text) for text in texts]
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # This filter is applied to the form data before it is sent to the OpenAI API.
-        print(f"inlet:{__name__}")
+        logger.debug("inlet:%s", __name__)
 
         user_message = body["messages"][-1]["content"]
 
         # Filter out prompt injection messages
-        sanitized_prompt, is_valid, risk_score = self.model.scan(user_message)
+        sanitized_prompt, is_valid, risk_score = await self.batcher.predict(user_message)
 
         if risk_score > 0.8: 
             raise Exception("Prompt injection detected")
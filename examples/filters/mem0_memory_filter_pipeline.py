@@ -8,12 +8,19 @@ description: A filter that processes user messages and stores them as long term
 requirements: pydantic, ollama, mem0ai
 """
 
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel
+from collections import OrderedDict
+import asyncio
 import json
+import queue
 from mem0 import Memory
 import threading
 
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
+
 class Pipeline:
     class Valves(BaseModel):
         pipelines: List[str] = []
@@ -21,6 +28,14 @@ class Pipeline:
 
         store_cycles: int = 5 # Number of messages from the user before the data is processed and added to the memory
         mem_zero_user: str = "user" # Memories belongs to this user, only used by mem0 for internal organization of memories
+        memory_per_user: bool = False # Keep separate memories for each Open WebUI user instead of mem_zero_user
+
+        # Memory search must answer within this budget, or the request goes on without memories
+        search_timeout_ms: int = 500
+        search_cache_size: int = 1024 # Number of recent searches cached, across all users
+
+        # Maximum number of message batches waiting to be added to the memory
+        ingest_queue_size: int = 1000
 
         # Default values for the mem0 vector store
         vector_store_qdrant_name: str = "memories"
@@ -41,8 +56,14 @@ class Pipeline:
     def __init__(self):
         self.type = "filter"
         self.name = "Memory Filter"
-        self.user_messages = []
-        self.thread = None
+        # user -> messages waiting for the next store cycle
+        self.user_messages: Dict[str, List[str]] = {}
+        # (user, query) -> recent search results, least recently used first, and
+        # invalidated when new memories are added for the user
+        self.search_cache: "OrderedDict[Tuple[str, str], list]" = OrderedDict()
+        self.search_cache_lock = threading.Lock()
+        # (user, query) -> search in progress, shared by the requests that need it
+        self.searches: Dict[Tuple[str, str], asyncio.Future] = {}
         self.valves = self.Valves(
             **{
                 "pipelines": ["*"],  # Connect to all pipelines
@@ -50,19 +71,109 @@ class Pipeline:
         )
         self.m = self.init_mem_zero()
 
+        # A single worker thread adds buffered messages to the memory
+        self.ingest_queue: queue.Queue = queue.Queue(maxsize=self.valves.ingest_queue_size)
+        self.thread = None
+
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
-        pass
+        logger.info("on_startup:%s", __name__)
+        self.thread = threading.Thread(target=self.ingest_worker, name=f"mem0:{__name__}", daemon=True)
+        self.thread.start()
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.thread and self.thread.is_alive():
+            # Let the worker finish the batches already queued
+            self.ingest_queue.put(None)
+            self.thread.join(timeout=30)
+
+    def ingest_worker(self):
+        while True:
+            batch = [self.ingest_queue.get()]
+            while True:
+                try:
+                    batch.append(self.ingest_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Batches queued for the same user are added in a single call
+            texts_by_user: Dict[str, List[str]] = {}
+            for item in batch:
+                if item is not None:
+                    texts_by_user.setdefault(item[0], []).append(item[1])
+
+            for user, texts in texts_by_user.items():
+                try:
+                    self.m.add(data=" ".join(texts), user_id=user)
+                except Exception as e:
+                    logger.warning("Error adding memory: %s", e)
+                self.forget_searches(user)
+
+            if None in batch:
+                return
+
+    def store_message(self, user: str, message: str):
+        messages = self.user_messages.setdefault(user, [])
+
+        # Repeated messages are only stored once per cycle
+        if message in messages:
+            return
+        messages.append(message)
+
+        if len(messages) >= self.valves.store_cycles:
+            message_text = " ".join(messages)
+            messages.clear()
+            try:
+                self.ingest_queue.put_nowait((user, message_text))
+            except queue.Full:
+                logger.warning("Memory ingestion queue is full, dropping messages")
+
+    def forget_searches(self, user: str):
+        with self.search_cache_lock:
+            for key in [key for key in self.search_cache if key[0] == user]:
+                del self.search_cache[key]
+
+    async def search_memories(self, user: str, query: str) -> list:
+        key = (user, query)
+        with self.search_cache_lock:
+            if key in self.search_cache:
+                self.search_cache.move_to_end(key)
+                return self.search_cache[key]
+
+        def remember(future):
+            self.searches.pop(key, None)
+            if not future.cancelled() and future.exception() is None:
+                with self.search_cache_lock:
+                    self.search_cache[key] = future.result()
+                    while len(self.search_cache) > self.valves.search_cache_size:
+                        self.search_cache.popitem(last=False)
+
+        # A search that missed the budget of an earlier request is still running:
+        # wait for it rather than starting another one
+        future = self.searches.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, lambda: self.m.search(query, user_id=user))
+            # A search that misses the budget still completes and fills the cache
+            future.add_done_callback(remember)
+            self.searches[key] = future
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(future), timeout=self.valves.search_timeout_ms / 1000
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Memory search exceeded its latency budget, continuing without memories")
+        except Exception as e:
+            logger.warning("Error searching memories: %s", e)
+        return []
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"pipe:{__name__}")
+        logger.debug("pipe:%s", __name__)
 
-        user = self.valves.mem_zero_user
-        store_cycles = self.valves.store_cycles
+        if self.valves.memory_per_user and user and user.get("id"):
+            user = user["id"]
+        else:
+            user = self.valves.mem_zero_user
 
         if isinstance(body, str):
             body = json.loads(body)
@@ -70,42 +181,18 @@ class Pipeline:
         all_messages = body["messages"]
         last_message = all_messages[-1]["content"]
 
-        self.user_messages.append(last_message)
+        self.store_message(user, last_message)
 
-        if len(self.user_messages) == store_cycles:
-
-            message_text = ""
-            for message in self.user_messages:
-                message_text += message + " "
-
-            if self.thread and self.thread.is_alive():
-                print("Waiting for previous memory to be done")
-                self.thread.join()
-
-            self.thread = threading.Thread(target=self.m.add, kwargs={"data":message_text,"user_id":user})
-
-            print("Text to be processed in to a memory:")
-            print(message_text)
-
-            self.thread.start()
-            self.user_messages.clear()
-
-        memories = self.m.search(last_message, user_id=user)
+        memories = await self.search_memories(user, last_message)
 
         if(memories):
             fetched_memory = memories[0]["memory"]
         else:
             fetched_memory = ""
 
-        print("Memory added to the context:")
-        print(fetched_memory)
-
         if fetched_memory:
             all_messages.insert(0, {"role":"system", "content":"This is your inner voice talking, you remember this about the person you chatting with "+str(fetched_memory)})
 
-        print("Final body to send to the LLM:")
-        print(body)
-
         return body
 
     def init_mem_zero(self):
@@ -9,12 +9,18 @@ requirements: presidio-analyzer, presidio-anonymizer
 """
 
 import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Optional
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
-from presidio_analyzer import AnalyzerEngine
-from presidio_anonymizer import AnonymizerEngine
-from presidio_anonymizer.entities import OperatorConfig
+
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.pii import get_engines, redact_text, redact_texts
+
+logger = get_pipeline_logger(__name__)
 
 class Pipeline:
     class Valves(BaseModel):
@@ -27,6 +33,10 @@ class Pipeline:
             "DATE_TIME", "NRP", "MEDICAL_LICENSE", "URL"
         ]
         language: str = "en"
+        # Number of worker processes used to analyze new messages, 0 to use a thread
+        worker_processes: int = 0
+        # Number of redacted messages remembered between turns
+        cache_size: int = 4096
 
     def __init__(self):
         self.type = "filter"
@@ -38,44 +48,106 @@ class Pipeline:
                 "enabled_for_admins": os.getenv("PII_REDACT_ENABLED_FOR_ADMINS", "false").lower() == "true",
                 "entities_to_redact": os.getenv("PII_REDACT_ENTITIES", ",".join(self.Valves().entities_to_redact)).split(","),
                 "language": os.getenv("PII_REDACT_LANGUAGE", "en"),
+                "worker_processes": int(os.getenv("PII_REDACT_WORKER_PROCESSES", 0)),
             }
         )
 
-        self.analyzer = AnalyzerEngine()
-        self.anonymizer = AnonymizerEngine()
+        self.analyzer, self.anonymizer = get_engines()
+
+        # Fingerprint of a message content -> redacted content. Redacted outputs are
+        # also stored as their own fingerprint, so already redacted history is skipped.
+        self.redactions: "OrderedDict[str, str]" = OrderedDict()
+        self.executor: Optional[ProcessPoolExecutor] = None
 
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
+        self.update_executor()
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def on_valves_updated(self):
+        # Cached redactions depend on the language and entities
+        self.redactions.clear()
+        self.update_executor()
+
+    def update_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.valves.worker_processes > 0:
+            self.executor = ProcessPoolExecutor(max_workers=self.valves.worker_processes)
 
     def redact_pii(self, text: str) -> str:
-        results = self.analyzer.analyze(
-            text=text,
-            language=self.valves.language,
-            entities=self.valves.entities_to_redact
-        )
+        return redact_text(text, self.valves.language, self.valves.entities_to_redact)
 
-        anonymized_text = self.anonymizer.anonymize(
-            text=text,
-            analyzer_results=results,
-            operators={
-                "DEFAULT": OperatorConfig("replace", {"new_value": "[REDACTED]"})
-            }
-        )
+    def fingerprint(self, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
 
-        return anonymized_text.text
+    def remember(self, text: str, redacted: str):
+        for key in (self.fingerprint(text), self.fingerprint(redacted)):
+            self.redactions[key] = redacted
+            self.redactions.move_to_end(key)
+        while len(self.redactions) > self.valves.cache_size:
+            self.redactions.popitem(last=False)
+
+    async def redact_many(self, texts: List[str]) -> List[str]:
+        """Redact texts off the event loop, spread across the worker processes if any."""
+        loop = asyncio.get_running_loop()
+        args = (self.valves.language, self.valves.entities_to_redact)
+
+        if self.executor is None:
+            return await loop.run_in_executor(None, redact_texts, texts, *args)
+
+        chunk_size = -(-len(texts) // self.valves.worker_processes)
+        chunks = await asyncio.gather(
+            *[
+                loop.run_in_executor(self.executor, redact_texts, texts[i : i + chunk_size], *args)
+                for i in range(0, len(texts), chunk_size)
+            ]
+        )
+        return [text for chunk in chunks for text in chunk]
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"pipe:{__name__}")
-        print(body)
-        print(user)
+        logger.debug("pipe:%s", __name__)
+        logger.debug("chat:%s user:%s", body.get("chat_id"), (user or {}).get("id"))
 
         if user is None or user.get("role") != "admin" or self.valves.enabled_for_admins:
             messages = body.get("messages", [])
+
+            # Collect the text of every user message, as (container, key) to write back to
+            targets = []
             for message in messages:
-                if message.get("role") == "user":
-                    message["content"] = self.redact_pii(message["content"])
+                if message.get("role") != "user":
+                    continue
+                if isinstance(message.get("content"), str):
+                    targets.append((message, "content"))
+                elif isinstance(message.get("content"), list):
+                    targets.extend(
+                        (item, "text")
+                        for item in message["content"]
+                        if item.get("type") == "text"
+                    )
+
+            # Only analyze messages that were not redacted in a previous turn
+            pending = OrderedDict()
+            for container, key in targets:
+                text = container[key]
+                fingerprint = self.fingerprint(text)
+                if fingerprint in self.redactions:
+                    self.redactions.move_to_end(fingerprint)
+                    container[key] = self.redactions[fingerprint]
+                else:
+                    pending.setdefault(text, []).append((container, key))
+
+            if pending:
+                texts = list(pending.keys())
+                for text, redacted in zip(texts, await self.redact_many(texts)):
+                    self.remember(text, redacted)
+                    for container, key in pending[text]:
+                        container[key] = redacted
 
         return body
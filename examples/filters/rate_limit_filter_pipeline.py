@@ -1,9 +1,149 @@
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
+from collections import OrderedDict
+import asyncio
+import sqlite3
+import threading
 import time
 
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
+
+
+# A window counter is (window_start, count, previous_window_count)
+WindowState = List[float]
+
+
+def roll_window(state: WindowState, window: int, now: float) -> WindowState:
+    """Advance a fixed window counter to the window containing `now`."""
+    window_start = now - now % window
+    if state[0] != window_start:
+        elapsed_windows = (window_start - state[0]) / window
+        state[2] = state[1] if elapsed_windows == 1 else 0
+        state[1] = 0
+        state[0] = window_start
+    return state
+
+
+def estimate_window(state: WindowState, window: int, now: float) -> float:
+    """Estimate the number of requests in the sliding window ending at `now`."""
+    weight = (window - (now - state[0])) / window
+    return state[2] * weight + state[1]
+
+
+class MemoryRateLimitBackend:
+    """Per-process sliding-window counters with LRU eviction of idle users."""
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self.users: "OrderedDict[str, Dict[int, WindowState]]" = OrderedDict()
+
+    def hit(self, user_id: str, limits: List[Tuple[int, int]], now: float) -> bool:
+        """Record a request unless it exceeds a limit. Returns True if rate limited."""
+        windows = self.users.get(user_id)
+        if windows is None:
+            windows = {}
+            self.users[user_id] = windows
+            if len(self.users) > self.max_users:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(user_id)
+
+        states = []
+        for window, limit in limits:
+            state = roll_window(windows.setdefault(window, [0, 0, 0]), window, now)
+            if estimate_window(state, window, now) >= limit:
+                return True
+            states.append(state)
+
+        for state in states:
+            state[1] += 1
+        return False
+
+    def close(self):
+        self.users.clear()
+
+
+class SQLiteRateLimitBackend:
+    """
+    Sliding-window counters stored in a SQLite file, so every server worker
+    pointing at the same file shares the same limits.
+    """
+
+    def __init__(self, path: str, idle_seconds: int = 3600):
+        self.path = path
+        # Minimum idle time before a counter is dropped
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        # hit() runs in threads, and the connection holds one transaction at a time
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=5, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS rate_limits (
+                user_id TEXT NOT NULL,
+                window INTEGER NOT NULL,
+                window_start REAL NOT NULL,
+                count INTEGER NOT NULL,
+                previous_count INTEGER NOT NULL,
+                PRIMARY KEY (user_id, window)
+            )"""
+        )
+
+    def hit(self, user_id: str, limits: List[Tuple[int, int]], now: float) -> bool:
+        """Record a request unless it exceeds a limit. Returns True if rate limited."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                limited = self._hit(user_id, limits, now)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return limited
+
+    def _hit(self, user_id: str, limits: List[Tuple[int, int]], now: float) -> bool:
+        rows = self.conn.execute(
+            "SELECT window, window_start, count, previous_count FROM rate_limits WHERE user_id = ?",
+            (user_id,),
+        ).fetchall()
+        windows = {row[0]: list(row[1:]) for row in rows}
+
+        states = []
+        for window, limit in limits:
+            state = roll_window(windows.get(window, [0, 0, 0]), window, now)
+            if estimate_window(state, window, now) >= limit:
+                return True
+            states.append((window, state))
+
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?)",
+            [
+                (user_id, window, state[0], state[1] + 1, state[2])
+                for window, state in states
+            ],
+        )
+
+        # Periodically drop users that have been idle for longer than any window.
+        # The horizon follows the current limits, which valves updates may widen
+        self.hits += 1
+        if self.hits % 1000 == 0:
+            idle_seconds = max([self.idle_seconds] + [window * 2 for window, _ in limits])
+            self.conn.execute(
+                "DELETE FROM rate_limits WHERE window_start < ?",
+                (now - idle_seconds,),
+            )
+        return False
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -22,6 +162,12 @@ class Pipeline:
         sliding_window_limit: Optional[int] = None
         sliding_window_minutes: Optional[int] = None
 
+        # Maximum number of users tracked in memory before the least recently seen are evicted
+        max_tracked_users: int = 10000
+
+        # Optional SQLite file shared by all server workers, e.g. "./rate_limits.db"
+        storage_path: Optional[str] = None
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -50,78 +196,82 @@ class Pipeline:
                 "sliding_window_minutes": int(
                     os.getenv("RATE_LIMIT_SLIDING_WINDOW_MINUTES", 15)
                 ),
+                "storage_path": os.getenv("RATE_LIMIT_STORAGE_PATH", None),
             }
         )
 
-        # Tracking data - user_id -> (timestamps of requests)
-        self.user_requests = {}
+        # Tracking data - user_id -> sliding-window counters
+        self.backend = None
+        self.update_backend()
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        self.backend.close()
 
-    def prune_requests(self, user_id: str):
-        """Prune old requests that are outside of the sliding window period."""
-        now = time.time()
-        if user_id in self.user_requests:
-            self.user_requests[user_id] = [
-                req
-                for req in self.user_requests[user_id]
-                if (
-                    (self.valves.requests_per_minute is not None and now - req < 60)
-                    or (self.valves.requests_per_hour is not None and now - req < 3600)
-                    or (
-                        self.valves.sliding_window_limit is not None
-                        and now - req < self.valves.sliding_window_minutes * 60
-                    )
-                )
-            ]
-
-    def log_request(self, user_id: str):
-        """Log a new request for a user."""
-        now = time.time()
-        if user_id not in self.user_requests:
-            self.user_requests[user_id] = []
-        self.user_requests[user_id].append(now)
-
-    def rate_limited(self, user_id: str) -> bool:
-        """Check if a user is rate limited."""
-        self.prune_requests(user_id)
-
-        user_reqs = self.user_requests.get(user_id, [])
+    async def on_valves_updated(self):
+        # This function is called when the valves are updated.
+        self.update_backend()
 
-        if self.valves.requests_per_minute is not None:
-            requests_last_minute = sum(1 for req in user_reqs if time.time() - req < 60)
-            if requests_last_minute >= self.valves.requests_per_minute:
-                return True
+    def update_backend(self):
+        """(Re)create the counter backend if the storage valves changed."""
+        if self.valves.storage_path:
+            if (
+                isinstance(self.backend, SQLiteRateLimitBackend)
+                and self.backend.path == self.valves.storage_path
+            ):
+                return
+            if self.backend is not None:
+                self.backend.close()
+            self.backend = SQLiteRateLimitBackend(self.valves.storage_path)
+        elif isinstance(self.backend, MemoryRateLimitBackend):
+            self.backend.max_users = self.valves.max_tracked_users
+        else:
+            if self.backend is not None:
+                self.backend.close()
+            self.backend = MemoryRateLimitBackend(self.valves.max_tracked_users)
 
-        if self.valves.requests_per_hour is not None:
-            requests_last_hour = sum(1 for req in user_reqs if time.time() - req < 3600)
-            if requests_last_hour >= self.valves.requests_per_hour:
-                return True
+    def get_limits(self) -> List[Tuple[int, int]]:
+        """
+        Return the configured (window in seconds, limit) pairs. Counters are kept
+        per window, so limits sharing a window are merged into the strictest one.
+        """
+        limits: Dict[int, int] = {}
 
-        if self.valves.sliding_window_limit is not None:
-            requests_in_window = len(user_reqs)
-            if requests_in_window >= self.valves.sliding_window_limit:
-                return True
+        def add(window: int, limit: int):
+            limits[window] = min(limit, limits.get(window, limit))
 
-        return False
+        if self.valves.requests_per_minute is not None:
+            add(60, self.valves.requests_per_minute)
+        if self.valves.requests_per_hour is not None:
+            add(3600, self.valves.requests_per_hour)
+        if (
+            self.valves.sliding_window_limit is not None
+            and self.valves.sliding_window_minutes
+        ):
+            add(self.valves.sliding_window_minutes * 60, self.valves.sliding_window_limit)
+        return list(limits.items())
+
+    async def rate_limited(self, user_id: str) -> bool:
+        """Check if a user is rate limited, and log the request if not."""
+        if isinstance(self.backend, SQLiteRateLimitBackend):
+            # Waiting for the lock of the shared file must not block the event loop
+            return await asyncio.to_thread(
+                self.backend.hit, user_id, self.get_limits(), time.time()
+            )
+        return self.backend.hit(user_id, self.get_limits(), time.time())
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
-        print(f"pipe:{__name__}")
-        print(body)
-        print(user)
+        logger.debug("pipe:%s", __name__)
 
-        if user.get("role", "admin") == "user":
-            user_id = user["id"] if user and "id" in user else "default_user"
-            if self.rate_limited(user_id):
+        if user and user.get("role", "admin") == "user":
+            user_id = user.get("id", "default_user")
+            if await self.rate_limited(user_id):
                 raise Exception("Rate limit exceeded. Please try again later.")
 
-            self.log_request(user_id)
         return body
@@ -16,7 +16,10 @@ from typing import List, Union, Generator, Iterator
 from pydantic import BaseModel
 import sseclient
 
-from utils.pipelines.main import pop_system_message
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.main import MessageView
+
+logger = get_pipeline_logger(__name__)
 
 
 class Pipeline:
@@ -51,11 +54,11 @@ class Pipeline:
         ]
 
     async def on_startup(self):
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
         pass
 
     async def on_valves_updated(self):
@@ -90,22 +93,22 @@ class Pipeline:
             for key in ['user', 'chat_id', 'title']:
                 body.pop(key, None)
 
-            system_message, messages = pop_system_message(messages)
+            view = MessageView(messages)
+            system_message = view.system_message
+
+            if view.image_count > 5:
+                raise ValueError("Maximum of 5 images per API call exceeded")
 
             processed_messages = []
-            image_count = 0
             total_image_size = 0
 
-            for message in messages:
+            for message in view.without_system():
                 processed_content = []
                 if isinstance(message.get("content"), list):
                     for item in message["content"]:
                         if item["type"] == "text":
                             processed_content.append({"type": "text", "text": item["text"]})
                         elif item["type"] == "image_url":
-                            if image_count >= 5:
-                                raise ValueError("Maximum of 5 images per API call exceeded")
-
                             processed_image = self.process_image(item["image_url"])
                             processed_content.append(processed_image)
 
@@ -117,8 +120,6 @@ class Pipeline:
                             total_image_size += image_size
                             if total_image_size > 100 * 1024 * 1024:
                                 raise ValueError("Total size of images exceeds 100 MB limit")
-
-                            image_count += 1
                 else:
                     processed_content = [{"type": "text", "text": message.get("content", "")}]
 
@@ -159,10 +160,10 @@ class Pipeline:
                     elif data["type"] == "message_stop":
                         break
                 except json.JSONDecodeError:
-                    print(f"Failed to parse JSON: {event.data}")
+                    logger.warning("Failed to parse JSON: %s", event.data)
                 except KeyError as e:
-                    print(f"Unexpected data structure: {e}")
-                    print(f"Full data: {data}")
+                    logger.warning("Unexpected data structure: %s", e)
+                    logger.debug("Event type: %s", data.get("type"))
         else:
             raise Exception(f"Error: {response.status_code} - {response.text}")
 
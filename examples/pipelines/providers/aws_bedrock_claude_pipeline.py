@@ -9,19 +9,31 @@ requirements: requests, boto3
 environment_variables: AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION_NAME
 """
 import base64
-import json
-import logging
 from io import BytesIO
 from typing import List, Union, Generator, Iterator
 
-import boto3
+from botocore.exceptions import ClientError
 
 from pydantic import BaseModel
 
 import os
 import requests
 
+from utils.pipelines.clients import get_boto3_client
+from utils.pipelines.logger import get_pipeline_logger
 from utils.pipelines.main import pop_system_message
+from utils.pipelines.upstream import get_upstream
+
+# Error codes that mean Bedrock is overloaded rather than the request is invalid
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ModelNotReadyException",
+    "ModelTimeoutException",
+    "InternalServerException",
+}
+
+logger = get_pipeline_logger(__name__)
 
 
 class Pipeline:
@@ -29,6 +41,11 @@ class Pipeline:
         AWS_ACCESS_KEY: str = ""
         AWS_SECRET_KEY: str = ""
         AWS_REGION_NAME: str = ""
+        # Requests to Bedrock time out, and fail fast once it keeps failing
+        REQUEST_TIMEOUT: float = 120
+        MAX_CONCURRENCY: int = 32
+        FAILURE_THRESHOLD: int = 5
+        RECOVERY_TIMEOUT: float = 30
 
     def __init__(self):
         self.type = "manifold"
@@ -47,41 +64,42 @@ class Pipeline:
             }
         )
 
-        self.bedrock = boto3.client(aws_access_key_id=self.valves.AWS_ACCESS_KEY,
-                                    aws_secret_access_key=self.valves.AWS_SECRET_KEY,
-                                    service_name="bedrock",
-                                    region_name=self.valves.AWS_REGION_NAME)
-        self.bedrock_runtime = boto3.client(aws_access_key_id=self.valves.AWS_ACCESS_KEY,
-                                            aws_secret_access_key=self.valves.AWS_SECRET_KEY,
-                                            service_name="bedrock-runtime",
-                                            region_name=self.valves.AWS_REGION_NAME)
+        self.update_clients()
 
         self.pipelines = self.get_models()
 
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
         pass
 
     async def on_valves_updated(self):
         # This function is called when the valves are updated.
-        print(f"on_valves_updated:{__name__}")
-        self.bedrock = boto3.client(aws_access_key_id=self.valves.AWS_ACCESS_KEY,
-                                    aws_secret_access_key=self.valves.AWS_SECRET_KEY,
-                                    service_name="bedrock",
-                                    region_name=self.valves.AWS_REGION_NAME)
-        self.bedrock_runtime = boto3.client(aws_access_key_id=self.valves.AWS_ACCESS_KEY,
-                                            aws_secret_access_key=self.valves.AWS_SECRET_KEY,
-                                            service_name="bedrock-runtime",
-                                            region_name=self.valves.AWS_REGION_NAME)
+        logger.info("on_valves_updated:%s", __name__)
+        self.update_clients()
         self.pipelines = self.get_models()
 
+    def update_clients(self):
+        # Clients are shared and only rebuilt when the region or the credentials change,
+        # which closes the ones used before
+        self.bedrock = get_boto3_client("bedrock",
+                                        self.valves.AWS_REGION_NAME,
+                                        self.valves.AWS_ACCESS_KEY,
+                                        self.valves.AWS_SECRET_KEY,
+                                        owner=__name__)
+        self.bedrock_runtime = get_boto3_client("bedrock-runtime",
+                                                self.valves.AWS_REGION_NAME,
+                                                self.valves.AWS_ACCESS_KEY,
+                                                self.valves.AWS_SECRET_KEY,
+                                                read_timeout=self.valves.REQUEST_TIMEOUT,
+                                                owner=__name__)
+
     def pipelines(self) -> List[dict]:
         return self.get_models()
 
@@ -97,7 +115,7 @@ class Pipeline:
                     for model in response["modelSummaries"]
                 ]
             except Exception as e:
-                print(f"Error: {e}")
+                logger.error("Error fetching models from Bedrock: %s", e)
                 return [
                     {
                         "id": "error",
@@ -111,11 +129,11 @@ class Pipeline:
         self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
         # This is where you can add your custom pipelines like RAG.
-        print(f"pipe:{__name__}")
+        logger.debug("pipe:%s", __name__)
 
         system_message, messages = pop_system_message(messages)
 
-        logging.info(f"pop_system_message: {json.dumps(messages)}")
+        logger.debug("pop_system_message: %s messages", len(messages))
 
         try:
             processed_messages = []
@@ -143,10 +161,24 @@ class Pipeline:
                        "inferenceConfig": {"temperature": body.get("temperature", 0.5)},
                        "additionalModelRequestFields": {"top_k": body.get("top_k", 200), "top_p": body.get("top_p", 0.9)}
                        }
-            if body.get("stream", False):
-                return self.stream_response(model_id, payload)
-            else:
-                return self.get_completion(model_id, payload)
+            upstream = get_upstream(
+                f"bedrock:{self.valves.AWS_REGION_NAME}",
+                timeout=self.valves.REQUEST_TIMEOUT,
+                max_concurrency=self.valves.MAX_CONCURRENCY,
+                failure_threshold=self.valves.FAILURE_THRESHOLD,
+                recovery_timeout=self.valves.RECOVERY_TIMEOUT,
+            )
+            slot = upstream.acquire()
+            try:
+                if body.get("stream", False):
+                    return upstream.stream(slot, self.stream_response(model_id, payload, slot))
+                else:
+                    response = self.get_completion(model_id, payload, slot)
+                    slot.release()
+                    return response
+            except Exception:
+                slot.release()
+                raise
         except Exception as e:
             return f"Error: {e}"
 
@@ -165,17 +197,32 @@ class Pipeline:
                       "source": {"bytes": img_stream.read()}}
         }
 
-    def stream_response(self, model_id: str, payload: dict) -> Generator:
+    def call(self, slot, fn, **kwargs):
+        try:
+            response = fn(**kwargs)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES:
+                slot.failure()
+            else:
+                slot.success()
+            raise
+        except Exception:
+            slot.failure()
+            raise
+        slot.success()
+        return response
+
+    def stream_response(self, model_id: str, payload: dict, slot) -> Generator:
         if "system" in payload:
             del payload["system"]
         if "additionalModelRequestFields" in payload:
             del payload["additionalModelRequestFields"]
-        streaming_response = self.bedrock_runtime.converse_stream(**payload)
+        streaming_response = self.call(slot, self.bedrock_runtime.converse_stream, **payload)
         for chunk in streaming_response["stream"]:
             if "contentBlockDelta" in chunk:
                 yield chunk["contentBlockDelta"]["delta"]["text"]
 
-    def get_completion(self, model_id: str, payload: dict) -> str:
-        response = self.bedrock_runtime.converse(**payload)
+    def get_completion(self, model_id: str, payload: dict, slot) -> str:
+        response = self.call(slot, self.bedrock_runtime.converse, **payload)
         return response['output']['message']['content'][0]['text']
 
@@ -12,16 +12,13 @@ environment_variables: AZURE_INFERENCE_CREDENTIAL, AZURE_INFERENCE_ENDPOINT, MOD
 
 import os
 import json
-import logging
 from typing import List, Union, Generator, Iterator, Tuple
 from pydantic import BaseModel
-from azure.ai.inference import ChatCompletionsClient
-from azure.core.credentials import AzureKeyCredential
+from utils.pipelines.clients import get_chat_completions_client
+from utils.pipelines.logger import get_pipeline_logger
 from azure.ai.inference.models import SystemMessage, UserMessage, AssistantMessage
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
-logger = logging.getLogger(__name__)
+logger = get_pipeline_logger(__name__)
 
 
 def pop_system_message(messages: List[dict]) -> Tuple[str, List[dict]]:
@@ -72,10 +69,12 @@ class Pipeline:
         self.update_client()
 
     def update_client(self):
-        self.client = ChatCompletionsClient(
-            endpoint=self.valves.AZURE_INFERENCE_ENDPOINT,
-            credential=AzureKeyCredential(
-                self.valves.AZURE_INFERENCE_CREDENTIAL))
+        # The client is shared and only rebuilt when the endpoint or the key change,
+        # which closes the one used before
+        self.client = get_chat_completions_client(
+            self.valves.AZURE_INFERENCE_ENDPOINT,
+            self.valves.AZURE_INFERENCE_CREDENTIAL,
+            owner=__name__)
 
     def get_jais_models(self):
         return [
@@ -86,11 +85,11 @@ class Pipeline:
         ]
 
     async def on_startup(self):
-        logger.info(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
-        logger.info(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
         pass
 
     async def on_valves_updated(self):
@@ -102,11 +101,8 @@ class Pipeline:
     def pipe(self, user_message: str, model_id: str, messages: List[dict],
              body: dict) -> Union[str, Generator, Iterator]:
         try:
-            logger.debug(
-                f"Received request - user_message: {user_message}, model_id: {model_id}"
-            )
-            logger.debug(f"Messages: {json.dumps(messages, indent=2)}")
-            logger.debug(f"Body: {json.dumps(body, indent=2)}")
+            logger.debug("Received request - model_id: %s, messages: %s",
+                         model_id, len(messages))
 
             # Remove unnecessary keys
             for key in ['user', 'chat_id', 'title']:
@@ -134,8 +130,8 @@ class Pipeline:
                 for k, v in body.items() if k in allowed_params
             }
 
-            logger.debug(f"Prepared Jais messages: {jais_messages}")
-            logger.debug(f"Filtered body: {filtered_body}")
+            logger.debug("Prepared %s Jais messages, params: %s",
+                         len(jais_messages), sorted(filtered_body))
 
             is_stream = body.get("stream", False)
             if is_stream:
@@ -143,7 +139,7 @@ class Pipeline:
             else:
                 return self.get_completion(jais_messages, filtered_body)
         except Exception as e:
-            logger.error(f"Error in pipe: {str(e)}", exc_info=True)
+            logger.error("Error in pipe: %s", e, exc_info=True)
             return json.dumps({"error": str(e)})
 
     def stream_response(self, jais_messages: List[Union[SystemMessage, UserMessage, AssistantMessage]], params: dict) -> str:
@@ -160,7 +156,7 @@ class Pipeline:
                         complete_response += delta_content
             return complete_response
         except Exception as e:
-            logger.error(f"Error in stream_response: {str(e)}", exc_info=True)
+            logger.error("Error in stream_response: %s", e, exc_info=True)
             return json.dumps({"error": str(e)})
 
     def get_completion(self, jais_messages: List[Union[SystemMessage, UserMessage, AssistantMessage]], params: dict) -> str:
@@ -170,13 +166,13 @@ class Pipeline:
                                             **params)
             if response.choices:
                 result = response.choices[0].message.content
-                logger.debug(f"Completion result: {result}")
+                logger.debug("Completion result: %s chars", len(result or ""))
                 return result
             else:
                 logger.warning("No choices in completion response")
                 return ""
         except Exception as e:
-            logger.error(f"Error in get_completion: {str(e)}", exc_info=True)
+            logger.error("Error in get_completion: %s", e, exc_info=True)
             return json.dumps({"error": str(e)})
 
 
@@ -3,6 +3,11 @@ from pydantic import BaseModel
 import requests
 import os
 
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.upstream import UpstreamUnavailable, get_upstream
+
+logger = get_pipeline_logger(__name__)
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -12,6 +17,11 @@ class Pipeline:
         AZURE_OPENAI_API_VERSION: str
         AZURE_OPENAI_MODELS: str
         AZURE_OPENAI_MODEL_NAMES: str
+        # Requests to the endpoint time out, and fail fast once it keeps failing
+        REQUEST_TIMEOUT: float = 120
+        MAX_CONCURRENCY: int = 32
+        FAILURE_THRESHOLD: int = 5
+        RECOVERY_TIMEOUT: float = 30
 
     def __init__(self):
         self.type = "manifold"
@@ -34,7 +44,7 @@ class Pipeline:
         self.pipelines = [
             {"id": model, "name": name} for model, name in zip(models, model_names)
         ]
-        print(f"azure_openai_manifold_pipeline - models: {self.pipelines}")
+        logger.info("azure_openai_manifold_pipeline - models: %s", self.pipelines)
         pass
 
     async def on_valves_updated(self):
@@ -42,22 +52,21 @@ class Pipeline:
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
         pass
 
     def pipe(
             self, user_message: str, model_id: str, messages: List[dict], body: dict
     ) -> Union[str, Generator, Iterator]:
         # This is where you can add your custom pipelines like RAG.
-        print(f"pipe:{__name__}")
+        logger.debug("pipe:%s", __name__)
 
-        print(messages)
-        print(user_message)
+        logger.debug("model:%s messages:%s", model_id, len(messages))
 
         headers = {
             "api-key": self.valves.AZURE_OPENAI_API_KEY,
@@ -76,7 +85,20 @@ class Pipeline:
         filtered_body = {k: v for k, v in body.items() if k in allowed_params}
         # log fields that were filtered out as a single line
         if len(body) != len(filtered_body):
-            print(f"Dropped params: {', '.join(set(body.keys()) - set(filtered_body.keys()))}")
+            logger.debug("Dropped params: %s", ", ".join(set(body.keys()) - set(filtered_body.keys())))
+
+        r = None
+        upstream = get_upstream(
+            f"azure-openai:{self.valves.AZURE_OPENAI_ENDPOINT}",
+            timeout=self.valves.REQUEST_TIMEOUT,
+            max_concurrency=self.valves.MAX_CONCURRENCY,
+            failure_threshold=self.valves.FAILURE_THRESHOLD,
+            recovery_timeout=self.valves.RECOVERY_TIMEOUT,
+        )
+        try:
+            slot = upstream.acquire()
+        except UpstreamUnavailable as e:
+            return f"Error: {e}"
 
         try:
             r = requests.post(
@@ -84,14 +106,24 @@ class Pipeline:
                 json=filtered_body,
                 headers=headers,
                 stream=True,
+                timeout=upstream.timeouts,
             )
 
+            if r.status_code == 429 or r.status_code >= 500:
+                slot.failure()
+            else:
+                slot.success()
+
             r.raise_for_status()
             if body["stream"]:
-                return r.iter_lines()
+                return upstream.stream(slot, r.iter_lines())
             else:
-                return r.json()
+                response = r.json()
+                slot.release()
+                return response
         except Exception as e:
+            slot.failure()
+            slot.release()
             if r:
                 text = r.text
                 return f"Error: {e} ({text})"
@@ -17,6 +17,11 @@ from pydantic import BaseModel, Field
 import google.generativeai as genai
 from google.generativeai.types import GenerationConfig
 
+from utils.pipelines.logger import get_pipeline_logger
+from utils.pipelines.main import MessageView
+
+logger = get_pipeline_logger(__name__)
+
 
 class Pipeline:
     """Google GenAI pipeline"""
@@ -44,19 +49,19 @@ class Pipeline:
     async def on_startup(self) -> None:
         """This function is called when the server is started."""
 
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         genai.configure(api_key=self.valves.GOOGLE_API_KEY)
         self.update_pipelines()
 
     async def on_shutdown(self) -> None:
         """This function is called when the server is stopped."""
 
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
 
     async def on_valves_updated(self) -> None:
         """This function is called when the valves are updated."""
 
-        print(f"on_valves_updated:{__name__}")
+        logger.info("on_valves_updated:%s", __name__)
         genai.configure(api_key=self.valves.GOOGLE_API_KEY)
         self.update_pipelines()
 
@@ -101,32 +106,32 @@ class Pipeline:
             if not model_id.startswith("gemini-"):
                 return f"Error: Invalid model name format: {model_id}"
 
-            print(f"Pipe function called for model: {model_id}")
-            print(f"Stream mode: {body.get('stream', False)}")
+            logger.debug("Pipe function called for model: %s", model_id)
+            logger.debug("Stream mode: %s", body.get("stream", False))
 
-            system_message = next((msg["content"] for msg in messages if msg["role"] == "system"), None)
+            view = MessageView(messages)
+            system_message = view.system_message["content"] if view.system_message else None
             
             contents = []
-            for message in messages:
-                if message["role"] != "system":
-                    if isinstance(message.get("content"), list):
-                        parts = []
-                        for content in message["content"]:
-                            if content["type"] == "text":
-                                parts.append({"text": content["text"]})
-                            elif content["type"] == "image_url":
-                                image_url = content["image_url"]["url"]
-                                if image_url.startswith("data:image"):
-                                    image_data = image_url.split(",")[1]
-                                    parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_data}})
-                                else:
-                                    parts.append({"image_url": image_url})
-                        contents.append({"role": message["role"], "parts": parts})
-                    else:
-                        contents.append({
-                            "role": "user" if message["role"] == "user" else "model",
-                            "parts": [{"text": message["content"]}]
-                        })
+            for message in view.without_system():
+                if isinstance(message.get("content"), list):
+                    parts = []
+                    for content in message["content"]:
+                        if content["type"] == "text":
+                            parts.append({"text": content["text"]})
+                        elif content["type"] == "image_url":
+                            image_url = content["image_url"]["url"]
+                            if image_url.startswith("data:image"):
+                                image_data = image_url.split(",")[1]
+                                parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_data}})
+                            else:
+                                parts.append({"image_url": image_url})
+                    contents.append({"role": message["role"], "parts": parts})
+                else:
+                    contents.append({
+                        "role": "user" if message["role"] == "user" else "model",
+                        "parts": [{"text": message["content"]}]
+                    })
             
             if "gemini-1.5" in model_id:
                 model = genai.GenerativeModel(model_name=model_id, system_instruction=system_message)
@@ -167,7 +172,7 @@ class Pipeline:
                 return response.text
 
         except Exception as e:
-            print(f"Error generating content: {e}")
+            logger.warning("Error generating content: %s", e)
             return f"An error occurred: {str(e)}"
 
     def stream_response(self, response):
@@ -0,0 +1,386 @@
+"""
+title: Router Manifold Pipeline
+author: open-webui
+date: 2024-09-01
+version: 1.0
+license: MIT
+description: Routes logical models to weighted OpenAI-compatible and Azure OpenAI backends, with latency-aware selection, failover and hedged requests.
+requirements: requests
+environment_variables: ROUTER_ROUTES
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union, Generator, Iterator
+from pydantic import BaseModel
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+import requests
+
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
+
+
+class Backend:
+    def __init__(self, config: dict):
+        self.provider = config.get("provider", "openai")
+        self.base_url = config["base_url"].rstrip("/")
+        self.api_key = config.get("api_key") or os.getenv(config.get("api_key_env", ""), "")
+        self.model = config["model"]
+        self.api_version = config.get("api_version", "2024-02-01")
+        self.weight = max(float(config.get("weight", 1)), 0.01)
+
+        # Exponentially weighted moving averages of the time to first token (in
+        # seconds, None until the first success) and of the error rate
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def key(self) -> tuple:
+        return (self.provider, self.base_url, self.model)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def request(self, payload: dict) -> tuple:
+        if self.provider == "azure":
+            url = f"{self.base_url}/openai/deployments/{self.model}/chat/completions?api-version={self.api_version}"
+            headers = {"api-key": self.api_key, "Content-Type": "application/json"}
+        else:
+            url = f"{self.base_url}/chat/completions"
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            }
+        return url, headers, {**payload, "model": self.model}
+
+    def record_latency(self, latency: float, alpha: float):
+        with self.lock:
+            self.latency = (
+                latency
+                if self.latency is None
+                else alpha * latency + (1 - alpha) * self.latency
+            )
+
+    def record_success(self, latency: float, alpha: float):
+        self.record_latency(latency, alpha)
+        with self.lock:
+            self.error_rate = (1 - alpha) * self.error_rate
+            self.consecutive_failures = 0
+
+    def record_failure(self, alpha: float, failure_threshold: int, cooldown: float):
+        with self.lock:
+            self.error_rate = alpha + (1 - alpha) * self.error_rate
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= failure_threshold:
+                self.unhealthy_until = time.monotonic() + cooldown
+
+    def metrics(self) -> dict:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "latency_ms": None if self.latency is None else round(self.latency * 1000),
+            "error_rate": round(self.error_rate, 3),
+            "healthy": self.healthy,
+        }
+
+
+class RetryableError(Exception):
+    pass
+
+
+class Attempt:
+    def __init__(self, backend: Backend):
+        self.backend = backend
+        self.response = None
+        self.lines = None
+        self.first = None
+        self.error: Optional[Exception] = None
+        self.retryable = True
+        self.cancelled = False
+        self.done = False
+        self.started = time.monotonic()
+
+
+class Pipeline:
+    class Valves(BaseModel):
+        # JSON object mapping each logical model to its backends, e.g.
+        # {"gpt-4o": [
+        #   {"provider": "openai", "base_url": "https://api.openai.com/v1", "api_key_env": "OPENAI_API_KEY", "model": "gpt-4o", "weight": 2},
+        #   {"provider": "azure", "base_url": "https://example.openai.azure.com", "api_key": "...", "model": "gpt-4o", "api_version": "2024-02-01"}
+        # ]}
+        ROUTES: str = "{}"
+        CONNECT_TIMEOUT: float = 5
+        READ_TIMEOUT: float = 120
+        # Start a second request on the next backend if the first token takes
+        # longer than this, 0 to disable hedging
+        HEDGE_AFTER_MS: int = 2000
+        # Maximum number of backends tried per request, hedges included
+        MAX_ATTEMPTS: int = 3
+        EWMA_ALPHA: float = 0.2
+        ERROR_PENALTY: float = 4
+        EXPLORE_RATIO: float = 0.05
+        FAILURE_THRESHOLD: int = 3
+        COOLDOWN_SECONDS: float = 30
+        # Maximum number of backend requests waiting for their first token, across
+        # all requests. Further attempts wait for a free worker
+        MAX_CONCURRENCY: int = 32
+
+    def __init__(self):
+        self.type = "manifold"
+        self.name = "Router: "
+
+        self.valves = self.Valves(**{"ROUTES": os.getenv("ROUTER_ROUTES", "{}")})
+
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.executor = None
+        self.executor_size = 0
+        self.update_routes()
+        self.update_executor()
+        pass
+
+    async def on_startup(self):
+        # This function is called when the server is started.
+        logger.info("on_startup:%s", __name__)
+        pass
+
+    async def on_shutdown(self):
+        # This function is called when the server is stopped.
+        logger.info("on_shutdown:%s", __name__)
+        self.executor.shutdown(wait=False)
+        self.session.close()
+        pass
+
+    async def on_valves_updated(self):
+        # This function is called when the valves are updated.
+        logger.info("on_valves_updated:%s", __name__)
+        self.update_routes()
+        self.update_executor()
+        pass
+
+    def update_executor(self):
+        size = max(self.valves.MAX_CONCURRENCY, 1)
+        if size == self.executor_size:
+            return
+        # Attempts already submitted to the previous executor still run
+        previous = self.executor
+        self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="router")
+        self.executor_size = size
+        if previous is not None:
+            previous.shutdown(wait=False)
+
+    def update_routes(self):
+        try:
+            config = json.loads(self.valves.ROUTES or "{}")
+        except ValueError as e:
+            logger.warning("Invalid ROUTES: %s", e)
+            config = {}
+        if not isinstance(config, dict):
+            logger.warning("Invalid ROUTES: expected a JSON object, got %s", type(config).__name__)
+            config = {}
+
+        # Statistics of backends that are kept across updates are preserved
+        with self.lock:
+            existing = {
+                backend.key: backend
+                for backends in self.routes.values()
+                for backend in backends
+            }
+            routes = {}
+            for model, backends in config.items():
+                if not isinstance(backends, list):
+                    logger.warning("Invalid backends for %s: expected a JSON array", model)
+                    continue
+                routes[model] = []
+                for backend_config in backends:
+                    try:
+                        backend = Backend(backend_config)
+                    except (KeyError, TypeError, ValueError) as e:
+                        logger.warning("Invalid backend for %s: %s", model, e)
+                        continue
+                    if backend.key in existing:
+                        existing[backend.key].weight = backend.weight
+                        existing[backend.key].api_key = backend.api_key
+                        backend = existing[backend.key]
+                    routes[model].append(backend)
+            self.routes = routes
+
+        self.pipelines = [{"id": model, "name": model} for model in self.routes]
+
+    def rank(self, backends: List[Backend]) -> List[Backend]:
+        """
+        Orders backends from best to worst: healthy backends first, by EWMA time
+        to first token penalized by their error rate and divided by their weight.
+        Backends without a latency yet are tried first, and occasionally a random
+        backend is moved to the front so that the statistics of slower backends
+        stay fresh.
+        """
+
+        def score(backend: Backend) -> tuple:
+            latency = backend.latency
+            if latency is None:
+                latency = self.valves.CONNECT_TIMEOUT if backend.error_rate else 0.0
+            penalty = 1 + backend.error_rate * self.valves.ERROR_PENALTY
+            return (not backend.healthy, latency * penalty / backend.weight)
+
+        ranked = sorted(backends, key=score)
+        healthy = [backend for backend in ranked if backend.healthy]
+        if len(healthy) > 1 and random.random() < self.valves.EXPLORE_RATIO:
+            chosen = random.choices(healthy, weights=[b.weight for b in healthy])[0]
+            ranked.remove(chosen)
+            ranked.insert(0, chosen)
+        return ranked
+
+    def start(self, attempt: Attempt, payload: dict, stream: bool, results: queue.Queue):
+        backend = attempt.backend
+
+        def run():
+            # The request may have completed on another backend while this
+            # attempt waited for a worker
+            if attempt.cancelled:
+                return
+            try:
+                url, headers, data = backend.request(payload)
+                r = self.session.post(
+                    url=url,
+                    json=data,
+                    headers=headers,
+                    stream=True,
+                    timeout=(self.valves.CONNECT_TIMEOUT, self.valves.READ_TIMEOUT),
+                )
+                with self.lock:
+                    attempt.response = r
+                    if attempt.cancelled:
+                        r.close()
+                        return
+
+                if r.status_code in (408, 429) or r.status_code >= 500:
+                    raise RetryableError(f"{r.status_code} {r.reason}")
+                if r.status_code >= 400:
+                    attempt.retryable = False
+                r.raise_for_status()
+
+                if stream:
+                    attempt.lines = (line for line in r.iter_lines() if line)
+                    attempt.first = next(attempt.lines, None)
+                else:
+                    attempt.first = r.json()
+
+                backend.record_success(
+                    time.monotonic() - attempt.started, self.valves.EWMA_ALPHA
+                )
+            except Exception as e:
+                if attempt.cancelled:
+                    return
+                attempt.error = e
+                if attempt.response is not None:
+                    attempt.response.close()
+                if attempt.retryable:
+                    backend.record_failure(
+                        self.valves.EWMA_ALPHA,
+                        self.valves.FAILURE_THRESHOLD,
+                        self.valves.COOLDOWN_SECONDS,
+                    )
+            attempt.done = True
+            results.put(attempt)
+
+        self.executor.submit(run)
+
+    def pipe(
+        self, user_message: str, model_id: str, messages: List[dict], body: dict
+    ) -> Union[str, Generator, Iterator]:
+        logger.debug("pipe:%s", __name__)
+
+        backends = self.routes.get(model_id)
+        if not backends:
+            return f"Error: No backends configured for {model_id}"
+
+        payload = {**body}
+        for key in ("user", "chat_id", "title"):
+            payload.pop(key, None)
+
+        stream = bool(body.get("stream"))
+        candidates = self.rank(backends)[: max(self.valves.MAX_ATTEMPTS, 1)]
+        results = queue.Queue()
+        attempts = []
+        errors = []
+
+        def launch():
+            attempt = Attempt(candidates[len(attempts)])
+            attempts.append(attempt)
+            self.start(attempt, payload, stream, results)
+
+        def cancel(winner: Optional[Attempt] = None):
+            with self.lock:
+                for attempt in attempts:
+                    if attempt is not winner and not attempt.cancelled:
+                        attempt.cancelled = True
+                        if winner is not None and not attempt.done:
+                            # A hedge that lost was at least this slow
+                            attempt.backend.record_latency(
+                                time.monotonic() - attempt.started,
+                                self.valves.EWMA_ALPHA,
+                            )
+                        if attempt.response is not None:
+                            attempt.response.close()
+
+        launch()
+        pending = 1
+        winner = None
+        while pending:
+            hedge = (
+                self.valves.HEDGE_AFTER_MS > 0
+                and len(attempts) < len(candidates)
+            )
+            try:
+                attempt = results.get(
+                    timeout=self.valves.HEDGE_AFTER_MS / 1000 if hedge else None
+                )
+            except queue.Empty:
+                # The first token is late: hedge on the next backend
+                logger.debug("Hedging %s on %s", model_id, candidates[len(attempts)].base_url)
+                launch()
+                pending += 1
+                continue
+
+            pending -= 1
+            if attempt.error is None:
+                winner = attempt
+                break
+
+            errors.append(f"{attempt.backend.base_url}: {attempt.error}")
+            if not attempt.retryable:
+                break
+            if len(attempts) < len(candidates) and pending == 0:
+                # Fail over to the next backend
+                launch()
+                pending += 1
+
+        cancel(winner)
+
+        if winner is None:
+            return f"Error: {'; '.join(errors)}"
+
+        if not stream:
+            return winner.first
+
+        def stream_lines():
+            try:
+                if winner.first is not None:
+                    yield winner.first
+                yield from winner.lines
+            finally:
+                winner.response.close()
+
+        return stream_lines()
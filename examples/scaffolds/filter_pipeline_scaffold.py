@@ -11,6 +11,9 @@ requirements: requests
 from typing import List, Optional
 from pydantic import BaseModel
 from schemas import OpenAIChatMessage
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
 
 
 class Pipeline:
@@ -46,23 +49,35 @@ class Pipeline:
 
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
+        logger.info("on_startup:%s", __name__)
         pass
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
+        logger.info("on_shutdown:%s", __name__)
         pass
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # This filter is applied to the form data before it is sent to the OpenAI API.
-        print(f"inlet:{__name__}")
+        # Log ids and sizes rather than whole bodies or user records.
+        logger.debug(
+            "inlet:%s messages:%s user:%s",
+            __name__,
+            len(body.get("messages", [])),
+            (user or {}).get("id"),
+        )
 
         # If you'd like to check for title generation, you can add the following check
         if body.get("title", False):
-            print("Title Generation Request")
-
-        print(body)
-        print(user)
+            logger.debug("Title Generation Request")
 
         return body
+
+    # Optional: define stream_outlet to filter streamed responses of connected
+    # pipelines as they are generated. It is called with batches of complete
+    # sentences; return the (possibly modified) text, an empty string to drop it,
+    # or raise an exception to abort the stream with finish_reason "content_filter".
+    #
+    # async def stream_outlet(self, chunk: str, body: dict) -> str:
+    #     logger.debug("stream_outlet:%s", __name__)
+    #     return chunk
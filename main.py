@@ -1,18 +1,49 @@
 from fastapi import FastAPI, Request, Depends, status, HTTPException, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
+from fastapi.concurrency import run_in_threadpool, iterate_in_threadpool
 
 
-from starlette.responses import StreamingResponse, Response
+from starlette.responses import StreamingResponse, Response, PlainTextResponse
 from pydantic import BaseModel, ConfigDict
-from typing import List, Union, Generator, Iterator
+from typing import List, Optional, Union, Generator, Iterator, AsyncGenerator, AsyncIterator
 
 
 from utils.pipelines.auth import bearer_security, get_current_user
-from utils.pipelines.main import get_last_user_message, stream_message_template
+from utils.pipelines.main import (
+    get_last_user_message,
+    stream_message_template,
+    split_at_sentence_boundary,
+)
 from utils.pipelines.misc import convert_to_raw_url
+from utils.pipelines.clients import close_clients
+from utils.pipelines.control import CONTROL
+from utils.pipelines.valves import VALVES
+from utils.pipelines.logger import (
+    configure_logging,
+    get_logger,
+)
+from utils.pipelines.metrics import (
+    REGISTRY,
+    ERRORS,
+    FILTER_DURATION,
+    HTTP_REQUEST_DURATION,
+    QUEUE_WAIT,
+    RELOAD_DURATION,
+    REQUEST_DURATION,
+    STREAM_BYTES,
+    STREAM_CHUNKS,
+    TIME_TO_FIRST_TOKEN,
+)
+from utils.pipelines.profiling import (
+    SETTINGS as PROFILING,
+    SLOW_REQUESTS,
+    get_trace,
+    record,
+    sample_stacks,
+    start_trace,
+)
 
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, nullcontext
 from concurrent.futures import ThreadPoolExecutor
 from schemas import FilterForm, OpenAIChatCompletionForm
 from urllib.parse import urlparse
@@ -21,7 +52,7 @@ import shutil
 import aiohttp
 import os
 import importlib.util
-import logging
+import inspect
 import time
 import json
 import uuid
@@ -31,6 +62,9 @@ import subprocess
 
 from config import API_KEY, PIPELINES_DIR
 
+configure_logging()
+logger = get_logger("main")
+
 if not os.path.exists(PIPELINES_DIR):
     os.makedirs(PIPELINES_DIR)
 
@@ -107,6 +141,254 @@ def get_all_pipelines():
     return pipelines
 
 
+def format_stream_line(model: str, line) -> str:
+    """
+    Formats a line yielded by a streaming pipe as an SSE event. Lines that are
+    already SSE events are passed through, other lines are wrapped in a chunk.
+    """
+    if isinstance(line, BaseModel):
+        line = line.model_dump_json()
+        line = f"data: {line}"
+
+    try:
+        line = line.decode("utf-8")
+    except:
+        pass
+
+    logger.debug("stream_content:Generator:%s chars", len(line))
+
+    if line.startswith("data:"):
+        return f"{line}\n\n"
+    else:
+        line = stream_message_template(model, line)
+        return f"data: {json.dumps(line)}\n\n"
+
+
+def stream_finish_message(model: str, finish_reason: str = "stop") -> dict:
+    return {
+        "id": f"{model}-{str(uuid.uuid4())}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {},
+                "logprobs": None,
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
+
+
+def completion_response(model: str, res) -> dict:
+    """Builds the chat.completion response of a non-streaming pipe call."""
+    if isinstance(res, dict):
+        return res
+    elif isinstance(res, BaseModel):
+        return res.model_dump()
+    else:
+
+        message = ""
+
+        if isinstance(res, str):
+            message = res
+
+        if isinstance(res, Generator):
+            for stream in res:
+                message = f"{message}{stream}"
+
+        logger.debug("stream:false:%s chars", len(message))
+        return {
+            "id": f"{model}-{str(uuid.uuid4())}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {
+                        "role": "assistant",
+                        "content": message,
+                    },
+                    "logprobs": None,
+                    "finish_reason": "stop",
+                }
+            ],
+        }
+
+
+def get_stream_outlet_filters(model_id: str) -> list:
+    """
+    Returns the (id, module) pairs of the filter pipelines connected to model_id
+    that implement the optional stream_outlet hook, in priority order.
+    """
+    filters = []
+    for pipeline_id, pipeline in PIPELINES.items():
+        if pipeline["type"] != "filter":
+            continue
+        module = PIPELINE_MODULES.get(pipeline_id)
+        if module is None or not hasattr(module, "stream_outlet"):
+            continue
+        if "*" in pipeline["pipelines"] or model_id in pipeline["pipelines"]:
+            filters.append((pipeline["priority"], pipeline_id, module))
+
+    return [
+        (pipeline_id, module)
+        for _, pipeline_id, module in sorted(filters, key=lambda item: item[0])
+    ]
+
+
+class StreamAborted(Exception):
+    """Raised when a stream_outlet filter aborts a stream."""
+
+
+async def filter_stream_content(
+    events: AsyncIterator, filters: list, model: str, body: dict
+):
+    """
+    Applies the stream_outlet hook of filters to a stream of SSE events.
+
+    Content deltas are buffered and passed to the filters one batch of complete
+    sentences at a time; other events (role, finish, [DONE]) flush the buffer
+    and are passed through. A filter can transform a batch, drop it by returning
+    an empty string, or abort the stream by raising an exception, which ends it
+    with a content_filter finish reason.
+    """
+
+    async def run_filters(text: str) -> str:
+        for filter_id, module in filters:
+            if not text:
+                break
+            started = time.perf_counter()
+            try:
+                text = await module.stream_outlet(text, body)
+            finally:
+                duration = time.perf_counter() - started
+                FILTER_DURATION.observe(duration, filter=filter_id, stage="stream_outlet")
+                record(f"filter.{filter_id}.stream_outlet", duration)
+        return text
+
+    def event(text: str) -> str:
+        return f"data: {json.dumps(stream_message_template(model, text))}\n\n"
+
+    async def apply_filters(text: str) -> str:
+        try:
+            return await run_filters(text)
+        except Exception as e:
+            logger.warning("Stream aborted by a stream_outlet filter: %s", e)
+            raise StreamAborted() from e
+
+    buffer = ""
+    try:
+        # Errors of the pipe itself are not caught, and take the usual error path
+        async for line in events:
+            content = None
+            payload = line[len("data:") :].strip() if line.startswith("data:") else ""
+            if payload.startswith("{"):
+                try:
+                    content = json.loads(payload)["choices"][0]["delta"].get("content")
+                except (ValueError, KeyError, IndexError, AttributeError):
+                    content = None
+
+            if isinstance(content, str) and content:
+                # Only the appended text, and the character before it, can hold
+                # a new boundary
+                start = len(buffer) - 1
+                buffer += content
+                text, buffer = split_at_sentence_boundary(buffer, start)
+                text = await apply_filters(text) if text else ""
+                if text:
+                    yield event(text)
+            else:
+                if buffer:
+                    text, buffer = await apply_filters(buffer), ""
+                    if text:
+                        yield event(text)
+                yield line
+
+        text = await apply_filters(buffer) if buffer else ""
+        if text:
+            yield event(text)
+    except StreamAborted:
+        # The reason is logged, not sent to the client
+        finish_message = stream_finish_message(model, "content_filter")
+        yield f"data: {json.dumps(finish_message)}\n\n"
+        yield f"data: [DONE]"
+    finally:
+        if hasattr(events, "aclose"):
+            await events.aclose()
+
+
+def instrument_stream(
+    events: Iterator, pipeline_id: str, route: str, started: float, trace=None
+):
+    """
+    Records the time to first chunk, chunk count, size and duration of a stream,
+    and finishes the request's profiling trace, if any, once it ends.
+    """
+    chunks = 0
+    size = 0
+    first_chunk = None
+    try:
+        for event in events:
+            if not chunks:
+                first_chunk = time.perf_counter()
+                TIME_TO_FIRST_TOKEN.observe(first_chunk - started, pipeline=pipeline_id)
+            chunks += 1
+            size += len(event.encode("utf-8")) if isinstance(event, str) else len(event)
+            yield event
+    except Exception:
+        ERRORS.inc(pipeline=pipeline_id, route=route)
+        raise
+    finally:
+        STREAM_CHUNKS.observe(chunks, pipeline=pipeline_id)
+        STREAM_BYTES.observe(size, pipeline=pipeline_id)
+        ended = time.perf_counter()
+        REQUEST_DURATION.observe(ended - started, pipeline=pipeline_id, route=route)
+        if trace is not None:
+            if first_chunk is not None:
+                trace.add("first_chunk", first_chunk - started)
+                trace.add("stream", ended - first_chunk)
+            trace.finish()
+
+
+async def instrument_async_stream(
+    events: AsyncIterator, pipeline_id: str, route: str, started: float, trace=None
+):
+    """Same as instrument_stream for async streams."""
+    chunks = 0
+    size = 0
+    first_chunk = None
+    try:
+        async for event in events:
+            if not chunks:
+                first_chunk = time.perf_counter()
+                TIME_TO_FIRST_TOKEN.observe(first_chunk - started, pipeline=pipeline_id)
+            chunks += 1
+            size += len(event.encode("utf-8")) if isinstance(event, str) else len(event)
+            yield event
+    except Exception:
+        ERRORS.inc(pipeline=pipeline_id, route=route)
+        raise
+    finally:
+        STREAM_CHUNKS.observe(chunks, pipeline=pipeline_id)
+        STREAM_BYTES.observe(size, pipeline=pipeline_id)
+        ended = time.perf_counter()
+        REQUEST_DURATION.observe(ended - started, pipeline=pipeline_id, route=route)
+        if trace is not None:
+            if first_chunk is not None:
+                trace.add("first_chunk", first_chunk - started)
+                trace.add("stream", ended - first_chunk)
+            trace.finish()
+
+
+def get_route(request: Request) -> str:
+    """The route template of a request, e.g. /v1/{pipeline_id}/valves, to keep label values bounded."""
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
 def parse_frontmatter(content):
     frontmatter = {}
     for line in content.split("\n"):
@@ -120,10 +402,10 @@ def install_frontmatter_requirements(requirements):
     if requirements:
         req_list = [req.strip() for req in requirements.split(",")]
         for req in req_list:
-            print(f"Installing requirement: {req}")
+            logger.info("Installing requirement: %s", req)
             subprocess.check_call([sys.executable, "-m", "pip", "install", req])
     else:
-        print("No requirements found in frontmatter.")
+        logger.info("No requirements found in frontmatter.")
 
 
 async def load_module_from_path(module_name, module_path):
@@ -149,13 +431,13 @@ async def load_module_from_path(module_name, module_path):
         spec = importlib.util.spec_from_file_location(module_name, module_path)
         module = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(module)
-        print(f"Loaded module: {module.__name__}")
+        logger.info("Loaded module: %s", module.__name__)
         if hasattr(module, "Pipeline"):
             return module.Pipeline()
         else:
             raise Exception("No Pipeline class found")
     except Exception as e:
-        print(f"Error loading module: {module_name}")
+        logger.error("Error loading module: %s", module_name)
 
         # Move the file to the error folder
         failed_pipelines_folder = os.path.join(PIPELINES_DIR, "failed")
@@ -164,7 +446,7 @@ async def load_module_from_path(module_name, module_path):
 
         failed_file_path = os.path.join(failed_pipelines_folder, f"{module_name}.py")
         os.rename(module_path, failed_file_path)
-        print(e)
+        logger.error("%s", e)
     return None
 
 
@@ -181,45 +463,40 @@ async def load_modules_from_directory(directory):
             subfolder_path = os.path.join(directory, module_name)
             if not os.path.exists(subfolder_path):
                 os.makedirs(subfolder_path)
-                logging.info(f"Created subfolder: {subfolder_path}")
-
-            # Create a valves.json file if it doesn't exist
-            valves_json_path = os.path.join(subfolder_path, "valves.json")
-            if not os.path.exists(valves_json_path):
-                with open(valves_json_path, "w") as f:
-                    json.dump({}, f)
-                logging.info(f"Created valves.json in: {subfolder_path}")
+                logger.info("Created subfolder: %s", subfolder_path)
 
             pipeline = await load_module_from_path(module_name, module_path)
             if pipeline:
-                # Overwrite pipeline.valves with values from valves.json
-                if os.path.exists(valves_json_path):
-                    with open(valves_json_path, "r") as f:
-                        valves_json = json.load(f)
-                        if hasattr(pipeline, "valves"):
-                            ValvesModel = pipeline.valves.__class__
-                            # Create a ValvesModel instance using default values and overwrite with valves_json
-                            combined_valves = {
-                                **pipeline.valves.model_dump(),
-                                **valves_json,
-                            }
-                            valves = ValvesModel(**combined_valves)
-                            pipeline.valves = valves
-
-                            logging.info(f"Updated valves for module: {module_name}")
+                # Overwrite pipeline.valves with the saved values
+                valves_json = VALVES.get(module_name)
+                if valves_json and hasattr(pipeline, "valves"):
+                    ValvesModel = pipeline.valves.__class__
+                    # Create a ValvesModel instance using default values and overwrite with valves_json
+                    combined_valves = {
+                        **pipeline.valves.model_dump(),
+                        **valves_json,
+                    }
+                    valves = ValvesModel(**combined_valves)
+                    pipeline.valves = valves
+
+                    logger.info("Updated valves for module: %s", module_name)
 
                 pipeline_id = pipeline.id if hasattr(pipeline, "id") else module_name
                 PIPELINE_MODULES[pipeline_id] = pipeline
                 PIPELINE_NAMES[pipeline_id] = module_name
-                logging.info(f"Loaded module: {module_name}")
+                logger.info("Loaded module: %s", module_name)
             else:
-                logging.warning(f"No Pipeline class found in {module_name}")
+                logger.warning("No Pipeline class found in %s", module_name)
+
+    # Save the valves imported from legacy valves.json files in one write
+    VALVES.flush()
 
     global PIPELINES
     PIPELINES = get_all_pipelines()
 
 
 async def on_startup():
+    VALVES.load()
     await load_modules_from_directory(PIPELINES_DIR)
 
     for module in PIPELINE_MODULES.values():
@@ -233,7 +510,8 @@ async def on_shutdown():
             await module.on_shutdown()
 
 
-async def reload():
+async def reload(broadcast: bool = True):
+    started = time.perf_counter()
     await on_shutdown()
     # Clear existing pipelines
     PIPELINES.clear()
@@ -241,13 +519,40 @@ async def reload():
     PIPELINE_NAMES.clear()
     # Load pipelines afresh
     await on_startup()
+    RELOAD_DURATION.observe(time.perf_counter() - started)
+
+    # Let the other workers reload as well
+    if broadcast and CONTROL is not None:
+        CONTROL.publish_reload()
+
+
+async def reload_valves(pipeline_id: str):
+    """Applies the valves of pipeline_id saved by another worker."""
+    pipeline = PIPELINE_MODULES.get(pipeline_id)
+    if pipeline is None or not hasattr(pipeline, "valves"):
+        return
+
+    VALVES.load()
+    valves_json = VALVES.get(PIPELINE_NAMES[pipeline_id])
+
+    ValvesModel = pipeline.valves.__class__
+    pipeline.valves = ValvesModel(**{**pipeline.valves.model_dump(), **valves_json})
+
+    if hasattr(pipeline, "on_valves_updated"):
+        await pipeline.on_valves_updated()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await on_startup()
+    if CONTROL is not None:
+        CONTROL.start(lambda: reload(broadcast=False), reload_valves)
     yield
+    if CONTROL is not None:
+        await CONTROL.stop()
     await on_shutdown()
+    # SDK clients outlive reloads, so they are only closed when the server stops
+    await close_clients()
 
 
 app = FastAPI(docs_url="/docs", redoc_url=None, lifespan=lifespan)
@@ -269,11 +574,29 @@ app.add_middleware(
 
 @app.middleware("http")
 async def check_url(request: Request, call_next):
-    start_time = int(time.time())
-    app.state.PIPELINES = get_all_pipelines()
+    start_time = time.perf_counter()
+    trace = start_trace(request.method, request.url.path)
+    if trace is not None:
+        with trace.span("pipelines"):
+            app.state.PIPELINES = get_all_pipelines()
+    else:
+        app.state.PIPELINES = get_all_pipelines()
     response = await call_next(request)
-    process_time = int(time.time()) - start_time
-    response.headers["X-Process-Time"] = str(process_time)
+    process_time = time.perf_counter() - start_time
+    response.headers["X-Process-Time"] = f"{process_time:.6f}"
+    if trace is not None:
+        if trace.handled is not None:
+            # Serializing the response body and the rest of the middleware stack
+            trace.add("encode", time.perf_counter() - trace.handled)
+        response.headers["Server-Timing"] = trace.server_timing()
+        if not trace.streaming:
+            trace.finish()
+    HTTP_REQUEST_DURATION.observe(
+        process_time,
+        method=request.method,
+        route=get_route(request),
+        status=response.status_code,
+    )
 
     return response
 
@@ -323,6 +646,16 @@ async def get_status():
     return {"status": True}
 
 
+@app.get("/metrics")
+async def get_metrics(user: str = Depends(get_current_user)):
+    """
+    Returns the server metrics in the Prometheus text format
+    """
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @app.get("/v1/pipelines")
 @app.get("/pipelines")
 async def list_pipelines(user: str = Depends(get_current_user)):
@@ -394,7 +727,7 @@ async def add_pipeline(
     try:
         url = convert_to_raw_url(form_data.url)
 
-        print(url)
+        logger.info("Downloading pipeline from %s", url)
         file_path = await download_file(url, dest_folder=PIPELINES_DIR)
         await reload()
         return {
@@ -505,6 +838,87 @@ async def reload_pipelines(user: str = Depends(get_current_user)):
         )
 
 
+class ProfilingForm(BaseModel):
+    enabled: Optional[bool] = None
+    slow_request_threshold_ms: Optional[float] = None
+
+
+def profiling_status() -> dict:
+    return {
+        "enabled": PROFILING.enabled,
+        "slow_request_threshold_ms": PROFILING.slow_request_threshold_ms,
+        "slow_requests": list(SLOW_REQUESTS),
+    }
+
+
+@app.get("/v1/profiling")
+@app.get("/profiling")
+async def get_profiling(user: str = Depends(get_current_user)):
+    """
+    Returns the profiling settings and the most recent slow requests, with the
+    time spent in each stage
+    """
+    if user != API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid API key",
+        )
+    return profiling_status()
+
+
+@app.post("/v1/profiling/update")
+@app.post("/profiling/update")
+async def update_profiling(
+    form_data: ProfilingForm, user: str = Depends(get_current_user)
+):
+    if user != API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid API key",
+        )
+
+    if form_data.enabled is not None:
+        PROFILING.enabled = form_data.enabled
+    if form_data.slow_request_threshold_ms is not None:
+        PROFILING.slow_request_threshold_ms = form_data.slow_request_threshold_ms
+    return profiling_status()
+
+
+@app.get("/v1/profiling/flamegraph")
+@app.get("/profiling/flamegraph")
+async def get_flamegraph(
+    seconds: float = 10,
+    interval_ms: float = 10,
+    user: str = Depends(get_current_user),
+):
+    """
+    Samples the stacks of every thread for the given number of seconds and
+    returns them as collapsed stacks, the input of flamegraph.pl and speedscope
+    """
+    if user != API_KEY:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid API key",
+        )
+    if not 0 < seconds <= 300 or not 1 <= interval_ms <= 1000:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="seconds must be in (0, 300] and interval_ms in [1, 1000]",
+        )
+
+    try:
+        stacks = await run_in_threadpool(sample_stacks, seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+
+    return PlainTextResponse(
+        stacks,
+        headers={
+            "Content-Disposition": f'attachment; filename="pipelines-{int(time.time())}.folded"'
+        },
+    )
+
+
 @app.get("/v1/{pipeline_id}/valves")
 @app.get("/{pipeline_id}/valves")
 async def get_valves(pipeline_id: str):
@@ -568,18 +982,16 @@ async def update_valves(pipeline_id: str, form_data: dict):
         valves = ValvesModel(**form_data)
         pipeline.valves = valves
 
-        # Determine the directory path for the valves.json file
-        subfolder_path = os.path.join(PIPELINES_DIR, PIPELINE_NAMES[pipeline_id])
-        valves_json_path = os.path.join(subfolder_path, "valves.json")
-
-        # Save the updated valves data back to the valves.json file
-        with open(valves_json_path, "w") as f:
-            json.dump(valves.model_dump(), f)
+        # Save the updated valves, batched with concurrent updates
+        await VALVES.save(PIPELINE_NAMES[pipeline_id], valves.model_dump())
 
         if hasattr(pipeline, "on_valves_updated"):
             await pipeline.on_valves_updated()
+
+        if CONTROL is not None:
+            CONTROL.publish_valves(pipeline_id)
     except Exception as e:
-        print(e)
+        logger.exception("%s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"{str(e)}",
@@ -608,12 +1020,18 @@ async def filter_inlet(pipeline_id: str, form_data: FilterForm):
 
     try:
         if hasattr(pipeline, "inlet"):
-            body = await pipeline.inlet(form_data.body, form_data.user)
+            started = time.perf_counter()
+            try:
+                body = await pipeline.inlet(form_data.body, form_data.user)
+            finally:
+                duration = time.perf_counter() - started
+                FILTER_DURATION.observe(duration, filter=pipeline_id, stage="inlet")
+                record(f"filter.{pipeline_id}.inlet", duration)
             return body
         else:
             return form_data.body
     except Exception as e:
-        print(e)
+        logger.exception("%s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"{str(e)}",
@@ -640,12 +1058,18 @@ async def filter_outlet(pipeline_id: str, form_data: FilterForm):
 
     try:
         if hasattr(pipeline, "outlet"):
-            body = await pipeline.outlet(form_data.body, form_data.user)
+            started = time.perf_counter()
+            try:
+                body = await pipeline.outlet(form_data.body, form_data.user)
+            finally:
+                duration = time.perf_counter() - started
+                FILTER_DURATION.observe(duration, filter=pipeline_id, stage="outlet")
+                record(f"filter.{pipeline_id}.outlet", duration)
             return body
         else:
             return form_data.body
     except Exception as e:
-        print(e)
+        logger.exception("%s", e)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"{str(e)}",
@@ -654,7 +1078,12 @@ async def filter_outlet(pipeline_id: str, form_data: FilterForm):
 
 @app.post("/v1/chat/completions")
 @app.post("/chat/completions")
-async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
+async def generate_openai_chat_completion(
+    request: Request, form_data: OpenAIChatCompletionForm
+):
+    started = time.perf_counter()
+    route = get_route(request)
+    trace = get_trace()
     messages = [message.model_dump() for message in form_data.messages]
     user_message = get_last_user_message(messages)
 
@@ -667,117 +1096,129 @@ async def generate_openai_chat_completion(form_data: OpenAIChatCompletionForm):
             detail=f"Pipeline {form_data.model} not found",
         )
 
-    def job():
-        print(form_data.model)
+    pipeline = app.state.PIPELINES[form_data.model]
+    pipeline_id = form_data.model
 
-        pipeline = app.state.PIPELINES[form_data.model]
-        pipeline_id = form_data.model
+    if pipeline["type"] == "manifold":
+        manifold_id, pipeline_id = pipeline_id.split(".", 1)
+        pipe = PIPELINE_MODULES[manifold_id].pipe
+    else:
+        pipe = PIPELINE_MODULES[pipeline_id].pipe
 
-        print(pipeline_id)
+    def span(stage: str):
+        return trace.span(stage) if trace is not None else nullcontext()
 
-        if pipeline["type"] == "manifold":
-            manifold_id, pipeline_id = pipeline_id.split(".", 1)
-            pipe = PIPELINE_MODULES[manifold_id].pipe
-        else:
-            pipe = PIPELINE_MODULES[pipeline_id].pipe
+    def call_pipe():
+        return pipe(
+            user_message=user_message,
+            model_id=pipeline_id,
+            messages=messages,
+            body=form_data.model_dump(),
+        )
 
+    def stream_response(events: AsyncIterator) -> StreamingResponse:
+        stream_filters = get_stream_outlet_filters(form_data.model)
+        if stream_filters:
+            events = filter_stream_content(
+                events, stream_filters, form_data.model, form_data.model_dump()
+            )
+        events = instrument_async_stream(events, form_data.model, route, started, trace)
+        if trace is not None:
+            trace.streaming = True
+        return StreamingResponse(events, media_type="text/event-stream")
+
+    def completion(res) -> dict:
+        response = completion_response(form_data.model, res)
+        REQUEST_DURATION.observe(
+            time.perf_counter() - started, pipeline=form_data.model, route=route
+        )
+        if trace is not None:
+            trace.handled = time.perf_counter()
+        return response
+
+    # Async pipes run on the event loop, so that in-flight requests to them do not
+    # hold a worker thread each
+    if inspect.iscoroutinefunction(pipe) or inspect.isasyncgenfunction(pipe):
         if form_data.stream:
 
-            def stream_content():
-                res = pipe(
-                    user_message=user_message,
-                    model_id=pipeline_id,
-                    messages=messages,
-                    body=form_data.model_dump(),
-                )
+            async def stream_content_async():
+                with span("pipe"):
+                    res = call_pipe()
+                    if inspect.isawaitable(res):
+                        res = await res
 
-                logging.info(f"stream:true:{res}")
+                logger.debug("stream:true:%s", type(res).__name__)
 
                 if isinstance(res, str):
                     message = stream_message_template(form_data.model, res)
-                    logging.info(f"stream_content:str:{message}")
                     yield f"data: {json.dumps(message)}\n\n"
 
-                if isinstance(res, Iterator):
-                    for line in res:
-                        if isinstance(line, BaseModel):
-                            line = line.model_dump_json()
-                            line = f"data: {line}"
-
-                        try:
-                            line = line.decode("utf-8")
-                        except:
-                            pass
-
-                        logging.info(f"stream_content:Generator:{line}")
-
-                        if line.startswith("data:"):
-                            yield f"{line}\n\n"
-                        else:
-                            line = stream_message_template(form_data.model, line)
-                            yield f"data: {json.dumps(line)}\n\n"
-
-                if isinstance(res, str) or isinstance(res, Generator):
-                    finish_message = {
-                        "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": form_data.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {},
-                                "logprobs": None,
-                                "finish_reason": "stop",
-                            }
-                        ],
-                    }
+                if isinstance(res, AsyncIterator):
+                    async for line in res:
+                        yield format_stream_line(form_data.model, line)
 
-                    yield f"data: {json.dumps(finish_message)}\n\n"
+                if isinstance(res, str) or isinstance(res, AsyncGenerator):
+                    yield f"data: {json.dumps(stream_finish_message(form_data.model))}\n\n"
                     yield f"data: [DONE]"
 
-            return StreamingResponse(stream_content(), media_type="text/event-stream")
+            return stream_response(stream_content_async())
         else:
-            res = pipe(
-                user_message=user_message,
-                model_id=pipeline_id,
-                messages=messages,
-                body=form_data.model_dump(),
-            )
-            logging.info(f"stream:false:{res}")
+            try:
+                with span("pipe"):
+                    res = call_pipe()
+                    if inspect.isawaitable(res):
+                        res = await res
+
+                    logger.debug("stream:false:%s", type(res).__name__)
+
+                    if isinstance(res, AsyncIterator):
+                        res = "".join([f"{chunk}" async for chunk in res])
+            except Exception:
+                ERRORS.inc(pipeline=form_data.model, route=route)
+                raise
+            return completion(res)
+
+    def job(submitted: float):
+        queued = time.perf_counter() - submitted
+        QUEUE_WAIT.observe(queued, pipeline=form_data.model)
+        record("queue", queued, trace)
 
-            if isinstance(res, dict):
-                return res
-            elif isinstance(res, BaseModel):
-                return res.model_dump()
-            else:
+        if form_data.stream:
+
+            def stream_content():
+                with span("pipe"):
+                    res = call_pipe()
 
-                message = ""
+                logger.debug("stream:true:%s", type(res).__name__)
 
                 if isinstance(res, str):
-                    message = res
-
-                if isinstance(res, Generator):
-                    for stream in res:
-                        message = f"{message}{stream}"
-
-                logging.info(f"stream:false:{message}")
-                return {
-                    "id": f"{form_data.model}-{str(uuid.uuid4())}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": form_data.model,
-                    "choices": [
-                        {
-                            "index": 0,
-                            "message": {
-                                "role": "assistant",
-                                "content": message,
-                            },
-                            "logprobs": None,
-                            "finish_reason": "stop",
-                        }
-                    ],
-                }
+                    message = stream_message_template(form_data.model, res)
+                    yield f"data: {json.dumps(message)}\n\n"
 
-    return await run_in_threadpool(job)
+                if isinstance(res, Iterator):
+                    for line in res:
+                        yield format_stream_line(form_data.model, line)
+
+                if isinstance(res, str) or isinstance(res, Generator):
+                    yield f"data: {json.dumps(stream_finish_message(form_data.model))}\n\n"
+                    yield f"data: [DONE]"
+
+            if get_stream_outlet_filters(form_data.model):
+                return stream_response(iterate_in_threadpool(stream_content()))
+            if trace is not None:
+                trace.streaming = True
+            return StreamingResponse(
+                instrument_stream(stream_content(), form_data.model, route, started, trace),
+                media_type="text/event-stream",
+            )
+        else:
+            try:
+                with span("pipe"):
+                    res = call_pipe()
+                logger.debug("stream:false:%s", type(res).__name__)
+                return completion(res)
+            except Exception:
+                ERRORS.inc(pipeline=form_data.model, route=route)
+                raise
+
+    return await run_in_threadpool(job, time.perf_counter())
@@ -2,117 +2,151 @@
 title: Azure OpenAI Knowledge Retrieval Pipeline
 author: open-webui
 date: 2024-11-26
-version: 1.0
+version: 1.1
 license: MIT
 description: A pipeline for retrieving relevant information from an Azure-based knowledge base and synthesizing it using OpenAI's GPT model.
-requirements:  azure-search-documents,  azure-cosmos
+requirements:  azure-search-documents,  azure-cosmos, aiohttp
 
 """
 
 
+import asyncio
 import os
 import re
-from typing import List, Union, Generator, Iterator
-from azure.cosmos import CosmosClient
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
+from typing import AsyncGenerator, List, Union
 from dotenv import load_dotenv
 
+from utils.pipelines.clients import (
+    get_azure_openai_client,
+    get_cosmos_client,
+    get_search_client,
+)
+from utils.pipelines.turbosa import (
+    AzureOpenAILLM,
+    AzureSearchRetriever,
+    CosmosControlCatalog,
+    load_local_backends,
+)
+from utils.pipelines.logger import get_pipeline_logger
+
+logger = get_pipeline_logger(__name__)
+
+
+# Number of generated questions of a control that are answered concurrently
+MAX_CONCURRENT_QUESTIONS = int(os.getenv("TURBOSA_MAX_CONCURRENT_QUESTIONS", "4"))
+
+# "azure", or "local" to run on the stand-in backends built from TURBOSA_LOCAL_CORPUS
+TURBOSA_BACKEND = os.getenv("TURBOSA_BACKEND", "azure")
+
 
 class Pipeline:
     def __init__(self):
+        # The control catalog, retriever and LLM backends, see utils.pipelines.turbosa
+        self.catalog = None
+        self.retriever = None
+        self.llm = None
         pass
 
     async def on_startup(self):
         load_dotenv()
+        if os.getenv("TURBOSA_BACKEND", TURBOSA_BACKEND) == "local":
+            backends = load_local_backends(
+                os.getenv("TURBOSA_LOCAL_CORPUS", "turbosa_corpus.json"),
+                latency_ms=float(os.getenv("TURBOSA_STUB_LATENCY_MS", "200")),
+                tokens_per_second=float(os.getenv("TURBOSA_STUB_TOKENS_PER_SECOND", "50")),
+            )
+            self.catalog = backends["catalog"]
+            self.retriever = backends["retriever"]
+            self.llm = backends["llm"]
+            logger.info("Using local TurboSA backends.")
+            return
+
+        # The clients are async, so the pipe runs on the event loop and concurrent
+        # assessments do not each hold a worker thread while waiting on Azure
         try:
-            self.client_cosmosdb = CosmosClient(
+            self.client_cosmosdb = get_cosmos_client(
                 os.getenv("COSMOS_DB_URI"),
-                os.getenv("COSMOS_DB_KEY")
+                os.getenv("COSMOS_DB_KEY"),
+                is_async=True,
+                owner=__name__,
             )
-            print("Connected to Cosmos DB successfully.")
-            
+            logger.info("Connected to Cosmos DB successfully.")
+
             self.database = self.client_cosmosdb.get_database_client(os.getenv("COSMOS_DB_NAME"))
             self.container = self.database.get_container_client(os.getenv("COSMOS_DB_CONTAINER"))
-            print("Cosmos DB container connection successful.")
-            
+            self.catalog = CosmosControlCatalog(self.container)
+            logger.info("Cosmos DB container connection successful.")
+
         except Exception as e:
-            print(f"Failed to connect to Cosmos DB: {e}")
+            logger.error("Failed to connect to Cosmos DB: %s", e)
 
         try:
-            self.client = AzureOpenAI(
-                azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-                api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-                api_version="2024-08-01-preview"
+            self.client = get_azure_openai_client(
+                os.getenv("AZURE_OPENAI_ENDPOINT"),
+                os.getenv("AZURE_OPENAI_API_KEY"),
+                "2024-08-01-preview",
+                is_async=True,
+                owner=__name__,
+            )
+            self.llm = AzureOpenAILLM(
+                self.client, model="gpt-4o", max_tokens=800, temperature=0.7, top_p=0.95
             )
-            print("Connected to Azure OpenAI successfully.")
+            logger.info("Connected to Azure OpenAI successfully.")
         except Exception as e:
-            print(f"Failed to connect to Azure OpenAI: {e}")
-        
+            logger.error("Failed to connect to Azure OpenAI: %s", e)
+
         try:
-            self.search_client = SearchClient(
-                endpoint=os.getenv("AZURE_SEARCH_URI"),
-                index_name=os.getenv("AZURE_SEARCH_INDEX_NAME"),
-                credential=AzureKeyCredential(os.getenv("AZURE_SEARCH_KEY")),
+            self.search_client = get_search_client(
+                os.getenv("AZURE_SEARCH_URI"),
+                os.getenv("AZURE_SEARCH_INDEX_NAME"),
+                os.getenv("AZURE_SEARCH_KEY"),
+                is_async=True,
+                owner=__name__,
             )
-            print("Connected to Azure Search successfully.")
+            self.retriever = AzureSearchRetriever(
+                self.search_client, "vector-indexturbosa-semantic-configuration"
+            )
+            logger.info("Connected to Azure Search successfully.")
         except Exception as e:
-            print(f"Failed to connect to Azure Search: {e}")
+            logger.error("Failed to connect to Azure Search: %s", e)
 
     async def on_shutdown(self):
         pass
 
-    def fetch_cosmos_data(self, family: str, control_id: str):
-        query = f"SELECT * FROM c WHERE c.Family = '{family}' AND c.ControlID = '{control_id}'"
+    async def fetch_cosmos_data(self, family: str, control_id: str):
         try:
-            results = list(self.container.query_items(query=query, enable_cross_partition_query=True))
-            if results:
-                print(f"Query successful: {len(results)} item(s) retrieved.")
-                return results[0]
+            item = await self.catalog.get_control(family, control_id)
+            if item:
+                logger.debug("Query successful: item retrieved.")
             else:
-                print("Query executed, but no results found.")
-                return None
+                logger.debug("Query executed, but no results found.")
+            return item
         except Exception as e:
-            print(f"Error executing query: {e}")
+            logger.warning("Error executing query: %s", e)
             return None
 
-
-
-
     def extract_family_and_control_id(self, message: str):
         # Extract Family (allow Family: AC and similar patterns)
         family_match = re.search(r"(Family|family):\s*([A-Za-z0-9\-]+)", message)
-        
+
         # Extract Control ID (allow ControlID: 1 and similar patterns)
         control_id_match = re.search(r"(ControlID|controlid|ID|id):\s*(\d+)", message)
-        
+
         # If matches found, extract the values
         family = family_match.group(2) if family_match else None
         control_id = control_id_match.group(2) if control_id_match else None
-        
-        
-        return family, control_id
 
 
-    def run_search(self, query_text: str):
-        search_results = self.search_client.search(
-            search_text=query_text,
-            query_type="semantic",
-            select=["title", "chunk"],
-            semantic_configuration_name="vector-indexturbosa-semantic-configuration",
-            top=5,
-        )
+        return family, control_id
 
-        # If search_results is not already a list, convert it into one
-        if not isinstance(search_results, list):
-            search_results = list(search_results)
+    async def run_search(self, query_text: str):
+        search_results = await self.retriever.search(query_text, top=5)
 
         # Remove extra blank spaces between words in the chunk using regex
         for document in search_results:
             document['chunk'] = re.sub(r'\s+', ' ', document['chunk']).strip()
 
-            
+
         sources_formatted = "\n=================\n".join(
             [
                 f"FILE: {document['title']}\nCONTENT: {document['chunk']}"
@@ -120,115 +154,101 @@ class Pipeline:
             ]
         )
 
-        # Sort by score in descending order and take the top three
-        top_results = sorted(search_results, key=lambda doc: doc['@search.score'], reverse=True)[:3]
-
-        
-        # Formatting to lowercase and bold using ANSI escape codes
-        source_list = "\n\n".join(
-            [
-                f"**title:** {document['title'].lower()}\n"
-                f"**score:** {document['@search.score']:.2f}\n"
-                f"**related text starts from:** {' '.join(document['chunk'].lower().split()[:20])}..."
-                for document in top_results
-            ]
-        )
-
         source_list = "\n".join(
-            [f"- {document['title']} (Score: {search_results['@search.score']}:.2f)" for document in search_results]
+            [f"- {document['title']} (Score: {document['@search.score']:.2f})" for document in search_results]
         )
 
         return sources_formatted, source_list
 
-    def pipe(
-        self, user_message: str, model_id: str, messages: List[dict], body: dict
-    ) -> Union[str, Generator, Iterator]:
-        
-        
-        # Extract Family and ControlID from user message
-        family, control_id = self.extract_family_and_control_id(user_message)
-
+    async def answer_question(self, control_name: str, question: str) -> str:
+        # Perform search with both control name and question for specific chunks
+        search_results, source_list = await self.run_search(f"{control_name} {question}")
 
-        if family and control_id:
-            control_data = self.fetch_cosmos_data(family, control_id)
-            if control_data:
-                    control_name = control_data["Name"]
-                    generated_questions = control_data["GeneratedQuestions"].split("\n")  # List of questions
-                    generated_questions = [q.strip() for q in generated_questions if q.strip()]       
-
-                    all_answers = []
-
-                    # Loop through the first 3 questions, sending one by one to the chat
-                    for question in generated_questions:
-                            question = question.strip()  # Clean any leading/trailing spaces
-                            
-                            if question:  # Skip empty questions if any
-                                # Construct the search query for the specific question
-                                search_query = f"{control_name} {question}"
-
-                                # Perform search with both control name and question for specific chunks
-                                search_results, source_list = self.run_search(search_query)
-
-                                if  search_results:
-                                    
-                                    sys_prompt = f"""
-                                    You are an expert in security controls. Respond to the following QUESTION based on the provided CONTROL NAME and DOCUMENT TEXT.
-                                    Provide the company's name at the beginning. Verify if the QUESTION is answered in the DOCUMENT TEXT. Do not add any unnecessary explanations                                Provied the company's name at the begning. Verify if the  QUESTION was answerd in DOCUMENT TEXT.Don't add any unecessairy explanations.
-
-                                    CONTROL NAME: {control_name}
-                                    DOCUMENT TEXT: {search_results}
-                                    QUESTION: {question}
-                                    """
-
-                                    chat_prompt = [
-                                        {"role": "system", "content": sys_prompt},
-                                        {"role": "user", "content": question},
-                                    ]
-
-                                    # Get the answer for the current question
-                                    completion = self.client.chat.completions.create(
-                                        model="gpt-4o",
-                                        messages=chat_prompt,
-                                        max_tokens=800,
-                                        temperature=0.7,
-                                        top_p=0.95
-                                    )
-
-                                    # Retrieve the response and store it
-                                    gpt_result = completion.choices[0].message.content
-                                    print(f"'{source_list}'")
-
-
-                                # Store the result as a tuple (question, answer)
-                                all_answers.append(f"**Q: {question}**\nA: {gpt_result}\nSources used:\n{source_list}")
-
-                        # Combine all the answers into a single response
-                            final_response = f"**Family:'{family}'**\n ControlID:'{control_id}'\n".join(all_answers)
-
-            return f"'{final_response}'"
-           
-        else:
-            # If no family and control_id are provided, fall back to regular search
-            search_results, source_list = self.run_search(user_message)
+        gpt_result = "No relevant documents found."
+        if search_results:
             sys_prompt = f"""
-            You are a semantic search assistant. Respond to the user’s query with relevant information from the retrieved DOCUMENT TEXT.
-            Provide the company's name at the beginning. Verify if the query is answered in the DOCUMENT TEXT. Do not add any unnecessary explanations  
+            You are an expert in security controls. Respond to the following QUESTION based on the provided CONTROL NAME and DOCUMENT TEXT.
+            Provide the company's name at the beginning. Verify if the QUESTION is answered in the DOCUMENT TEXT. Do not add any unnecessary explanations                                Provied the company's name at the begning. Verify if the  QUESTION was answerd in DOCUMENT TEXT.Don't add any unecessairy explanations.
 
+            CONTROL NAME: {control_name}
             DOCUMENT TEXT: {search_results}
+            QUESTION: {question}
             """
+
             chat_prompt = [
                 {"role": "system", "content": sys_prompt},
-                {"role": "user", "content": user_message},
+                {"role": "user", "content": question},
             ]
 
-            completion = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=chat_prompt,
-                max_tokens=800,
-                temperature=0.7,
-                top_p=0.95,
-            )
+            gpt_result = await self.llm.complete(chat_prompt)
+
+        return f"**Q: {question}**\nA: {gpt_result}\nSources used:\n{source_list}"
+
+    async def assess_control(self, family: str, control_id: str) -> AsyncGenerator:
+        """
+        Answers the generated questions of a control concurrently and yields the
+        answers in order, each as soon as it and the ones before it are ready.
+        """
+        control_data = await self.fetch_cosmos_data(family, control_id)
+        if not control_data:
+            yield f"No control found for Family '{family}' and ControlID '{control_id}'."
+            return
+
+        control_name = control_data["Name"]
+        generated_questions = control_data["GeneratedQuestions"].split("\n")  # List of questions
+        generated_questions = [q.strip() for q in generated_questions if q.strip()]
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUESTIONS)
+
+        async def answer(question: str) -> str:
+            async with semaphore:
+                return await self.answer_question(control_name, question)
+
+        tasks = [asyncio.create_task(answer(question)) for question in generated_questions]
+        separator = f"**Family:'{family}'**\n ControlID:'{control_id}'\n"
+        try:
+            for i, task in enumerate(tasks):
+                yield f"{separator if i else ''}{await task}"
+        finally:
+            # The client went away or a question failed: stop the remaining ones
+            for task in tasks:
+                task.cancel()
+
+    async def search_and_answer(self, user_message: str, stream: bool) -> AsyncGenerator:
+        # If no family and control_id are provided, fall back to regular search
+        search_results, source_list = await self.run_search(user_message)
+        sys_prompt = f"""
+        You are a semantic search assistant. Respond to the user’s query with relevant information from the retrieved DOCUMENT TEXT.
+        Provide the company's name at the beginning. Verify if the query is answered in the DOCUMENT TEXT. Do not add any unnecessary explanations  
+
+        DOCUMENT TEXT: {search_results}
+        """
+        chat_prompt = [
+            {"role": "system", "content": sys_prompt},
+            {"role": "user", "content": user_message},
+        ]
+
+        if stream:
+            async for token in await self.llm.complete(chat_prompt, stream=True):
+                yield token
+        else:
+            yield await self.llm.complete(chat_prompt)
+
+        yield f"\n\n---\nSources used:\n{source_list}"
+
+    async def pipe(
+        self, user_message: str, model_id: str, messages: List[dict], body: dict
+    ) -> Union[str, AsyncGenerator]:
+        stream = bool(body.get("stream"))
+
+        # Extract Family and ControlID from user message
+        family, control_id = self.extract_family_and_control_id(user_message)
+
+        if family and control_id:
+            response = self.assess_control(family, control_id)
+        else:
+            response = self.search_and_answer(user_message, stream)
 
-            gpt_result = completion.choices[0].message.content
-            gpt_result += f"\n\n---\nSources used:\n{source_list}"
-            return gpt_result
\ No newline at end of file
+        if stream:
+            return response
+        return "".join([chunk async for chunk in response])
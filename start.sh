@@ -129,5 +129,9 @@ fi
 
 
 
-# Start the server
-uvicorn main:app --host "$HOST" --port "$PORT" --forwarded-allow-ips '*'
+# Start the server, on several worker processes if PIPELINES_WORKERS is set
+if [[ "${PIPELINES_WORKERS:-1}" -gt 1 ]]; then
+  python supervisor.py --host "$HOST" --port "$PORT" --workers "$PIPELINES_WORKERS"
+else
+  uvicorn main:app --host "$HOST" --port "$PORT" --forwarded-allow-ips '*'
+fi
@@ -0,0 +1,46 @@
+"""
+Runs the pipelines server on several worker processes.
+
+Every worker loads the pipelines itself. Reloads, added or deleted pipelines and
+valves updates handled by one worker are broadcast to the others through the
+control channel (see utils/pipelines/control.py), which this entry point turns
+on. uvicorn's process manager restarts workers that exit.
+
+Usage:
+    python supervisor.py --workers 4
+    PIPELINES_WORKERS=4 bash start.sh
+"""
+
+import argparse
+import os
+
+import uvicorn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "9099")))
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("PIPELINES_WORKERS", str(os.cpu_count() or 1))),
+    )
+    parser.add_argument("--forwarded-allow-ips", default="*")
+    args = parser.parse_args()
+
+    # Read by the workers, which inherit the environment
+    os.environ["PIPELINES_WORKERS"] = str(args.workers)
+    os.environ.setdefault("CONTROL_CHANNEL", "true")
+
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import gc
+import time
+
+from utils.pipelines.upstream import CircuitBreaker, Upstream
+
+
+def test_dropped_probe_stream_does_not_keep_circuit_half_open():
+    upstream = Upstream("test", failure_threshold=1, recovery_timeout=0.01)
+    with upstream.acquire() as slot:
+        slot.failure()
+    assert upstream.breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.02)
+    stream = upstream.stream(upstream.acquire(), iter(["chunk"]))
+    assert upstream.breaker.state == CircuitBreaker.HALF_OPEN
+    del stream
+    gc.collect()
+
+    time.sleep(0.02)
+    slot = upstream.acquire()
+    slot.success()
+    slot.release()
+    assert upstream.breaker.state == CircuitBreaker.CLOSED
+    assert upstream.limiter.in_flight == 0
@@ -0,0 +1,152 @@
+import asyncio
+import hashlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-text predictions into batches for local models.
+
+    Callers await predict(text). Texts are queued and a background worker
+    collects up to max_batch_size of them, waiting at most max_wait_ms after the
+    first one, and runs predict_batch on the whole batch in a dedicated thread,
+    off the event loop. Results are cached by text hash in a bounded LRU.
+
+    :param predict_batch: A function mapping a list of texts to a list of results.
+    :param max_batch_size: Maximum number of texts per batch.
+    :param max_wait_ms: Maximum time to wait for a batch to fill up.
+    :param cache_size: Maximum number of cached results, 0 to disable the cache.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[str]], List[Any]],
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10,
+        cache_size: int = 1024,
+    ):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, Any]" = OrderedDict()
+
+        # Local models are rarely thread-safe, so batches run one at a time
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        # The texts taken from the queue by the worker and not answered yet
+        self.batch: List[Tuple[str, str, asyncio.Future]] = []
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    async def predict(self, text: str) -> Any:
+        key = self.key(text)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self.run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((key, text, future))
+        return await future
+
+    async def next_batch(self) -> List[Tuple[str, str, asyncio.Future]]:
+        batch = self.batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait_ms / 1000
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+
+            # Identical texts in the same batch are only predicted once
+            texts = OrderedDict()
+            for key, text, _ in batch:
+                texts.setdefault(key, text)
+
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.predict_batch, list(texts.values())
+                )
+                results = dict(zip(texts.keys(), results))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                self.batch = []
+                continue
+
+            for key, result in results.items():
+                self.remember(key, result)
+            for key, _, future in batch:
+                if not future.done():
+                    future.set_result(results[key])
+            self.batch = []
+
+    def configure(
+        self,
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        cache_size: Optional[int] = None,
+    ):
+        """
+        Changes the batching settings in place. Queued texts and the batch in
+        progress are unaffected, and batches keep running on the same thread.
+        """
+        if max_batch_size is not None:
+            self.max_batch_size = max_batch_size
+        if max_wait_ms is not None:
+            self.max_wait_ms = max_wait_ms
+        if cache_size is not None:
+            self.cache_size = cache_size
+            while len(self.cache) > max(cache_size, 0):
+                self.cache.popitem(last=False)
+
+    def remember(self, key: str, result: Any):
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+        # Callers still waiting on the current batch or on queued texts get an
+        # error rather than being left hanging
+        pending = self.batch
+        self.batch = []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("The batcher was closed"))
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+from typing import Any, Callable, Dict, Optional
+
+from utils.pipelines.logger import get_logger
+
+logger = get_logger("clients")
+
+
+# Connection pool and timeout settings of the SDK clients built below
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "32"))
+CLIENT_CONNECT_TIMEOUT = float(os.getenv("CLIENT_CONNECT_TIMEOUT", "5"))
+CLIENT_READ_TIMEOUT = float(os.getenv("CLIENT_READ_TIMEOUT", "120"))
+CLIENT_MAX_RETRIES = int(os.getenv("CLIENT_MAX_RETRIES", "2"))
+
+# SDK clients are cached by kind, endpoint and credential hash, and shared by every
+# pipeline of the process. A valves update that does not change the endpoint or the
+# credentials therefore keeps the warm client and its pooled connections. Getters take
+# the id of the calling pipeline as owner, so that the client a pipeline no longer
+# uses after such a change is closed.
+CLIENTS: Dict[tuple, Any] = {}
+CLIENTS_LOCK = threading.Lock()
+# The cache key of the client each owner got last, see get_client
+CLIENT_OWNERS: Dict[tuple, tuple] = {}
+
+
+def credential_hash(*credentials: Optional[str]) -> str:
+    """
+    Returns a hash identifying credentials, so that cache keys never hold secrets.
+    """
+    digest = hashlib.sha256()
+    for credential in credentials:
+        digest.update((credential or "").encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def get_client(key: tuple, create: Callable[[], Any], owner: Optional[tuple] = None) -> Any:
+    """
+    Returns the client cached under key, calling create() to build it on first use.
+
+    :param key: The cache key, e.g. (kind, endpoint, credential_hash(api_key)).
+    :param create: A function building the client.
+    :param owner: Identifies who uses the client, e.g. (pipeline_id, service_name). When
+        an owner gets a client under a new key, e.g. after its credentials changed, the
+        client it used before is evicted and closed unless another owner still uses it.
+    """
+    stale = None
+    with CLIENTS_LOCK:
+        client = CLIENTS.get(key)
+        if client is None:
+            client = CLIENTS[key] = create()
+
+        if owner is not None:
+            previous = CLIENT_OWNERS.get(owner)
+            CLIENT_OWNERS[owner] = key
+            if previous not in (None, key) and previous not in CLIENT_OWNERS.values():
+                stale = CLIENTS.pop(previous, None)
+
+    if stale is not None:
+        close_client(stale)
+    return client
+
+
+def get_async_client(key: tuple, create: Callable[[], Any], owner: Optional[tuple] = None) -> Any:
+    """
+    Same as get_client for async clients, which are bound to the running event loop.
+    Must be called from a coroutine.
+    """
+    return get_client((*key, id(asyncio.get_running_loop())), create, owner=owner)
+
+
+def client_owner(owner: Optional[str], *kind: str) -> Optional[tuple]:
+    """The owner passed to get_client for a pipeline's client of a kind, if any."""
+    return (owner, *kind) if owner is not None else None
+
+
+def close_client(client: Any):
+    """Closes an evicted client. The close() coroutine of async clients runs on the current loop."""
+    try:
+        result = client.close() if hasattr(client, "close") else None
+        if asyncio.iscoroutine(result):
+            asyncio.get_running_loop().create_task(result)
+    except Exception as e:
+        logger.warning("Error closing client %s: %s", type(client).__name__, e)
+
+
+async def close_clients():
+    """Closes every cached client, sync and async. Called on server shutdown."""
+    with CLIENTS_LOCK:
+        clients = list(CLIENTS.values())
+        CLIENTS.clear()
+        CLIENT_OWNERS.clear()
+
+    for client in clients:
+        try:
+            result = client.close() if hasattr(client, "close") else None
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            logger.warning("Error closing client %s: %s", type(client).__name__, e)
+
+
+def azure_transport():
+    """A requests transport for Azure SDK clients with a pool of CLIENT_POOL_SIZE connections."""
+    import requests
+    from azure.core.pipeline.transport import RequestsTransport
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=CLIENT_POOL_SIZE, pool_maxsize=CLIENT_POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(
+        session=session,
+        session_owner=True,
+        connection_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUT,
+    )
+
+
+def azure_async_transport():
+    """An aiohttp transport for async Azure SDK clients with a pool of CLIENT_POOL_SIZE connections."""
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=CLIENT_POOL_SIZE, ttl_dns_cache=300)
+    )
+    return AioHttpTransport(
+        session=session,
+        session_owner=True,
+        connection_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUT,
+    )
+
+
+def get_cosmos_client(url: str, key: str, is_async: bool = False, owner: Optional[str] = None):
+    def create():
+        if is_async:
+            from azure.cosmos.aio import CosmosClient
+
+            return CosmosClient(url, key, transport=azure_async_transport())
+
+        from azure.cosmos import CosmosClient
+
+        return CosmosClient(url, key, transport=azure_transport())
+
+    cache_key = ("cosmos", url, credential_hash(key))
+    return (get_async_client if is_async else get_client)(
+        cache_key, create, owner=client_owner(owner, "cosmos")
+    )
+
+
+def get_search_client(
+    endpoint: str, index_name: str, key: str, is_async: bool = False, owner: Optional[str] = None
+):
+    def create():
+        from azure.core.credentials import AzureKeyCredential
+
+        if is_async:
+            from azure.search.documents.aio import SearchClient
+
+            return SearchClient(
+                endpoint=endpoint,
+                index_name=index_name,
+                credential=AzureKeyCredential(key),
+                transport=azure_async_transport(),
+            )
+
+        from azure.search.documents import SearchClient
+
+        return SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(key),
+            transport=azure_transport(),
+        )
+
+    cache_key = ("search", endpoint, index_name, credential_hash(key))
+    return (get_async_client if is_async else get_client)(
+        cache_key, create, owner=client_owner(owner, "search")
+    )
+
+
+def get_chat_completions_client(
+    endpoint: str, key: str, is_async: bool = False, owner: Optional[str] = None
+):
+    """An Azure AI Inference ChatCompletionsClient."""
+
+    def create():
+        from azure.core.credentials import AzureKeyCredential
+
+        if is_async:
+            from azure.ai.inference.aio import ChatCompletionsClient
+
+            return ChatCompletionsClient(
+                endpoint=endpoint,
+                credential=AzureKeyCredential(key),
+                transport=azure_async_transport(),
+            )
+
+        from azure.ai.inference import ChatCompletionsClient
+
+        return ChatCompletionsClient(
+            endpoint=endpoint,
+            credential=AzureKeyCredential(key),
+            transport=azure_transport(),
+        )
+
+    cache_key = ("inference", endpoint, credential_hash(key))
+    return (get_async_client if is_async else get_client)(
+        cache_key, create, owner=client_owner(owner, "inference")
+    )
+
+
+def get_azure_openai_client(
+    endpoint: str,
+    api_key: str,
+    api_version: str,
+    is_async: bool = False,
+    owner: Optional[str] = None,
+):
+    def create():
+        import httpx
+
+        limits = httpx.Limits(
+            max_connections=CLIENT_POOL_SIZE,
+            max_keepalive_connections=CLIENT_POOL_SIZE,
+        )
+        timeout = httpx.Timeout(CLIENT_READ_TIMEOUT, connect=CLIENT_CONNECT_TIMEOUT)
+
+        if is_async:
+            from openai import AsyncAzureOpenAI
+
+            return AsyncAzureOpenAI(
+                azure_endpoint=endpoint,
+                api_key=api_key,
+                api_version=api_version,
+                max_retries=CLIENT_MAX_RETRIES,
+                http_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+            )
+
+        from openai import AzureOpenAI
+
+        return AzureOpenAI(
+            azure_endpoint=endpoint,
+            api_key=api_key,
+            api_version=api_version,
+            max_retries=CLIENT_MAX_RETRIES,
+            http_client=httpx.Client(limits=limits, timeout=timeout),
+        )
+
+    cache_key = ("azure-openai", endpoint, api_version, credential_hash(api_key))
+    return (get_async_client if is_async else get_client)(
+        cache_key, create, owner=client_owner(owner, "azure-openai")
+    )
+
+
+def get_boto3_client(
+    service_name: str,
+    region_name: str,
+    access_key: str,
+    secret_key: str,
+    read_timeout: Optional[float] = None,
+    owner: Optional[str] = None,
+):
+    """
+    Returns a shared boto3 client.
+
+    :param owner: The id of the pipeline using the client. The client it used before is
+        closed when the region, the timeout or the credentials change.
+    """
+    read_timeout = read_timeout or CLIENT_READ_TIMEOUT
+
+    def create():
+        import boto3
+        from botocore.config import Config
+
+        return boto3.client(
+            service_name=service_name,
+            region_name=region_name,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            config=Config(
+                max_pool_connections=CLIENT_POOL_SIZE,
+                connect_timeout=CLIENT_CONNECT_TIMEOUT,
+                read_timeout=read_timeout,
+                # Unlike max_retries, max_attempts counts the first attempt as well
+                retries={"max_attempts": CLIENT_MAX_RETRIES + 1, "mode": "standard"},
+            ),
+        )
+
+    cache_key = (
+        "boto3",
+        service_name,
+        region_name,
+        read_timeout,
+        credential_hash(access_key, secret_key),
+    )
+    return get_client(cache_key, create, owner=client_owner(owner, "boto3", service_name))
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import os
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import PIPELINES_DIR
+
+from utils.pipelines.logger import get_logger
+from utils.pipelines.misc import file_lock, write_json_atomic
+
+logger = get_logger("control")
+
+
+# Number of worker processes, set by supervisor.py
+PIPELINES_WORKERS = int(os.getenv("PIPELINES_WORKERS", "1"))
+CONTROL_CHANNEL = (
+    os.getenv("CONTROL_CHANNEL", "true" if PIPELINES_WORKERS > 1 else "false").lower()
+    == "true"
+)
+CONTROL_DIR = os.getenv("CONTROL_DIR", os.path.join(PIPELINES_DIR, ".control"))
+CONTROL_POLL_INTERVAL = float(os.getenv("CONTROL_POLL_INTERVAL", "1"))
+
+
+class ControlChannel:
+    """
+    Broadcasts reload and valves update events between the worker processes of
+    one server through a state file shared by all of them.
+
+    The file holds a counter for reloads and one per pipeline for valves
+    updates. A worker bumps a counter after it applied a change itself, and the
+    other workers, which poll the file, apply every change whose counter moved
+    since they last looked. Changes themselves are read from disk: the pipeline
+    files and their valves.
+    """
+
+    def __init__(self, directory: str = CONTROL_DIR, poll_interval: float = CONTROL_POLL_INTERVAL):
+        self.path = os.path.join(directory, "state.json")
+        self.lock_path = os.path.join(directory, "state.lock")
+        self.poll_interval = poll_interval
+        self.seen = {"reload": 0, "valves": {}}
+        self.stat = None
+        self.task: Optional[asyncio.Task] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, "r") as file:
+                state = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {"reload": 0, "valves": {}}
+        return {"reload": state.get("reload", 0), "valves": state.get("valves", {})}
+
+    def update(self, change: Callable[[dict], None]) -> dict:
+        """Applies change to the state under an exclusive lock between processes."""
+        with file_lock(self.lock_path):
+            state = self.read()
+            change(state)
+            write_json_atomic(self.path, state)
+        return state
+
+    def publish_reload(self):
+        def change(state: dict):
+            state["reload"] += 1
+
+        state = self.update(change)
+        # This worker already applied its own change. Only that counter is marked
+        # as seen, and only if no other worker bumped it since the last poll:
+        # changes of other workers are still applied by poll()
+        if state["reload"] == self.seen["reload"] + 1:
+            self.seen["reload"] = state["reload"]
+
+    def publish_valves(self, pipeline_id: str):
+        def change(state: dict):
+            state["valves"][pipeline_id] = state["valves"].get(pipeline_id, 0) + 1
+
+        state = self.update(change)
+        count = state["valves"][pipeline_id]
+        if count == self.seen["valves"].get(pipeline_id, 0) + 1:
+            self.seen["valves"][pipeline_id] = count
+
+    def changed(self) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if key == self.stat:
+            return False
+        self.stat = key
+        return True
+
+    def poll(self) -> Dict[str, object]:
+        """
+        Returns whether other workers reloaded and the pipelines whose valves they
+        updated since the last poll.
+        """
+        if not self.changed():
+            return {"reload": False, "valves": []}
+
+        state = self.read()
+        reload = state["reload"] != self.seen["reload"]
+        valves: List[str] = [
+            pipeline_id
+            for pipeline_id, count in state["valves"].items()
+            if count != self.seen["valves"].get(pipeline_id, 0)
+        ]
+        self.seen = state
+        return {"reload": reload, "valves": valves}
+
+    def start(
+        self,
+        on_reload: Callable[[], Awaitable[None]],
+        on_valves: Callable[[str], Awaitable[None]],
+    ):
+        """Starts polling on the running event loop, from the current state."""
+        self.changed()
+        self.seen = self.read()
+
+        async def run():
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                try:
+                    events = self.poll()
+                    if events["reload"]:
+                        logger.info("Reloading pipelines changed by another worker")
+                        # A reload reads the valves of every pipeline as well
+                        await on_reload()
+                        continue
+                    for pipeline_id in events["valves"]:
+                        logger.info("Reloading valves of %s changed by another worker", pipeline_id)
+                        await on_valves(pipeline_id)
+                except Exception as e:
+                    logger.exception("Error applying control event: %s", e)
+
+        self.task = asyncio.create_task(run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+CONTROL = ControlChannel() if CONTROL_CHANNEL else None
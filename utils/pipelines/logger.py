@@ -0,0 +1,244 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# text or json, one object per line
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Formatted messages longer than this are truncated, 0 to disable
+LOG_MAX_LENGTH = int(os.getenv("LOG_MAX_LENGTH", "2000"))
+# Records are dropped, not waited for, when the queue is full
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Per-pipeline levels, e.g. "azure_openai_pipeline=DEBUG,router_manifold_pipeline=WARNING"
+PIPELINES_LOG_LEVELS = os.getenv("PIPELINES_LOG_LEVELS", "")
+LOG_REDACT_KEYS = {
+    key.strip().lower()
+    for key in os.getenv(
+        "LOG_REDACT_KEYS",
+        "api_key,apikey,authorization,password,secret,token,access_token,"
+        "refresh_token,aws_secret_key,aws_access_key,credential,credentials",
+    ).split(",")
+    if key.strip()
+}
+
+ROOT_LOGGER = "pipelines"
+REDACTED = "***"
+# Logged instead of arguments that could not be redacted
+UNREDACTABLE = "<arguments could not be redacted>"
+SECRET_PATTERNS = [
+    (re.compile(r"(?i)\b(bearer\s+)[A-Za-z0-9._~+/=-]+"), r"\1" + REDACTED),
+    (re.compile(r"\bsk-[A-Za-z0-9_-]{8,}"), REDACTED),
+]
+
+
+def redact(value, depth: int = 0):
+    """
+    Returns a copy of value with the values of secret keys (see LOG_REDACT_KEYS)
+    and bearer tokens masked. Pydantic models are redacted as dicts.
+    """
+    if depth > 10:
+        return value
+    if isinstance(value, BaseModel):
+        value = value.model_dump()
+    if isinstance(value, dict):
+        return {
+            key: (
+                REDACTED
+                if isinstance(key, str) and key.lower() in LOG_REDACT_KEYS
+                else redact(item, depth + 1)
+            )
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return type(value)(redact(item, depth + 1) for item in value)
+    if isinstance(value, str):
+        for pattern, replacement in SECRET_PATTERNS:
+            value = pattern.sub(replacement, value)
+    return value
+
+
+def truncate(text: str, max_length: int = LOG_MAX_LENGTH) -> str:
+    if max_length and len(text) > max_length:
+        return f"{text[:max_length]}... ({len(text) - max_length} more characters)"
+    return text
+
+
+# The attributes of every LogRecord, other attributes come from extra= and are
+# emitted as structured fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+
+class PayloadFormatter(logging.Formatter):
+    """
+    Formats records on the logging thread: redacts and truncates the message
+    arguments, and renders them as text or JSON lines with the extra= fields.
+    """
+
+    def __init__(self, format: str = LOG_FORMAT):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json = format == "json"
+
+    def message(self, record: logging.LogRecord) -> str:
+        if not getattr(record, "_redacted", False):
+            redact_record(record)
+        try:
+            message = record.msg % record.args if record.args else record.msg
+        except Exception:
+            # Never fall back to the raw arguments, which may hold secrets
+            message = f"{record.msg} {UNREDACTABLE}"
+        return truncate(str(message))
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.message = self.message(record)
+        fields = {
+            key: value
+            for key, value in vars(record).items()
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_")
+        }
+
+        if not self.json:
+            line = f"{self.formatTime(record)} {record.levelname} {record.name}: {record.message}"
+            if fields:
+                line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+            if record.exc_info:
+                line += "\n" + self.formatException(record.exc_info)
+            return line
+
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.message,
+            **fields,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def redact_record(record: logging.LogRecord):
+    """
+    Replaces the message, arguments and extra= fields of record with redacted
+    copies, or with a placeholder if they cannot be copied.
+    """
+    record.msg = redact(str(record.msg))
+    try:
+        if isinstance(record.args, dict):
+            record.args = redact(record.args)
+        elif record.args:
+            record.args = tuple(redact(arg) for arg in record.args)
+    except Exception:
+        record.msg = f"{record.msg} {UNREDACTABLE}"
+        record.args = ()
+
+    for key, value in list(vars(record).items()):
+        if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+            try:
+                setattr(record, key, redact(value))
+            except Exception:
+                setattr(record, key, UNREDACTABLE)
+    record._redacted = True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the logging thread, so that a slow sink never blocks a
+    request. Records are dropped and counted when the queue is full.
+
+    Only records whose level is enabled get here. Their arguments are redacted
+    on the calling thread, which also snapshots the dicts and lists a pipeline
+    may modify later. They are formatted into text on the logging thread.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        redact_record(record)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+LISTENER: Optional[logging.handlers.QueueListener] = None
+HANDLER: Optional[DroppingQueueHandler] = None
+LOCK = threading.Lock()
+
+
+def parse_levels(levels: str) -> Dict[str, str]:
+    """Parses "name=LEVEL,name=LEVEL" into a dict."""
+    parsed = {}
+    for item in levels.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure_logging():
+    """
+    Sends the records of the pipelines loggers through a bounded queue to a
+    stderr handler running on its own thread. Safe to call more than once.
+    """
+    global LISTENER, HANDLER
+    with LOCK:
+        if LISTENER is not None:
+            return
+
+        stream = logging.StreamHandler(sys.stderr)
+        stream.setFormatter(PayloadFormatter())
+        records = queue.Queue(LOG_QUEUE_SIZE)
+
+        logger = logging.getLogger(ROOT_LOGGER)
+        logger.setLevel(LOG_LEVEL)
+        HANDLER = DroppingQueueHandler(records)
+        logger.addHandler(HANDLER)
+        logger.propagate = False
+
+        for name, level in parse_levels(PIPELINES_LOG_LEVELS).items():
+            get_pipeline_logger(name).setLevel(level)
+
+        LISTENER = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+        LISTENER.start()
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Flushes the queued records and stops the logging thread."""
+    global LISTENER, HANDLER
+    with LOCK:
+        if LISTENER is not None:
+            logging.getLogger(ROOT_LOGGER).removeHandler(HANDLER)
+            LISTENER.stop()
+            LISTENER = None
+            HANDLER = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns the logger of a server component, e.g. get_logger("main")."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+
+def get_pipeline_logger(module_name: str) -> logging.Logger:
+    """Returns the logger of a pipeline module, whose level can be set in PIPELINES_LOG_LEVELS."""
+    return logging.getLogger(f"{ROOT_LOGGER}.pipeline.{module_name}")
+
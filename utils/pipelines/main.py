@@ -5,7 +5,9 @@ from typing import List
 from schemas import OpenAIChatMessage
 
 import inspect
-from typing import get_type_hints, Literal, Tuple
+import re
+from collections.abc import Sequence
+from typing import get_type_hints, Dict, Literal, Optional, Tuple, Union
 
 
 def stream_message_template(model: str, message: str):
@@ -25,6 +27,148 @@ def stream_message_template(model: str, message: str):
     }
 
 
+# Text up to the last of these boundaries can be post-processed on its own
+SENTENCE_BOUNDARY_REGEX = re.compile(r"[.!?]\s|[\u3002\uff01\uff1f]|\n")
+
+
+def split_at_sentence_boundary(text: str, start: int = 0) -> Tuple[str, str]:
+    """
+    Splits streamed text into the complete sentences it holds and the rest,
+    which should be kept until more text arrives.
+
+    :param start: Where to start looking for boundaries, e.g. one character
+        before the text appended since the last split.
+    """
+    end = None
+    for match in SENTENCE_BOUNDARY_REGEX.finditer(text, max(start, 0)):
+        end = match.end()
+    if end is None:
+        return "", text
+    return text[:end], text[end:]
+
+
+class MessageSlice(Sequence):
+    """
+    A read-only, copy-free view over a subset of a messages list.
+
+    The view holds a reference to the original list and the indices it exposes,
+    so the message dictionaries themselves are shared with the caller.
+    """
+
+    def __init__(self, messages: List[dict], indices: Sequence):
+        self._messages = messages
+        self._indices = indices
+
+    def __len__(self) -> int:
+        return len(self._indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return MessageSlice(self._messages, self._indices[key])
+        return self._messages[self._indices[key]]
+
+    def __iter__(self):
+        for index in self._indices:
+            yield self._messages[index]
+
+    def __repr__(self) -> str:
+        return f"MessageSlice({list(self)!r})"
+
+
+class MessageView:
+    """
+    Indexes roles, text parts and image parts of a messages list in one pass.
+
+    Filters and pipes that need several of the ``get_*`` helpers for the same
+    request should build a single view and use its accessors instead, as each
+    helper rescans the whole list. The view is a snapshot: rebuild it if the
+    underlying list is reordered or messages are inserted or removed.
+
+    :param messages: The list of message dictionaries.
+    """
+
+    def __init__(self, messages: List[dict]):
+        self.messages = messages
+        self.roles: Dict[str, List[int]] = {}
+        self.texts: List[Union[str, list, None]] = []
+        self.images: List[Tuple[int, dict]] = []
+
+        for index, message in enumerate(messages):
+            self.roles.setdefault(message["role"], []).append(index)
+
+            content = message.get("content")
+            text = content
+            if isinstance(content, list):
+                text = None
+                for item in content:
+                    if item["type"] == "text":
+                        if text is None:
+                            text = item["text"]
+                    elif item["type"] == "image_url":
+                        self.images.append((index, item))
+                if text is None:
+                    text = content
+            self.texts.append(text)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def first_index(self, role: str) -> Optional[int]:
+        indices = self.roles.get(role)
+        return indices[0] if indices else None
+
+    def last_index(self, role: str) -> Optional[int]:
+        indices = self.roles.get(role)
+        return indices[-1] if indices else None
+
+    def first(self, role: str) -> Optional[dict]:
+        index = self.first_index(role)
+        return self.messages[index] if index is not None else None
+
+    def last(self, role: str) -> Optional[dict]:
+        index = self.last_index(role)
+        return self.messages[index] if index is not None else None
+
+    def last_text(self, role: str) -> Union[str, list, None]:
+        index = self.last_index(role)
+        return self.texts[index] if index is not None else None
+
+    @property
+    def last_user_message(self) -> Union[str, list, None]:
+        return self.last_text("user")
+
+    @property
+    def last_assistant_message(self) -> Union[str, list, None]:
+        return self.last_text("assistant")
+
+    @property
+    def system_message(self) -> Optional[dict]:
+        return self.first("system")
+
+    @property
+    def image_count(self) -> int:
+        return len(self.images)
+
+    def with_role(self, role: str) -> MessageSlice:
+        return MessageSlice(self.messages, self.roles.get(role, []))
+
+    def without_role(self, role: str) -> MessageSlice:
+        excluded = self.roles.get(role)
+        if not excluded:
+            return MessageSlice(self.messages, range(len(self.messages)))
+        excluded = set(excluded)
+        return MessageSlice(
+            self.messages,
+            [index for index in range(len(self.messages)) if index not in excluded],
+        )
+
+    def without_system(self) -> MessageSlice:
+        return self.without_role("system")
+
+    def slice(self, start: Optional[int] = None, stop: Optional[int] = None, step: Optional[int] = None) -> MessageSlice:
+        return MessageSlice(self.messages, range(len(self.messages))[start:stop:step])
+
+
 def get_last_user_message(messages: List[dict]) -> str:
     for message in reversed(messages):
         if message["role"] == "user":
@@ -59,7 +203,8 @@ def remove_system_message(messages: List[dict]) -> List[dict]:
 
 
 def pop_system_message(messages: List[dict]) -> Tuple[dict, List[dict]]:
-    return get_system_message(messages), remove_system_message(messages)
+    view = MessageView(messages)
+    return view.system_message, list(view.without_system())
 
 
 def add_or_update_system_message(content: str, messages: List[dict]) -> List[dict]:
@@ -0,0 +1,186 @@
+import threading
+
+from typing import Dict, List, Sequence, Tuple
+
+
+# Latency buckets in seconds, from a cached filter call to a long generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def key(self, labels: Dict[str, str]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            lines.extend(self.samples())
+        return lines
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{format_labels(list(zip(self.labelnames, key)))} {format_value(value)}"
+            for key, value in sorted(self.values.items())
+        ]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: the count of each bucket (not cumulative), the sum and the count
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in sorted(self.values.items()):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{format_labels(labels + [('le', format_value(bound))])} {cumulative}"
+                )
+            lines.append(f"{self.name}_bucket{format_labels(labels + [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "pipelines_http_request_duration_seconds",
+    "Time to send the response headers, by route.",
+    ["method", "route", "status"],
+)
+REQUEST_DURATION = REGISTRY.histogram(
+    "pipelines_request_duration_seconds",
+    "Total time of a chat completion, until its last chunk when streaming.",
+    ["pipeline", "route"],
+)
+QUEUE_WAIT = REGISTRY.histogram(
+    "pipelines_queue_wait_seconds",
+    "Time a sync pipe waited for a threadpool worker.",
+    ["pipeline"],
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "pipelines_time_to_first_token_seconds",
+    "Time to the first streamed chunk.",
+    ["pipeline"],
+)
+STREAM_CHUNKS = REGISTRY.histogram(
+    "pipelines_stream_chunks",
+    "Number of chunks of a streamed response.",
+    ["pipeline"],
+    buckets=COUNT_BUCKETS,
+)
+STREAM_BYTES = REGISTRY.histogram(
+    "pipelines_stream_bytes",
+    "Number of bytes of a streamed response.",
+    ["pipeline"],
+    buckets=BYTES_BUCKETS,
+)
+ERRORS = REGISTRY.counter(
+    "pipelines_errors_total",
+    "Number of failed pipe calls and streams.",
+    ["pipeline", "route"],
+)
+FILTER_DURATION = REGISTRY.histogram(
+    "pipelines_filter_duration_seconds",
+    "Time spent in a filter hook.",
+    ["filter", "stage"],
+)
+RELOAD_DURATION = REGISTRY.histogram(
+    "pipelines_reload_duration_seconds",
+    "Time to reload every pipeline.",
+)
@@ -1,5 +1,14 @@
+import json
+import os
 import re
 
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 def convert_to_raw_url(github_url):
     """
@@ -33,3 +42,33 @@ def convert_to_raw_url(github_url):
 
     # If the URL does not match the expected pattern, return the original URL or raise an error
     return github_url
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive lock on path between processes, e.g. the workers of one
+    server. Does not lock where fcntl is not available (Windows).
+    """
+    with open(path, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_json_atomic(path: str, data):
+    """
+    Writes data as JSON to a temporary file next to path and renames it over
+    path, so that readers see either the old or the new document, never a
+    partially written one.
+    """
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
@@ -0,0 +1,38 @@
+from typing import List
+
+
+# Presidio engines are built lazily, once per process, so that the functions below
+# can also run in worker processes of a ProcessPoolExecutor.
+ENGINES = {}
+
+
+def get_engines():
+    if not ENGINES:
+        from presidio_analyzer import AnalyzerEngine
+        from presidio_anonymizer import AnonymizerEngine
+
+        ENGINES["analyzer"] = AnalyzerEngine()
+        ENGINES["anonymizer"] = AnonymizerEngine()
+    return ENGINES["analyzer"], ENGINES["anonymizer"]
+
+
+def redact_text(
+    text: str, language: str, entities: List[str], replacement: str = "[REDACTED]"
+) -> str:
+    from presidio_anonymizer.entities import OperatorConfig
+
+    analyzer, anonymizer = get_engines()
+    results = analyzer.analyze(text=text, language=language, entities=entities)
+
+    anonymized_text = anonymizer.anonymize(
+        text=text,
+        analyzer_results=results,
+        operators={"DEFAULT": OperatorConfig("replace", {"new_value": replacement})},
+    )
+    return anonymized_text.text
+
+
+def redact_texts(
+    texts: List[str], language: str, entities: List[str], replacement: str = "[REDACTED]"
+) -> List[str]:
+    return [redact_text(text, language, entities, replacement) for text in texts]
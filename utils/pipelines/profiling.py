@@ -0,0 +1,163 @@
+import os
+import sys
+import threading
+import time
+
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from utils.pipelines.logger import get_logger
+
+logger = get_logger("profiling")
+
+
+class ProfilingSettings:
+    """
+    Runtime profiling settings, updated through the admin profiling endpoints.
+
+    When enabled, every request gets a RequestTrace with the time spent in each
+    stage, and requests slower than slow_request_threshold_ms are logged with
+    their stage breakdown.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+        self.slow_request_threshold_ms = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "2000"))
+        self.max_slow_requests = int(os.getenv("MAX_SLOW_REQUESTS", "100"))
+
+
+SETTINGS = ProfilingSettings()
+SLOW_REQUESTS: deque = deque(maxlen=SETTINGS.max_slow_requests)
+CURRENT_TRACE: ContextVar[Optional["RequestTrace"]] = ContextVar("trace", default=None)
+
+
+class RequestTrace:
+    """
+    The stages of one request, e.g. queue, pipe, ttft, stream and filter hooks.
+    Durations of a stage that runs several times (a stream_outlet hook) add up.
+    """
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+        # Streamed responses are finished by the stream, not the middleware
+        self.streaming = False
+        self.finished = False
+        # When the endpoint returned its response body, to time its encoding
+        self.handled: Optional[float] = None
+
+    def add(self, stage: str, duration: float):
+        with self.lock:
+            entry = self.stages.setdefault(stage, [0.0, 0])
+            entry[0] += duration
+            entry[1] += 1
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def breakdown(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                stage: {"ms": round(total * 1000, 3), "count": count}
+                for stage, (total, count) in self.stages.items()
+            }
+
+    def server_timing(self) -> str:
+        """The stages formatted as a Server-Timing header."""
+        with self.lock:
+            return ", ".join(
+                f"{stage};dur={total * 1000:.3f}" for stage, (total, _) in self.stages.items()
+            )
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        total = time.perf_counter() - self.started
+        if total * 1000 < SETTINGS.slow_request_threshold_ms:
+            return
+
+        breakdown = self.breakdown()
+        SLOW_REQUESTS.append(
+            {
+                "method": self.method,
+                "path": self.path,
+                "started": time.time() - total,
+                "total_ms": round(total * 1000, 3),
+                "stages": breakdown,
+            }
+        )
+        stages = ", ".join(f"{stage} {value['ms']:.1f} ms" for stage, value in breakdown.items())
+        logger.warning(
+            "Slow request: %s %s %.1f ms (%s)", self.method, self.path, total * 1000, stages
+        )
+
+
+def start_trace(method: str, path: str) -> Optional[RequestTrace]:
+    if not SETTINGS.enabled:
+        return None
+    trace = RequestTrace(method, path)
+    CURRENT_TRACE.set(trace)
+    return trace
+
+
+def get_trace() -> Optional[RequestTrace]:
+    return CURRENT_TRACE.get()
+
+
+def record(stage: str, duration: float, trace: Optional[RequestTrace] = None):
+    """Adds duration to a stage of trace, or of the current request's trace."""
+    trace = trace or CURRENT_TRACE.get()
+    if trace is not None:
+        trace.add(stage, duration)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# Only one sampling profile runs at a time
+PROFILE_LOCK = threading.Lock()
+
+
+def sample_stacks(seconds: float, interval: float = 0.01) -> str:
+    """
+    Samples the stacks of every thread of the process for the given number of
+    seconds, and returns them in the collapsed ("folded") format read by
+    flamegraph.pl, speedscope and similar tools: one line per distinct stack,
+    frames from root to leaf separated by semicolons, followed by its count.
+    """
+    if not PROFILE_LOCK.acquire(blocking=False):
+        raise RuntimeError("A profile is already running")
+
+    try:
+        stacks: Counter = Counter()
+        current = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == current:
+                    continue
+                frames = []
+                while frame is not None:
+                    frames.append(frame_name(frame))
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, f"thread-{thread_id}"))
+                stacks[";".join(reversed(frames))] += 1
+            time.sleep(interval)
+    finally:
+        PROFILE_LOCK.release()
+
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,200 @@
+import queue
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from utils.pipelines.logger import get_logger
+
+logger = get_logger("telemetry")
+
+
+class TTLStore:
+    """
+    A bounded mapping whose entries expire ttl seconds after they were set.
+
+    Used by observability filters to hold in-flight trace state between inlet and
+    outlet, so that chats whose outlet never arrives do not leak memory. When the
+    store is full the oldest entry is evicted. on_evict is called with the key
+    and value of every expired or evicted entry.
+
+    :param max_size: Maximum number of entries.
+    :param ttl: Number of seconds an entry is kept.
+    :param on_evict: Optional callback for entries dropped without being popped.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 3600,
+        on_evict: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def set(self, key: Hashable, value: Any):
+        now = time.monotonic()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.ttl, value)
+            dropped = self._evict(now)
+        self._notify(dropped)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self.lock:
+            dropped = self._evict(now)
+            entry = self.entries.get(key)
+        self._notify(dropped)
+        return entry[1] if entry is not None else default
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self.lock:
+            dropped = self._evict(now)
+            entry = self.entries.pop(key, None)
+        self._notify(dropped)
+        return entry[1] if entry is not None else default
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _evict(self, now: float) -> list:
+        dropped = []
+        while self.entries:
+            key, (expires_at, value) = next(iter(self.entries.items()))
+            if expires_at <= now:
+                self.expired += 1
+            elif len(self.entries) > self.max_size:
+                self.evicted += 1
+            else:
+                break
+            del self.entries[key]
+            dropped.append((key, value))
+        return dropped
+
+    def _notify(self, dropped: list):
+        if self.on_evict is not None:
+            for key, value in dropped:
+                try:
+                    self.on_evict(key, value)
+                except Exception as e:
+                    logger.warning("Error evicting %s: %s", key, e)
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        return {"size": len(self.entries), "expired": self.expired, "evicted": self.evicted}
+
+
+class BackgroundExporter:
+    """
+    Runs telemetry calls on a single background thread, off the request path.
+
+    submit() never blocks: calls are put on a bounded queue and dropped (and
+    counted) when the queue is full, so a slow telemetry backend applies
+    backpressure to telemetry only, never to requests. The worker runs queued
+    calls in FIFO order, in batches of up to batch_size, and calls flush after
+    each batch if given.
+
+    :param name: Name of the worker thread.
+    :param max_queue_size: Maximum number of pending calls.
+    :param batch_size: Maximum number of calls run between two flushes.
+    :param flush: Optional callable run after each batch, e.g. the SDK's flush.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        name: str,
+        max_queue_size: int = 10000,
+        batch_size: int = 100,
+        flush: Optional[Callable[[], None]] = None,
+    ):
+        self.batch_size = batch_size
+        self.flush = flush
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self.submitted = 0
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> bool:
+        try:
+            self.queue.put_nowait((fn, args, kwargs))
+            self.submitted += 1
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for item in batch:
+                if item is self._STOP:
+                    stop = True
+                    continue
+                fn, args, kwargs = item
+                try:
+                    fn(*args, **kwargs)
+                    self.exported += 1
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning("Telemetry export error: %s", e)
+
+            if self.flush is not None:
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.errors += 1
+                    logger.warning("Telemetry flush error: %s", e)
+
+            if stop:
+                return
+
+    def resize(self, max_queue_size: int):
+        """
+        Changes the maximum number of pending calls. Calls already queued are kept,
+        and still run in order on the same worker thread.
+        """
+        with self.queue.mutex:
+            self.queue.maxsize = max_queue_size
+            self.queue.not_full.notify_all()
+
+    def close(self, timeout: float = 5):
+        """Runs the calls already queued, then stops the worker thread."""
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+
+    @property
+    def metrics(self) -> Dict[str, int]:
+        return {
+            "queued": self.queue.qsize(),
+            "submitted": self.submitted,
+            "exported": self.exported,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
@@ -0,0 +1,308 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple, Union
+
+from config import PIPELINES_DIR
+
+from utils.pipelines.logger import get_logger
+
+logger = get_logger("translation")
+
+
+TRANSLATION_CACHE_PATH = os.getenv(
+    "TRANSLATION_CACHE_PATH", os.path.join(PIPELINES_DIR, "translation_cache.db")
+)
+
+# Code blocks and markdown tables are passed through untranslated
+PROTECTED_BLOCK_REGEX = re.compile(
+    r"```[\s\S]*?```|(?:^[ \t]*\|.*\|[ \t]*(?:\n|$))+", re.MULTILINE
+)
+
+# Sentences and lines are the segments that are cached and re-used independently
+SEGMENT_SEPARATOR_REGEX = re.compile(r"((?<=[.!?\u3002\uff01\uff1f])[ \t]+|[ \t]*\n\s*)")
+
+Segment = Tuple[str, str, bool]
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _split_prose(text: str, segments: List[Segment]):
+    parts = SEGMENT_SEPARATOR_REGEX.split(text)
+    parts.append("")
+    for i in range(0, len(parts) - 1, 2):
+        if parts[i] or parts[i + 1]:
+            segments.append((parts[i], parts[i + 1], bool(parts[i].strip())))
+
+
+def split_segments(text: str) -> List[Segment]:
+    """
+    Splits text into (segment, separator, translatable) triples so that joining
+    every segment with its separator gives back the original text. Prose is
+    split into sentences and lines; code blocks and tables are kept whole and
+    marked as not translatable.
+    """
+    segments: List[Segment] = []
+    position = 0
+    for match in PROTECTED_BLOCK_REGEX.finditer(text):
+        _split_prose(text[position : match.start()], segments)
+        segments.append((match.group(0), "", False))
+        position = match.end()
+    _split_prose(text[position:], segments)
+    return segments
+
+
+async def translate_content(
+    content: Union[str, list, None], translate: Callable[[str], Awaitable[str]]
+) -> Union[str, list, None]:
+    """
+    Translates the content of a message with translate: a string, or the text
+    parts of a list of content parts, whose other parts (e.g. images) are kept.
+    Any other content is returned unchanged.
+    """
+    if isinstance(content, str):
+        return await translate(content)
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text" and isinstance(part.get("text"), str):
+                part = {**part, "text": await translate(part["text"])}
+            parts.append(part)
+        return parts
+    return content
+
+
+class TranslationMemory:
+    """
+    A bounded translation cache shared by the translation filters.
+
+    Translations are keyed by (namespace, source, target, hash of the normalized
+    text). Recent entries live in an in-memory LRU, and every entry is also
+    persisted to a SQLite file so it survives reloads and is shared between
+    filters and server workers. Set path to None to keep the cache in memory.
+
+    :param path: The SQLite file to persist translations to.
+    :param max_entries: Maximum number of translations kept in memory.
+    :param max_disk_entries: Maximum number of translations kept on disk.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = TRANSLATION_CACHE_PATH,
+        max_entries: int = 10000,
+        max_disk_entries: int = 100000,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.entries: "OrderedDict[Tuple[str, str, str, str], str]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.conn = None
+
+        if path:
+            try:
+                self.conn = sqlite3.connect(
+                    path, timeout=5, isolation_level=None, check_same_thread=False
+                )
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute(
+                    """CREATE TABLE IF NOT EXISTS translations (
+                        namespace TEXT NOT NULL,
+                        source TEXT NOT NULL,
+                        target TEXT NOT NULL,
+                        text_hash TEXT NOT NULL,
+                        translation TEXT NOT NULL,
+                        last_used REAL NOT NULL,
+                        PRIMARY KEY (namespace, source, target, text_hash)
+                    )"""
+                )
+            except sqlite3.Error as e:
+                logger.warning("Translation cache disabled for %s: %s", path, e)
+                self.conn = None
+
+    @staticmethod
+    def key(namespace: str, source: str, target: str, text: str) -> Tuple[str, str, str, str]:
+        text_hash = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+        return (namespace, source or "", target or "", text_hash)
+
+    def get(self, key: Tuple[str, str, str, str]) -> Optional[str]:
+        with self.lock:
+            translation = self.entries.get(key)
+            if translation is not None:
+                self.entries.move_to_end(key)
+                return translation
+
+            if self.conn is None:
+                return None
+
+            # Store errors, e.g. a database locked by another worker, are misses
+            try:
+                row = self.conn.execute(
+                    "SELECT translation FROM translations WHERE namespace = ? AND source = ? AND target = ? AND text_hash = ?",
+                    key,
+                ).fetchone()
+                if row is None:
+                    return None
+
+                self.conn.execute(
+                    "UPDATE translations SET last_used = ? WHERE namespace = ? AND source = ? AND target = ? AND text_hash = ?",
+                    (time.time(), *key),
+                )
+            except sqlite3.Error as e:
+                logger.warning("Error reading the translation cache: %s", e)
+                return None
+            self._remember(key, row[0])
+            return row[0]
+
+    def get_many(self, keys: List[Tuple[str, str, str, str]]) -> dict:
+        """Returns the cached translations of keys, by key."""
+        translations = {}
+        for key in keys:
+            translation = self.get(key)
+            if translation is not None:
+                translations[key] = translation
+        return translations
+
+    def put_many(self, items: List[Tuple[Tuple[str, str, str, str], str]]):
+        with self.lock:
+            for key, translation in items:
+                self._remember(key, translation)
+
+            if self.conn is None or not items:
+                return
+
+            # Store errors skip the write: the translations stay cached in memory
+            now = time.time()
+            try:
+                self.conn.execute("BEGIN")
+                try:
+                    self.conn.executemany(
+                        "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)",
+                        [(*key, translation, now) for key, translation in items],
+                    )
+                    self.conn.execute("COMMIT")
+                except BaseException:
+                    self.conn.execute("ROLLBACK")
+                    raise
+
+                previous_writes = self.writes
+                self.writes += len(items)
+                if self.writes // 500 != previous_writes // 500:
+                    self.conn.execute(
+                        """DELETE FROM translations WHERE rowid IN (
+                            SELECT rowid FROM translations ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                        )""",
+                        (self.max_disk_entries,),
+                    )
+            except sqlite3.Error as e:
+                logger.warning("Error writing the translation cache: %s", e)
+
+    def _remember(self, key: Tuple[str, str, str, str], translation: str):
+        self.entries[key] = translation
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def translate_async(
+        self,
+        text: str,
+        source: str,
+        target: str,
+        translate_batch_fn: Callable[[List[str], str, str], Awaitable[List[str]]],
+        namespace: str = "",
+        batch_size: int = 20,
+        batch_chars: int = 2000,
+        concurrency: int = 4,
+        retries: int = 2,
+        retry_delay: float = 1.0,
+    ) -> str:
+        """
+        Translates text segment by segment without blocking the event loop.
+
+        Segments that are not cached yet are de-duplicated, grouped into batches of
+        at most batch_size segments and batch_chars characters, and passed to
+        translate_batch_fn with at most concurrency batches in flight. A failing
+        batch is retried with exponential backoff, and left untranslated if it
+        still fails.
+        """
+        if not isinstance(text, str) or not text.strip():
+            return text
+
+        segments = split_segments(text)
+        results = [segment for segment, _, _ in segments]
+        keys = {
+            index: self.key(namespace, source, target, segment)
+            for index, (segment, _, translatable) in enumerate(segments)
+            if translatable
+        }
+
+        # The store is read and written in a thread: SQLite can wait up to its
+        # busy timeout for another worker
+        cached = await asyncio.to_thread(self.get_many, list(set(keys.values())))
+
+        pending = OrderedDict()
+        for index, key in keys.items():
+            if key in cached:
+                results[index] = cached[key]
+            else:
+                pending.setdefault(key, (segments[index][0], []))[1].append(index)
+
+        batches = []
+        batch, size = [], 0
+        for key, (segment, indices) in pending.items():
+            if batch and (len(batch) >= batch_size or size + len(segment) > batch_chars):
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append((key, segment, indices))
+            size += len(segment)
+        if batch:
+            batches.append(batch)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_batch(batch):
+            texts = [segment for _, segment, _ in batch]
+            async with semaphore:
+                for attempt in range(retries + 1):
+                    try:
+                        translations = await translate_batch_fn(texts, source, target)
+                        if len(translations) != len(texts):
+                            raise ValueError(
+                                f"Expected {len(texts)} translations, got {len(translations)}"
+                            )
+                        break
+                    except Exception as e:
+                        if attempt == retries:
+                            logger.warning("Error translating text: %s", e)
+                            return
+                        await asyncio.sleep(retry_delay * 2**attempt)
+
+            await asyncio.to_thread(
+                self.put_many,
+                [(key, translation) for (key, _, _), translation in zip(batch, translations)],
+            )
+            for (_, _, indices), translation in zip(batch, translations):
+                for index in indices:
+                    results[index] = translation
+
+        await asyncio.gather(*[run_batch(batch) for batch in batches])
+
+        return "".join(
+            f"{result}{separator}"
+            for result, (_, separator, _) in zip(results, segments)
+        )
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import math
+import re
+
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import AsyncIterator, Dict, List, Optional, Union
+
+
+# Backends of the TurboSA controls evidence pipeline. The pipeline only talks to
+# these three interfaces, so the Azure services can be swapped for local stand-ins
+# to run and benchmark it offline. A backend missing one of their methods cannot
+# be instantiated.
+
+
+class ControlCatalog(ABC):
+    @abstractmethod
+    async def get_control(self, family: str, control_id: str) -> Optional[dict]:
+        """Returns the control with its Name and GeneratedQuestions, or None."""
+
+
+class Retriever(ABC):
+    @abstractmethod
+    async def search(self, query: str, top: int = 5) -> List[dict]:
+        """Returns up to top documents with their title, chunk and @search.score."""
+
+
+class LLM(ABC):
+    @abstractmethod
+    async def complete(
+        self, messages: List[dict], stream: bool = False
+    ) -> Union[str, AsyncIterator[str]]:
+        """Returns the completion, or an async iterator of its tokens if stream is set."""
+
+
+class CosmosControlCatalog(ControlCatalog):
+    def __init__(self, container):
+        self.container = container
+
+    async def get_control(self, family: str, control_id: str) -> Optional[dict]:
+        query = "SELECT * FROM c WHERE c.Family = @family AND c.ControlID = @control_id"
+        parameters = [
+            {"name": "@family", "value": family},
+            {"name": "@control_id", "value": control_id},
+        ]
+        async for item in self.container.query_items(query=query, parameters=parameters):
+            return item
+        return None
+
+
+class AzureSearchRetriever(Retriever):
+    def __init__(self, search_client, semantic_configuration_name: str):
+        self.search_client = search_client
+        self.semantic_configuration_name = semantic_configuration_name
+
+    async def search(self, query: str, top: int = 5) -> List[dict]:
+        results = await self.search_client.search(
+            search_text=query,
+            query_type="semantic",
+            select=["title", "chunk"],
+            semantic_configuration_name=self.semantic_configuration_name,
+            top=top,
+        )
+        return [document async for document in results]
+
+
+class AzureOpenAILLM(LLM):
+    def __init__(self, client, model: str = "gpt-4o", **params):
+        self.client = client
+        self.model = model
+        self.params = params
+
+    async def complete(
+        self, messages: List[dict], stream: bool = False
+    ) -> Union[str, AsyncIterator[str]]:
+        completion = await self.client.chat.completions.create(
+            model=self.model, messages=messages, stream=stream, **self.params
+        )
+        if not stream:
+            return completion.choices[0].message.content
+
+        async def tokens():
+            async for chunk in completion:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        return tokens()
+
+
+class InMemoryControlCatalog(ControlCatalog):
+    """
+    :param controls: Controls with Family, ControlID, Name and GeneratedQuestions fields.
+    """
+
+    def __init__(self, controls: List[dict]):
+        self.controls = {
+            (str(control["Family"]), str(control["ControlID"])): control
+            for control in controls
+        }
+
+    async def get_control(self, family: str, control_id: str) -> Optional[dict]:
+        return self.controls.get((family, control_id))
+
+
+TOKEN_REGEX = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_REGEX.findall(text.lower())
+
+
+class BM25Retriever(Retriever):
+    """
+    A deterministic Okapi BM25 search over a local corpus, standing in for Azure
+    AI Search. Ties are broken by corpus order.
+
+    :param documents: Documents with title and chunk fields.
+    """
+
+    def __init__(self, documents: List[dict], k1: float = 1.5, b: float = 0.75):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokenize(document["chunk"])) for document in documents]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = sum(self.lengths) / len(documents) if documents else 0
+
+        document_frequencies = Counter()
+        for counts in self.term_counts:
+            document_frequencies.update(counts.keys())
+        n = len(documents)
+        self.idf = {
+            term: math.log(1 + (n - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def score(self, terms: List[str], index: int) -> float:
+        counts = self.term_counts[index]
+        norm = self.k1 * (1 - self.b + self.b * self.lengths[index] / (self.average_length or 1))
+        score = 0.0
+        for term in terms:
+            frequency = counts.get(term)
+            if frequency:
+                score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+        return score
+
+    async def search(self, query: str, top: int = 5) -> List[dict]:
+        terms = [term for term in set(tokenize(query)) if term in self.idf]
+        scores = [(self.score(terms, index), index) for index in range(len(self.documents))]
+        ranked = sorted(
+            (item for item in scores if item[0] > 0), key=lambda item: (-item[0], item[1])
+        )
+        return [
+            {**self.documents[index], "@search.score": score}
+            for score, index in ranked[:top]
+        ]
+
+
+class StubLLM(LLM):
+    """
+    A stand-in for the completion model that answers after latency_ms, then
+    produces tokens at tokens_per_second.
+
+    :param latency_ms: Time to first token.
+    :param tokens_per_second: Generation speed, 0 for instantaneous.
+    :param tokens: Number of tokens in each answer.
+    """
+
+    def __init__(self, latency_ms: float = 200, tokens_per_second: float = 50, tokens: int = 50):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+
+    def answer(self, messages: List[dict]) -> List[str]:
+        question = messages[-1]["content"] if messages else ""
+        words = (tokenize(question) or ["answer"]) * self.tokens
+        return [f"{word} " for word in words[: self.tokens]]
+
+    async def complete(
+        self, messages: List[dict], stream: bool = False
+    ) -> Union[str, AsyncIterator[str]]:
+        tokens = self.answer(messages)
+        delay = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        await asyncio.sleep(self.latency_ms / 1000)
+
+        if not stream:
+            await asyncio.sleep(delay * len(tokens))
+            return "".join(tokens)
+
+        async def generate():
+            for i, token in enumerate(tokens):
+                if i and delay:
+                    await asyncio.sleep(delay)
+                yield token
+
+        return generate()
+
+
+def load_local_backends(
+    path: str,
+    latency_ms: float = 200,
+    tokens_per_second: float = 50,
+    tokens: int = 50,
+) -> Dict[str, object]:
+    """
+    Builds local stand-in backends from a JSON file with "controls" and
+    "documents" lists.
+    """
+    with open(path, "r") as file:
+        data = json.load(file)
+
+    return {
+        "catalog": InMemoryControlCatalog(data.get("controls", [])),
+        "retriever": BM25Retriever(data.get("documents", [])),
+        "llm": StubLLM(latency_ms, tokens_per_second, tokens),
+    }
@@ -0,0 +1,349 @@
+import threading
+import time
+
+from collections.abc import Generator
+from typing import Dict, Iterator, Optional
+
+from utils.pipelines.logger import get_logger
+
+logger = get_logger("upstream")
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised instead of calling an upstream whose circuit is open or whose
+    concurrency limit stays reached for longer than the queue timeout.
+    """
+
+
+class CircuitBreaker:
+    """
+    A consecutive-failure circuit breaker.
+
+    The circuit opens after failure_threshold consecutive failures, and calls
+    fail fast until recovery_timeout seconds have passed. It then lets a single
+    probe call through: the circuit closes if the probe succeeds and opens again
+    if it fails.
+
+    :param failure_threshold: Number of consecutive failures that open the circuit.
+    :param recovery_timeout: Number of seconds the circuit stays open.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def cancel_probe(self):
+        """Lets another call probe a half-open circuit, e.g. when the probe was never made."""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Circuit opened after %s consecutive failures", self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+class AdaptiveLimiter:
+    """
+    A concurrency limit adjusted with AIMD (additive increase, multiplicative
+    decrease).
+
+    Every fast success raises the limit by 1 / limit, i.e. by about one per round
+    of limit calls, up to max_limit. Overload signals (429s, timeouts, server
+    errors) and responses slower than latency_target multiply the limit by
+    backoff, at most once per second and down to min_limit.
+
+    :param max_limit: Maximum (and initial) number of concurrent calls.
+    :param min_limit: Minimum number of concurrent calls.
+    :param latency_target: Response time in seconds above which the limit decreases, 0 to ignore latency.
+    :param backoff: Factor applied to the limit on overload.
+    """
+
+    def __init__(
+        self,
+        max_limit: int = 32,
+        min_limit: int = 1,
+        latency_target: float = 0,
+        backoff: float = 0.5,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def record_success(self, latency: float):
+        if self.latency_target and latency > self.latency_target:
+            self.record_overload()
+            return
+        with self.condition:
+            self.limit = min(self.limit + 1 / self.limit, float(self.max_limit))
+            self.condition.notify()
+
+    def record_overload(self):
+        with self.condition:
+            now = time.monotonic()
+            if now - self.last_decrease < 1:
+                return
+            self.last_decrease = now
+            self.limit = max(self.limit * self.backoff, float(self.min_limit))
+
+
+class Slot:
+    """
+    A call in flight to an upstream, returned by Upstream.acquire().
+
+    Report the outcome with success() or failure() as soon as the response
+    status is known, and call release() when the response has been consumed.
+    Used as a context manager, an exception counts as an overload failure and
+    the slot is released on exit.
+    """
+
+    def __init__(self, upstream: "Upstream", probe: bool = False):
+        self.upstream = upstream
+        # Whether this call probes a half-open circuit
+        self.probe = probe
+        self.started = time.monotonic()
+        self.reported = False
+        self.released = False
+
+    def success(self):
+        if not self.reported:
+            self.reported = True
+            self.upstream.breaker.record_success()
+            self.upstream.limiter.record_success(time.monotonic() - self.started)
+
+    def failure(self, overloaded: bool = True):
+        if not self.reported:
+            self.reported = True
+            self.upstream.failures += 1
+            self.upstream.breaker.record_failure()
+            if overloaded:
+                self.upstream.limiter.record_overload()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.upstream.limiter.release()
+            # A probe released without an outcome, e.g. a stream that was never
+            # iterated, must not keep the circuit half-open for good
+            if self.probe and not self.reported:
+                self.upstream.breaker.cancel_probe()
+
+    def __enter__(self) -> "Slot":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.failure()
+        self.release()
+
+
+class SlotStream(Generator):
+    """
+    Iterates over a streamed response, holding its slot until the stream ends,
+    fails or is closed. Unlike a generator function, the slot is also released
+    if the stream is dropped without ever being iterated.
+    """
+
+    def __init__(self, slot: Slot, iterator: Iterator):
+        self.slot = slot
+        self.iterator = iter(iterator)
+
+    def send(self, value):
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.slot.release()
+            raise
+        except Exception:
+            self.slot.failure()
+            self.slot.release()
+            raise
+
+    def throw(self, typ, val=None, tb=None):
+        self.close()
+        return super().throw(typ, val, tb)
+
+    def close(self):
+        try:
+            close = getattr(self.iterator, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self.slot.release()
+
+    def __del__(self):
+        self.slot.release()
+
+
+class Upstream:
+    """
+    Guards the calls to one upstream (an API endpoint or a cloud service) with
+    a circuit breaker and an adaptive concurrency limit, so that a slow or
+    failing upstream fails fast instead of tying up the server's worker threads.
+
+    :param name: Name of the upstream, used in errors.
+    :param timeout: Read timeout in seconds that callers should pass to their client.
+    :param connect_timeout: Connect timeout in seconds that callers should pass to their client.
+    :param queue_timeout: Maximum number of seconds to wait for a free slot.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 60,
+        connect_timeout: float = 5,
+        queue_timeout: float = 5,
+        max_concurrency: int = 32,
+        latency_target: float = 0,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30,
+    ):
+        self.name = name
+        self.breaker = CircuitBreaker(failure_threshold, recovery_timeout)
+        self.limiter = AdaptiveLimiter(max_concurrency, latency_target=latency_target)
+        self.rejected = 0
+        self.failures = 0
+        self.configure(
+            timeout=timeout,
+            connect_timeout=connect_timeout,
+            queue_timeout=queue_timeout,
+            max_concurrency=max_concurrency,
+            latency_target=latency_target,
+            failure_threshold=failure_threshold,
+            recovery_timeout=recovery_timeout,
+        )
+
+    def configure(
+        self,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        queue_timeout: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        latency_target: Optional[float] = None,
+        failure_threshold: Optional[int] = None,
+        recovery_timeout: Optional[float] = None,
+    ):
+        if timeout is not None:
+            self.timeout = timeout
+        if connect_timeout is not None:
+            self.connect_timeout = connect_timeout
+        if queue_timeout is not None:
+            self.queue_timeout = queue_timeout
+        if max_concurrency is not None:
+            self.limiter.max_limit = max_concurrency
+            self.limiter.limit = min(self.limiter.limit, float(max_concurrency))
+        if latency_target is not None:
+            self.limiter.latency_target = latency_target
+        if failure_threshold is not None:
+            self.breaker.failure_threshold = failure_threshold
+        if recovery_timeout is not None:
+            self.breaker.recovery_timeout = recovery_timeout
+
+    @property
+    def timeouts(self) -> tuple:
+        """The (connect, read) timeout tuple expected by requests."""
+        return (self.connect_timeout, self.timeout)
+
+    def acquire(self) -> Slot:
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise UpstreamUnavailable(f"{self.name} is unavailable (circuit open)")
+        probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+        if not self.limiter.acquire(self.queue_timeout):
+            self.rejected += 1
+            # The probe of a half-open circuit must not stay pending
+            if probe:
+                self.breaker.record_failure()
+            raise UpstreamUnavailable(f"{self.name} is overloaded (concurrency limit reached)")
+        return Slot(self, probe=probe)
+
+    def stream(self, slot: Slot, iterator: Iterator) -> SlotStream:
+        """Iterates over iterator, holding slot until the stream ends or is closed."""
+        return SlotStream(slot, iterator)
+
+    @property
+    def metrics(self) -> Dict[str, object]:
+        return {
+            "state": self.breaker.state,
+            "limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "rejected": self.rejected,
+            "failures": self.failures,
+        }
+
+
+# Upstreams are shared by every pipeline of the process that calls them
+UPSTREAMS: Dict[str, Upstream] = {}
+UPSTREAMS_LOCK = threading.Lock()
+
+
+def get_upstream(name: str, **settings) -> Upstream:
+    """
+    Returns the upstream registered under name, creating it on first use.
+    Settings passed on later calls update the existing upstream.
+
+    :param name: The upstream's name, e.g. "azure-openai:https://example.openai.azure.com".
+    """
+    with UPSTREAMS_LOCK:
+        upstream = UPSTREAMS.get(name)
+        if upstream is None:
+            upstream = UPSTREAMS[name] = Upstream(name, **settings)
+        elif settings:
+            upstream.configure(**settings)
+        return upstream
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import os
+
+from typing import Dict, Optional
+
+from config import PIPELINES_DIR
+
+from utils.pipelines.logger import get_logger
+from utils.pipelines.misc import file_lock, write_json_atomic
+
+logger = get_logger("valves")
+
+
+VALVES_STORE_PATH = os.getenv("VALVES_STORE_PATH", os.path.join(PIPELINES_DIR, "valves_store.json"))
+# Updates made within this many seconds of each other are written together
+VALVES_FLUSH_DELAY = float(os.getenv("VALVES_FLUSH_DELAY", "0.05"))
+
+# Version 1: {"version": 1, "valves": {module_name: {valve: value}}}
+SCHEMA_VERSION = 1
+
+
+def migrate(document: dict) -> dict:
+    """Upgrades a store document read from disk to SCHEMA_VERSION."""
+    version = document.get("version", 0)
+    if version > SCHEMA_VERSION:
+        raise ValueError(
+            f"Valves store version {version} is newer than the supported {SCHEMA_VERSION}"
+        )
+    return {"version": SCHEMA_VERSION, "valves": document.get("valves", {})}
+
+
+class ValvesStore:
+    """
+    The saved valves of every pipeline, keyed by module name, in one JSON
+    document that is replaced atomically on every write.
+
+    Writes merge the changed pipelines into the document on disk under a lock,
+    so that the workers of one server do not overwrite each other's updates.
+    Concurrent updates are batched into one write by save().
+
+    Pipelines saved before the store existed keep their valves in
+    PIPELINES_DIR/<module>/valves.json, which are imported on first load.
+    """
+
+    def __init__(self, path: str = VALVES_STORE_PATH, flush_delay: float = VALVES_FLUSH_DELAY):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+        self.flush_delay = flush_delay
+        self.valves: Dict[str, dict] = {}
+        self.pending: Dict[str, dict] = {}
+        self.flushing: Optional[asyncio.Task] = None
+        self.write_lock: Optional[asyncio.Lock] = None
+
+    def read(self) -> dict:
+        try:
+            with open(self.path, "r") as file:
+                return migrate(json.load(file))
+        except FileNotFoundError:
+            return migrate({})
+
+    def load(self):
+        """Reads the store from disk, e.g. on startup or after another worker changed it."""
+        try:
+            self.valves = self.read()["valves"]
+        except ValueError as e:
+            logger.error("Error reading valves store %s: %s", self.path, e)
+            self.valves = {}
+        self.valves.update(self.pending)
+
+    def get(self, module_name: str) -> dict:
+        """
+        Returns the saved valves of a pipeline module, importing its legacy
+        valves.json if the store has none.
+        """
+        if module_name in self.valves:
+            return self.valves[module_name]
+
+        legacy_path = os.path.join(PIPELINES_DIR, module_name, "valves.json")
+        if os.path.exists(legacy_path):
+            try:
+                with open(legacy_path, "r") as file:
+                    valves = json.load(file)
+            except ValueError as e:
+                logger.warning("Ignoring invalid %s: %s", legacy_path, e)
+                return {}
+            if valves:
+                logger.info("Imported valves of %s from %s", module_name, legacy_path)
+                self.valves[module_name] = self.pending[module_name] = valves
+            return valves
+        return {}
+
+    def write(self, updates: Dict[str, dict]):
+        """Merges updates into the document on disk."""
+        with file_lock(self.lock_path):
+            document = self.read()
+            document["valves"].update(updates)
+            write_json_atomic(self.path, document)
+
+    def flush(self):
+        """Writes the pending updates, e.g. the valves imported during startup."""
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            self.write(pending)
+
+    async def save(self, module_name: str, valves: dict):
+        """
+        Saves the valves of a pipeline module, and returns once they are on disk.
+        Updates saved while a flush is scheduled or writing are written by it.
+        """
+        self.valves[module_name] = self.pending[module_name] = valves
+        if self.write_lock is None:
+            self.write_lock = asyncio.Lock()
+
+        if self.flushing is None:
+
+            async def flush_later():
+                await asyncio.sleep(self.flush_delay)
+                try:
+                    async with self.write_lock:
+                        while self.pending:
+                            pending, self.pending = self.pending, {}
+                            await asyncio.to_thread(self.write, pending)
+                finally:
+                    self.flushing = None
+
+            self.flushing = asyncio.create_task(flush_later())
+
+        await asyncio.shield(self.flushing)
+
+
+VALVES = ValvesStore()